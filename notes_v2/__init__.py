@@ -4,53 +4,55 @@ import re
 from datetime import datetime, timedelta
 
 import click
-import sqlalchemy
-from flask import Blueprint, redirect, request, url_for
+from flask import Blueprint, current_app, redirect, request, url_for
 from flask.cli import with_appcontext
 from flask.json.provider import DefaultJSONProvider
 from markupsafe import escape
-from sqlalchemy import func
+from sqlalchemy import event, func
 from sqlalchemy.orm import scoped_session, sessionmaker, Session
-from sqlalchemy.pool import NullPool
 
 import notes_v2.report
-from notes_v2 import add, report
-from notes_v2.models import Base, Note, NoteDomain
+from notes_v2 import add, migrate, report, warm
+from notes_v2.models import Base, DomainStats, Note, intern_new_domains
+from notes_v2.report.render_utils import conditional_get
 from util import TimeScope, TimeScopeBuilder
+from util.database import create_sqlite_engine, sqlite_options_from_config
 # noinspection PyUnresolvedReferences
 from . import models
 
 db_session: Session | None = None
 
 
-def load_models(current_db_path: str):
-    engine = sqlalchemy.create_engine(
-        'sqlite:///' + current_db_path,
-        connect_args={
-            "check_same_thread": False,
-        },
-        # NB This breaks pytests.
-        poolclass=NullPool,
-    )
+def _create_db_session(engine) -> scoped_session:
+    session_factory = sessionmaker(autocommit=False,
+                                   autoflush=False,
+                                   bind=engine)
+    event.listen(session_factory, 'before_flush', intern_new_domains)
+
+    return scoped_session(session_factory)
+
+
+def load_models(current_db_path: str, **engine_kwargs):
+    engine = create_sqlite_engine(current_db_path, **engine_kwargs)
     Base.metadata.create_all(bind=engine)
+    migrate.migrate_models(engine)
 
     global db_session
-    db_session = scoped_session(sessionmaker(autocommit=False,
-                                             autoflush=False,
-                                             bind=engine))
+    db_session = _create_db_session(engine)
 
     # TODO: Stop using the .query attribute, in favor of new SQLAlchemy 2.0 API model.
     Base.query = db_session.query_property()
 
+    add.backfill_derived_tables(db_session)
+
 
 def load_models_pytest():
-    engine = sqlalchemy.create_engine('sqlite:///')
+    engine = create_sqlite_engine('')
     Base.metadata.create_all(bind=engine)
+    migrate.migrate_models(engine)
 
     global db_session
-    db_session = scoped_session(sessionmaker(autocommit=False,
-                                             autoflush=False,
-                                             bind=engine))
+    db_session = _create_db_session(engine)
 
     # TODO: Stop using the .query attribute, in favor of new SQLAlchemy 2.0 API model.
     Base.query = db_session.query_property()
@@ -72,25 +74,30 @@ def strtobool(val) -> bool:
 
 def init_app(app):
     if not app.config['TESTING']:
-        load_models(os.path.abspath(os.path.join(app.instance_path, 'notes-v2.db')))
+        load_models(os.path.abspath(os.path.join(app.instance_path, 'notes-v2.db')),
+                    **sqlite_options_from_config(app.config))
 
     _register_endpoints(app)
     _register_rest_endpoints(app)
 
     @click.command('n2/add', help='Import notes from a CSV file')
     @click.argument('csv_file', type=click.File('r'))
+    @click.option('--bulk/--row-by-row', default=True, show_default=True,
+                  help='Insert rows in batches, in a single transaction')
     @with_appcontext
-    def n2_add(csv_file):
-        add.all_from_csv(db_session, csv_file, expect_duplicates=False)
+    def n2_add(csv_file, bulk):
+        add.all_from_csv(db_session, csv_file, expect_duplicates=False, bulk=bulk)
 
     app.cli.add_command(n2_add)
 
     @click.command('n2/update', help='Update notes from partially-imported CSV file(s)')
     @click.argument('csv_files', type=click.File('r'), nargs=-1)
+    @click.option('--bulk/--row-by-row', default=True, show_default=True,
+                  help='Match and insert rows in batches, one transaction per file')
     @with_appcontext
-    def n2_update(csv_files):
+    def n2_update(csv_files, bulk):
         for csv_file in csv_files:
-            add.all_from_csv(db_session, csv_file, expect_duplicates=True)
+            add.all_from_csv(db_session, csv_file, expect_duplicates=True, bulk=bulk)
 
     app.cli.add_command(n2_update)
 
@@ -102,6 +109,29 @@ def init_app(app):
 
     app.cli.add_command(n2_export)
 
+    @click.command('n2/warm', help='Pre-render recent notes pages into the persistent render cache')
+    @click.option('--quarters', default=2, show_default=True, help='Number of recent quarters to render')
+    @click.option('--weeks', default=4, show_default=True, help='Number of recent weeks to render')
+    @click.option('--top-domains', default=0, show_default=True,
+                  help='Also render each scope filtered to this many of the most common domains')
+    @click.option('--jobs', default=os.cpu_count() or 1, show_default=True,
+                  help='Number of worker processes; each one starts its own copy of the app')
+    @with_appcontext
+    def n2_warm(quarters, weeks, top_domains, jobs):
+        if report.render_utils.get_render_cache().persistent_store is None:
+            raise click.UsageError("No persistent render cache configured, see RENDER_CACHE_PATH")
+
+        with current_app.test_request_context():
+            urls = warm.warm_urls(
+                warm.recent_scopes(quarters, weeks),
+                warm.top_domains(db_session, top_domains),
+            )
+
+        for result in warm.warm_render_cache(current_app._get_current_object(), urls, jobs):
+            print(f"{result.status_code} {result.elapsed_seconds:.3f}s {result.url}")
+
+    app.cli.add_command(n2_warm)
+
     @click.command('n2/color', help='Check render colors for different domains')
     @click.argument('domains', nargs=-1)
     @with_appcontext
@@ -147,15 +177,19 @@ def _register_endpoints(app):
         return report.edit_notes_simple(n, n)
 
     @notes_v2_bp.route("/notes")
+    @conditional_get(lambda: request.args.getlist('scope'))
     def do_render_matching_notes():
         page_scopes = tuple(escape(arg) for arg in request.args.getlist('scope'))
         single_page = strtobool(request.args.get('single_page'))
+        stream = strtobool(request.args.get('stream'))
 
         url_kwargs = {
             'domain': tuple(request.args.getlist('domain')),
         }
         if single_page:
             url_kwargs['single_page'] = single_page
+        if stream:
+            url_kwargs['stream'] = stream
 
         if page_scopes == ('week',):
             url_kwargs['scope'] = datetime.now().strftime("%G-ww%V")
@@ -175,9 +209,19 @@ def _register_endpoints(app):
             url_kwargs['domain'],
             page_scopes,
             single_page,
+            stream,
+        )
+
+    @notes_v2_bp.route("/notes/search")
+    def do_render_note_search():
+        return report.render_search_results(
+            db_session,
+            request.args.get('q', ''),
+            request.args.get('page', 1, type=int),
         )
 
     @notes_v2_bp.route("/domains")
+    @conditional_get()
     def do_render_domains():
         limit = request.args.get('limit')
         sql_ilike_filter = request.args.get('filter')
@@ -187,7 +231,7 @@ def _register_endpoints(app):
                 query = query.limit(limit)
             if sql_ilike_filter:
                 full_sql_filter = f"%{sql_ilike_filter}%"
-                query = query.filter(NoteDomain.domain_id.ilike(full_sql_filter))
+                query = query.filter(DomainStats.domain_id.ilike(full_sql_filter))
 
             return query
 
@@ -197,15 +241,14 @@ def _register_endpoints(app):
     def do_render_recent_domains():
         def nd_limiter(query, cutoff_days: int = 90):
             early_cutoff = datetime.now() - timedelta(days=cutoff_days)
-            early_cutoff_ts = TimeScopeBuilder.day_scope_from_dt(early_cutoff)
 
-            # TODO: Modify the query so `func.count(Note.note_id)` goes past the cutoff.
-            #       For now, it only reports the number of notes in the last 90 days.
-            return query.where(Note.time_scope_id >= early_cutoff_ts)
+            # NB The note counts cover all time, not just the notes past the cutoff.
+            return query.where(DomainStats.latest_scope_ordinal >= early_cutoff.toordinal())
 
         return notes_v2.report.domains.render_stats(db_session, nd_limiter, max_notes_cutoff=0)
 
     @notes_v2_bp.route("/domains/calendar")
+    @conditional_get(vary_by_date=True)
     def do_render_domain_calendar():
         """
         The difference between domains and filters is that a `filter` will lump together all matching notes.
@@ -220,6 +263,7 @@ def _register_endpoints(app):
         return notes_v2.report.counts.render_calendar(db_session, page_domains, page_domain_filters)
 
     @notes_v2_bp.route("/domains/calendar/<string:sql_ilike_filter>")
+    @conditional_get(vary_by_date=True)
     def do_render_one_domain_calendar(sql_ilike_filter: str):
         page_domain_filter = str(escape(sql_ilike_filter))
         if not page_domain_filter:
@@ -228,6 +272,7 @@ def _register_endpoints(app):
         return notes_v2.report.counts.render_one_calendar(db_session, page_domain_filter)
 
     @notes_v2_bp.route("/svg.day/<day_scope>")
+    @conditional_get(lambda day_scope: [day_scope])
     def do_render_svg_day(day_scope):
         return report.standalone_render_day_svg(
             db_session,
@@ -237,6 +282,7 @@ def _register_endpoints(app):
         )
 
     @notes_v2_bp.route("/svg.week/<week_scope>")
+    @conditional_get(lambda week_scope: [week_scope])
     def do_render_svg_week(week_scope):
         return report.standalone_render_week_svg(
             db_session,
@@ -245,6 +291,15 @@ def _register_endpoints(app):
             strtobool(request.args.get('disable_caching')),
         )
 
+    @notes_v2_bp.route("/svg.sprite")
+    @conditional_get(lambda: request.args.getlist('scope'))
+    def do_render_svg_sprite():
+        return report.standalone_render_svg_sprite(
+            db_session,
+            tuple(request.args.getlist('domain')),
+            tuple(escape(arg) for arg in request.args.getlist('scope')),
+        )
+
     app.register_blueprint(notes_v2_bp, url_prefix='')
 
 
@@ -270,19 +325,37 @@ def _register_rest_endpoints(app):
         return n.as_json(True)
 
     @notes_v2_rest_bp.route("/notes")
+    @conditional_get(lambda: request.args.getlist('scope'))
     def do_get_notes():
         page_scopes = [escape(arg) for arg in request.args.getlist('scope')]
         page_domains = [escape(arg) for arg in request.args.getlist('domain')]
         return report.notes_json_tree(db_session, page_domains, page_scopes)
 
+    @notes_v2_rest_bp.route("/notes/search")
+    def do_get_note_search():
+        results = report.search.search(
+            db_session,
+            request.args.get('q', ''),
+            request.args.get('page', 1, type=int),
+        )
+        return results.as_json()
+
     @notes_v2_rest_bp.route("/domains")
+    @conditional_get()
     def do_get_note_domains():
         return notes_v2.report.domains.stats(db_session)
 
     @notes_v2_rest_bp.route("/domains/calendar")
+    @conditional_get()
     def do_get_note_domains_calendar():
         page_scopes = tuple(escape(arg) for arg in request.args.getlist('scope') or [])
         page_domain_filters = tuple(escape(arg) for arg in request.args.getlist('filter') or [])
         return notes_v2.report.counts.calendar(db_session, page_scopes, page_domain_filters)
 
+    # Cache internals stay private unless asked for
+    if app.debug or app.config.get('RENDER_CACHE_DEBUG_ENDPOINT'):
+        @notes_v2_rest_bp.route("/debug/render-cache")
+        def do_get_render_cache_stats():
+            return report.render_utils.get_render_cache().stats()
+
     app.register_blueprint(notes_v2_rest_bp, url_prefix='/v2')
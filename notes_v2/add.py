@@ -4,12 +4,16 @@ import logging
 import sys
 from dataclasses import dataclass
 from os import path
-from typing import Dict, Optional, Set
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 from dateutil import parser
+from sqlalchemy import and_, case, delete, func, insert, select, true, tuple_, update
 from sqlalchemy.exc import IntegrityError, PendingRollbackError
+from sqlalchemy.orm import selectinload
 
-from notes_v2.models import Note, NoteDomain
+from notes_v2.models import Domain, DomainScopeCounts, DomainStats, Note, NoteDomain, domain_rarity_bucket, \
+    note_content_hash, scope_ordinals
+from util import TimeScope
 
 _valid_csv_fields = [
     'created_at',
@@ -65,12 +69,17 @@ def _special_tokenize(
     return set(d for d in split_domain_ids if d)
 
 
-def _add_domains(session, note_id, encoded_domain_ids: str, expect_duplicates: bool = False):
+def _add_domains(session, note_id, encoded_domain_ids: str, expect_duplicates: bool = False) -> Set[str]:
+    """
+    Link the note to its domains, returning only the domain_ids that weren't linked already
+    """
+    added_domain_ids = set()
     for domain_id in _special_tokenize(encoded_domain_ids):
         if expect_duplicates:
             nd_exists = session.query(
                 NoteDomain.query
-                .filter_by(note_id=note_id, domain_id=domain_id)
+                .join(NoteDomain.domain)
+                .filter(NoteDomain.note_id == note_id, Domain.domain_id == domain_id)
                 .exists()
             ).scalar()
             if nd_exists:
@@ -78,13 +87,209 @@ def _add_domains(session, note_id, encoded_domain_ids: str, expect_duplicates: b
 
         new_nd = NoteDomain(note_id=note_id, domain_id=domain_id)
         session.add(new_nd)
+        added_domain_ids.add(domain_id)
 
+    return added_domain_ids
 
-def one_from_csv(
+
+def _chunked(values: Iterable, chunk_size: int) -> Iterable[List]:
+    """
+    Chunk IN clauses, so we stay under SQLite's bound-parameter limits
+    """
+    values = sorted(set(values))
+    for chunk_start in range(0, len(values), chunk_size):
+        yield values[chunk_start:chunk_start + chunk_size]
+
+
+def _write_changed_rows(session, model, new_rows: List[Dict], existing_rows_filter, chunk_size: int = 500) -> None:
+    """
+    Make the `model` rows matching `existing_rows_filter` equal to `new_rows`, writing only the rows that differ
+
+    Unchanged rows are left alone, so re-deriving a table doesn't fire its generation triggers.
+    """
+    key_columns = list(model.__table__.primary_key.columns)
+
+    def key_of(row) -> Tuple:
+        return tuple(row[c.name] for c in key_columns)
+
+    existing_rows = {
+        key_of(row): row
+        for row in session.execute(select(model.__table__).where(existing_rows_filter)).mappings()
+    }
+    new_rows_by_key = {key_of(row): row for row in new_rows}
+
+    stale_keys = [key for key in existing_rows if key not in new_rows_by_key]
+    for chunk in _chunked(stale_keys, chunk_size):
+        session.execute(delete(model).where(tuple_(*key_columns).in_(chunk)))
+
+    added_rows = [row for key, row in new_rows_by_key.items() if key not in existing_rows]
+    if added_rows:
+        session.execute(insert(model), added_rows)
+
+    changed_rows = [
+        row for key, row in new_rows_by_key.items()
+        if key in existing_rows and any(existing_rows[key][name] != value for name, value in row.items())
+    ]
+    if changed_rows:
+        session.execute(update(model), changed_rows)
+
+
+def refresh_domain_stats(
         session,
-        csv_entry: Dict,
-        expect_duplicates: bool,
-) -> Optional[Note]:
+        domain_ids: Iterable[str] | None = None,
+        chunk_size: int = 500,
+) -> None:
+    """
+    Recompute `DomainStats` rows for the given domains, or for every domain if `None`
+
+    Domains that no longer have any notes get their rows deleted.
+    """
+    # Sessions are created with autoflush=False, so push any pending NoteDomains first
+    session.flush()
+
+    is_quarter = Note.scope_type == TimeScope.Type.quarter.value
+    non_quarter_scope_id = case((is_quarter, None), else_=Note.time_scope_id)
+    non_quarter_ordinal = case((is_quarter, None), else_=Note.scope_start_ordinal)
+
+    stats_query = (
+        select(
+            Domain.domain_id,
+            func.count(Note.note_id),
+            func.coalesce(func.min(non_quarter_scope_id), func.min(Note.time_scope_id)),
+            func.coalesce(func.max(non_quarter_scope_id), func.max(Note.time_scope_id)),
+            func.max(Note.sort_time),
+            func.coalesce(func.min(non_quarter_ordinal), func.min(Note.scope_start_ordinal)),
+            func.coalesce(func.max(non_quarter_ordinal), func.max(Note.scope_start_ordinal)),
+        )
+        .select_from(NoteDomain)
+        .join(Note, NoteDomain.note_id == Note.note_id)
+        .join(Domain, NoteDomain.domain_int == Domain.domain_int)
+        .group_by(Domain.domain_id)
+    )
+
+    def replace_rows(query, existing_rows_filter) -> None:
+        new_rows = [
+            {
+                'domain_id': row[0],
+                'note_count': row[1],
+                'rarity_bucket': domain_rarity_bucket(row[1]),
+                'earliest_time_scope_id': row[2],
+                'latest_time_scope_id': row[3],
+                'latest_sort_time': row[4],
+                'earliest_scope_ordinal': row[5],
+                'latest_scope_ordinal': row[6],
+            }
+            for row in session.execute(query).all()
+        ]
+
+        _write_changed_rows(session, DomainStats, new_rows, existing_rows_filter, chunk_size)
+
+    if domain_ids is None:
+        replace_rows(stats_query, true())
+        return
+
+    for chunk in _chunked(domain_ids, chunk_size):
+        replace_rows(
+            stats_query.where(Domain.domain_id.in_(chunk)),
+            DomainStats.domain_id.in_(chunk),
+        )
+
+
+def refresh_domain_scope_counts(
+        session,
+        touched_domains: Dict[str, Set[int | None]] | None = None,
+        chunk_size: int = 500,
+) -> None:
+    """
+    Recompute `DomainScopeCounts` rows, or the entire table if `touched_domains` is `None`
+
+    `touched_domains` maps domain_ids to the `scope_start_ordinal`s of notes that were
+    added to them. Only rows between the lowest and highest touched ordinals get
+    recomputed, so a normal import only rewrites a handful of rows per domain.
+    """
+    session.flush()
+
+    counts_query = (
+        select(
+            Domain.domain_id,
+            Note.time_scope_id,
+            Note.scope_type,
+            Note.scope_start_ordinal,
+            func.count(Note.note_id),
+        )
+        .select_from(NoteDomain)
+        .join(Note, NoteDomain.note_id == Note.note_id)
+        .join(Domain, NoteDomain.domain_int == Domain.domain_int)
+        .group_by(Domain.domain_id, Note.time_scope_id)
+    )
+
+    def replace_rows(query, existing_rows_filter) -> None:
+        new_rows = [
+            {
+                'domain_id': row[0],
+                'time_scope_id': row[1],
+                'scope_type': row[2],
+                'scope_start_ordinal': row[3],
+                'note_count': row[4],
+            }
+            for row in session.execute(query).all()
+        ]
+
+        _write_changed_rows(session, DomainScopeCounts, new_rows, existing_rows_filter, chunk_size)
+
+    if touched_domains is None:
+        replace_rows(counts_query, true())
+        return
+
+    for chunk in _chunked(touched_domains.keys(), chunk_size):
+        chunk_query = counts_query.where(Domain.domain_id.in_(chunk))
+        chunk_filter = DomainScopeCounts.domain_id.in_(chunk)
+
+        touched_ordinals = set().union(*(touched_domains[d] for d in chunk))
+        # Notes with unparseable time scopes don't have ordinals, so just redo the whole domain
+        if None not in touched_ordinals:
+            chunk_query = chunk_query.where(
+                Note.scope_start_ordinal.between(min(touched_ordinals), max(touched_ordinals)))
+            chunk_filter = and_(chunk_filter, DomainScopeCounts.scope_start_ordinal.between(
+                min(touched_ordinals), max(touched_ordinals)))
+
+        replace_rows(chunk_query, chunk_filter)
+
+
+def backfill_derived_tables(session) -> None:
+    """
+    Populate `DomainStats` and `DomainScopeCounts` for databases created before those tables existed
+    """
+    domains_exist = session.execute(select(NoteDomain.note_id).limit(1)).first()
+    if not domains_exist:
+        return
+
+    for derived_table, refresh_fn in [
+        (DomainStats, refresh_domain_stats),
+        (DomainScopeCounts, refresh_domain_scope_counts),
+    ]:
+        if session.execute(select(derived_table.domain_id).limit(1)).first():
+            continue
+
+        logger.info(f"Backfilling {derived_table.__tablename__} table, this may take a moment")
+        refresh_fn(session)
+        session.commit()
+
+
+@dataclass
+class ImportResult:
+    ignored_todo: int = 0
+    import_failed_parser_error: int = 0
+    import_failed_integrity_error: int = 0
+    import_succeeded: int = 0
+
+
+def _normalize_csv_entry(csv_entry: Dict) -> Tuple[Dict, str | None] | None:
+    """
+    Drop unknown and empty fields, and split off the encoded `domains` field
+
+    Returns `None` for rows that are entirely empty.
+    """
     # Filter CSV file to only have valid columns
     present_fields = [field for field in _valid_csv_fields if field in csv_entry.keys()]
     csv_entry = {field: csv_entry[field] for field in present_fields if csv_entry[field]}
@@ -105,49 +310,246 @@ def one_from_csv(
         encoded_domain_ids = csv_entry['domains']
         del csv_entry['domains']
 
+    return csv_entry, encoded_domain_ids
+
+
+def one_from_csv(
+        session,
+        csv_entry: Dict,
+        expect_duplicates: bool,
+        touched_domains: Dict[str, Set[int | None]] | None = None,
+) -> Optional[Note]:
+    """
+    Import one CSV row
+
+    If provided, `touched_domains` is updated with the domains and `scope_start_ordinal`s
+    that this row added, so the caller can refresh the derived tables afterwards.
+    """
+    normalized_entry = _normalize_csv_entry(csv_entry)
+    if normalized_entry is None:
+        return None
+
+    csv_entry, encoded_domain_ids = normalized_entry
+
+    missing_fields = [field for field in ['time_scope_id', 'desc'] if field not in csv_entry]
+    if missing_fields:
+        logger.warning(csv_entry)
+        raise KeyError(missing_fields[0])
+
     # Finally, upsert the new note.
     # NB Now that we have `import_source` tracking, it's probably okay to skip the checking.
-    target_note = None
+    target_note = Note.from_dict(csv_entry)
+    existing_note = None
     if expect_duplicates:
-        try:
-            inexact_match_exists = session.query(
-                Note.query.filter_by(time_scope_id=csv_entry['time_scope_id'],
-                                     desc=csv_entry['desc'])
-                .exists()
-            ).scalar()
+        hash_matches = Note.query.filter_by(content_hash=target_note.compute_content_hash()).limit(2).all()
+        if len(hash_matches) > 1:
+            return None
+        elif len(hash_matches) == 1:
+            existing_note = target_note = hash_matches[0]
+
+    # If we're creating a new Note, flush it to SQLAlchemy ORM
+    # so we can add matching NoteDomains.
+    if existing_note is None:
+        session.add(target_note)
+        session.flush()
 
-        except KeyError:
-            logger.warning(csv_entry)
-            raise
+    if encoded_domain_ids:
+        # Brand-new notes can't have any domains yet
+        added_domain_ids = _add_domains(session, target_note.note_id, encoded_domain_ids,
+                                        expect_duplicates=existing_note is not None)
+        if touched_domains is not None:
+            for domain_id in added_domain_ids:
+                touched_domains.setdefault(domain_id, set()).add(target_note.scope_start_ordinal)
+
+    return target_note
+
+
+def _count_failed_row(result: ImportResult, csv_entry: Dict, reason) -> None:
+    if (
+            "domains" in csv_entry
+            and "todo" in (csv_entry.get("domains") or "")
+    ):
+        result.ignored_todo += 1
+        return
+
+    logger.warning('\n'.join([
+        f"Couldn't import CSV row, {reason}: ",
+        json.dumps(csv_entry, indent=2, ensure_ascii=False),
+        '',
+    ]))
+
+    result.import_failed_integrity_error += 1
+
+
+def _bulk_from_csv(
+        session,
+        reader: Iterable[Dict],
+        expect_duplicates: bool,
+        result: ImportResult,
+        touched_domains: Dict[str, Set[int | None]],
+        print_details: bool = False,
+        import_source: str = "",
+        batch_size: int = 5_000,
+        chunk_size: int = 500,
+) -> None:
+    """
+    Import every CSV row with a handful of batched INSERTs, rather than a few queries per row
+
+    Existing notes get looked up by `Note.content_hash` up front, a chunk at a time,
+    then matched in memory, the same way `one_from_csv()` matches them with queries.
+    Nothing is flushed until every row has been checked, so this all happens in one transaction.
+    """
+    # Parse everything first, so we know which content hashes to look up
+    parsed_rows = []
+    for entry_index, csv_entry in enumerate(reader):
+        normalized_entry = _normalize_csv_entry(csv_entry)
+        if normalized_entry is None:
+            result.import_succeeded += 1
+            continue
 
-        if inexact_match_exists:
-            matchmaker_dict = dict(csv_entry)
+        parsed_entry, encoded_domain_ids = normalized_entry
+        try:
             for field in ['sort_time', 'created_at']:
-                # db search needs datetime objects, not the CSV string
-                if field in matchmaker_dict:
-                    matchmaker_dict[field] = parser.parse(matchmaker_dict[field])
+                if field in parsed_entry:
+                    parsed_entry[field] = parser.parse(parsed_entry[field])
+
+        except parser.ParserError as e:
+            if print_details:
+                logger.warning(e)
+
+            result.import_failed_parser_error += 1
+            continue
 
-            thorough_match = Note.query.filter_by(**matchmaker_dict).all()
+        # `one_from_csv()` fails these with a KeyError
+        missing_fields = [field for field in ['time_scope_id', 'desc'] if field not in parsed_entry]
+        if missing_fields:
+            _count_failed_row(result, csv_entry, f"missing {', '.join(missing_fields)}")
+            continue
 
-            if len(thorough_match) > 1:
-                return None
-            elif len(thorough_match) == 1:
-                target_note = thorough_match[0]
+        content_hash = note_content_hash(
+            parsed_entry['time_scope_id'],
+            parsed_entry.get('sort_time'),
+            parsed_entry.get('metadata'),
+            parsed_entry['desc'],
+            parsed_entry.get('detailed_desc'),
+            parsed_entry.get('created_at'),
+        )
+        parsed_rows.append((csv_entry, parsed_entry, encoded_domain_ids, content_hash))
+
+        if (entry_index + 1) % 10_000 == 0:
+            logger.debug(f"{import_source} => parsed {entry_index + 1:7_} CSV rows so far")
+
+    # Notes are tracked as dicts with their `note_id` (`None` until inserted), `domain_ids` for
+    # the domains they're already linked to, and for new notes, the `row` to insert.
+    notes_by_hash: Dict[str, Dict] = {}
+    # Hashes shared by several notes, which `one_from_csv()` won't pick between
+    ambiguous_hashes: Set[str] = set()
+    for chunk in _chunked({content_hash for _, _, _, content_hash in parsed_rows}, chunk_size):
+        for note_id, content_hash, scope_start_ordinal in session.execute(
+                select(Note.note_id, Note.content_hash, Note.scope_start_ordinal)
+                .where(Note.content_hash.in_(chunk))
+        ):
+            if content_hash in notes_by_hash:
+                ambiguous_hashes.add(content_hash)
+
+            notes_by_hash[content_hash] = {
+                'note_id': note_id,
+                'scope_start_ordinal': scope_start_ordinal,
+                'domain_ids': set(),
+            }
 
-    if not target_note:
-        target_note = Note.from_dict(csv_entry)
+        if expect_duplicates:
+            for content_hash, domain_id in session.execute(
+                    select(Note.content_hash, Domain.domain_id)
+                    .select_from(NoteDomain)
+                    .join(Note, NoteDomain.note_id == Note.note_id)
+                    .join(Domain, NoteDomain.domain_int == Domain.domain_int)
+                    .where(Note.content_hash.in_(chunk))
+            ):
+                notes_by_hash[content_hash]['domain_ids'].add(domain_id)
 
-        # If we're creating a new Note, flush it to SQLAlchemy ORM
-        # so we can add matching NoteDomains.
-        if target_note:
-            session.add(target_note)
-            session.flush()
+    new_notes: List[Dict] = []
+    new_links: List[Tuple[Dict, str]] = []
 
-    if encoded_domain_ids:
-        _add_domains(session, target_note.note_id, encoded_domain_ids,
-                     expect_duplicates=expect_duplicates if target_note else False)
+    for csv_entry, parsed_entry, encoded_domain_ids, content_hash in parsed_rows:
+        target_note = None
+        if expect_duplicates:
+            if content_hash in ambiguous_hashes:
+                result.import_succeeded += 1
+                continue
 
-    return target_note
+            target_note = notes_by_hash.get(content_hash)
+
+        # Same check as the partial unique index on `Note.content_hash`
+        elif content_hash in notes_by_hash and all(
+                parsed_entry.get(field) is not None
+                for field in ['sort_time', 'metadata', 'detailed_desc', 'created_at']
+        ):
+            _count_failed_row(result, csv_entry, "duplicate of an existing note")
+            continue
+
+        if target_note is None:
+            scope_type, scope_start_ordinal, scope_end_ordinal = scope_ordinals(parsed_entry['time_scope_id'])
+            target_note = {
+                'note_id': None,
+                'row': {
+                    'time_scope_id': parsed_entry['time_scope_id'],
+                    'sort_time': parsed_entry.get('sort_time'),
+                    'note_metadata': parsed_entry.get('metadata'),
+                    'desc': parsed_entry['desc'],
+                    'detailed_desc': parsed_entry.get('detailed_desc'),
+                    'created_at': parsed_entry.get('created_at'),
+                    'scope_type': scope_type,
+                    'scope_start_ordinal': scope_start_ordinal,
+                    'scope_end_ordinal': scope_end_ordinal,
+                    'content_hash': content_hash,
+                },
+                'scope_start_ordinal': scope_start_ordinal,
+                'domain_ids': set(),
+            }
+            new_notes.append(target_note)
+            notes_by_hash[content_hash] = target_note
+
+        if encoded_domain_ids:
+            for domain_id in _special_tokenize(encoded_domain_ids):
+                if domain_id not in target_note['domain_ids']:
+                    target_note['domain_ids'].add(domain_id)
+                    new_links.append((target_note, domain_id))
+                    touched_domains.setdefault(domain_id, set()).add(target_note['scope_start_ordinal'])
+
+        result.import_succeeded += 1
+
+    for batch_start in range(0, len(new_notes), batch_size):
+        batch = new_notes[batch_start:batch_start + batch_size]
+        note_ids = session.scalars(
+            insert(Note).returning(Note.note_id, sort_by_parameter_order=True),
+            [note['row'] for note in batch],
+        ).all()
+        for note, note_id in zip(batch, note_ids):
+            note['note_id'] = note_id
+
+        logger.debug(f"{import_source} => inserted {batch_start + len(batch):7_} new notes so far")
+
+    # Intern any new domains, then link them up
+    domain_ints: Dict[str, int] = {}
+    for chunk in _chunked({domain_id for _, domain_id in new_links}, chunk_size):
+        session.execute(
+            insert(Domain).prefix_with('OR IGNORE'),
+            [{'domain_id': domain_id} for domain_id in chunk],
+        )
+        domain_ints.update(session.execute(
+            select(Domain.domain_id, Domain.domain_int)
+            .where(Domain.domain_id.in_(chunk))
+        ).all())
+
+    for batch_start in range(0, len(new_links), batch_size):
+        session.execute(
+            insert(NoteDomain),
+            [
+                {'note_id': note['note_id'], 'domain_int': domain_ints[domain_id]}
+                for note, domain_id in new_links[batch_start:batch_start + batch_size]
+            ],
+        )
 
 
 def all_from_csv(
@@ -155,79 +557,86 @@ def all_from_csv(
         csv_file,
         expect_duplicates: bool,
         print_details: bool = False,
-):
-    @dataclass
-    class ImportResult:
-        ignored_todo: int = 0
-        import_failed_parser_error: int = 0
-        import_failed_integrity_error: int = 0
-        import_succeeded: int = 0
+        bulk: bool = False,
+) -> ImportResult:
+    """
+    Import every row of a CSV file, see `one_from_csv()`
 
+    With `bulk`, rows get matched in memory and inserted in batches, see `_bulk_from_csv()`.
+    """
     result = ImportResult()
 
     import_source = ""
     if hasattr(csv_file, 'name'):
         import_source = csv_file.name
 
+    touched_domains: Dict[str, Set[int | None]] = {}
+
     reader = csv.DictReader(csv_file)
-    for entry_index, csv_entry in enumerate(reader):
+    if bulk:
         try:
-            one_from_csv(session, csv_entry, expect_duplicates)
-            result.import_succeeded += 1
+            _bulk_from_csv(session, reader, expect_duplicates, result, touched_domains,
+                           print_details=print_details, import_source=import_source)
+        except IntegrityError:
+            session.rollback()
+            raise
+    else:
+        for entry_index, csv_entry in enumerate(reader):
+            try:
+                one_from_csv(session, csv_entry, expect_duplicates, touched_domains)
+                result.import_succeeded += 1
 
-            if (entry_index + 1) % 1000 == 0:
-                logger.debug(f"{import_source} => reviewed {entry_index + 1:7_} CSV rows so far")
+                if (entry_index + 1) % 1000 == 0:
+                    logger.debug(f"{import_source} => reviewed {entry_index + 1:7_} CSV rows so far")
 
-        except parser.ParserError as e:
-            if print_details:
-                logger.warning(e)
+            except parser.ParserError as e:
+                if print_details:
+                    logger.warning(e)
 
-            result.import_failed_parser_error += 1
-            continue
+                result.import_failed_parser_error += 1
+                continue
 
-        # TODO: Handle this properly, don't just do whatever the error message says.
-        #       This happened from having duplicate/identical entries right before?
-        except PendingRollbackError:
-            logger.warning(csv_entry)
-            session.rollback()
+            # TODO: Handle this properly, don't just do whatever the error message says.
+            #       This happened from having duplicate/identical entries right before?
+            except PendingRollbackError:
+                logger.warning(csv_entry)
+                session.rollback()
 
-            # Instead of re-raising the exception, end import and expect user to re-run
-            return
+                # Instead of re-raising the exception, end import and expect user to re-run
+                return result
 
-        except (KeyError, IntegrityError) as e:
-            if (
-                    "domains" in csv_entry
-                    and "todo" in csv_entry.get("domains")
-            ):
-                result.ignored_todo += 1
+            except (KeyError, IntegrityError) as e:
+                _count_failed_row(result, csv_entry, e)
                 continue
 
-            logger.warning('\n'.join([
-                f"Couldn't import CSV row, {e}: ",
-                json.dumps(csv_entry, indent=2, ensure_ascii=False),
-                '',
-            ]))
-
-            result.import_failed_integrity_error += 1
-            continue
-
     if result.ignored_todo > 0:
         logger.warning(f"{import_source}: Ignored {result.ignored_todo} malformed CSV rows with domain \"todo\"")
 
     if result.import_failed_parser_error > 0:
         logger.warning(f"{import_source}: Failed to import {result.import_failed_parser_error} rows due to parsing error, check file contents")
 
+    refresh_domain_stats(session, touched_domains.keys())
+    refresh_domain_scope_counts(session, touched_domains)
     session.commit()
     logger.info(f"Imported {result.import_succeeded} notes from {import_source}")
 
     if print_details:
         logger.info(result)
 
+    return result
+
 
 def all_to_csv(
         outfile=sys.stdout,
         write_note_id: bool=False,
+        chunk_size: int = 1_000,
 ):
+    """
+    Write every note out as CSV, in `note_id` order
+
+    Notes are read `chunk_size` at a time, with their domains loaded in one extra query
+    per chunk, so memory use doesn't grow with the size of the database.
+    """
     def one_to_csv(n: Note) -> Dict:
         note_as_json = n.as_json(include_domains=True)
         if not write_note_id:
@@ -249,7 +658,16 @@ def all_to_csv(
     writer = csv.DictWriter(outfile, fieldnames=fieldnames, lineterminator='\n')
     writer.writeheader()
 
-    # TODO: Can't `map(csv.DictWriter.writerow)`, why?
-    for n_csv in map(one_to_csv, Note.query.all()):
-        writer.writerow(n_csv)
+    last_note_id = None
+    while True:
+        notes_query = Note.query.options(selectinload(Note.domains))
+        if last_note_id is not None:
+            notes_query = notes_query.filter(Note.note_id > last_note_id)
+
+        notes_chunk = notes_query.order_by(Note.note_id).limit(chunk_size).all()
+        if not notes_chunk:
+            break
+
+        writer.writerows(map(one_to_csv, notes_chunk))
+        last_note_id = notes_chunk[-1].note_id
 
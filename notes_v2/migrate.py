@@ -0,0 +1,311 @@
+"""
+In-place schema migrations for notes-v2.db
+
+`Base.metadata.create_all()` only creates tables that don't exist yet, so
+anything that adds columns or indexes to an existing table lives here.
+Every migration checks whether it's needed first, so it's safe to run
+these on every startup.
+"""
+import logging
+from typing import Set
+
+from sqlalchemy import MetaData, bindparam, inspect, select, text, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateTable
+
+from notes_v2.models import DataGeneration, Domain, DomainStats, GLOBAL_GENERATION_KEY, NOTE_SEARCH_TABLE, Note, \
+    RARITY_GENERATION_KEY, \
+    NoteDomain, note_content_hash, scope_ordinals
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def _column_names(conn, table_name: str) -> Set[str]:
+    return {column['name'] for column in inspect(conn).get_columns(table_name)}
+
+
+def add_scope_ordinals(engine: Engine) -> None:
+    """
+    Add and backfill the numeric `scope_*` columns on Notes-v2
+    """
+    with engine.begin() as conn:
+        if 'scope_start_ordinal' in _column_names(conn, Note.__tablename__):
+            return
+
+        logger.info(f"Adding numeric time scope columns to {Note.__tablename__}")
+        for column_name in ['scope_type', 'scope_start_ordinal', 'scope_end_ordinal']:
+            conn.execute(text(f'ALTER TABLE "{Note.__tablename__}" ADD COLUMN {column_name} INTEGER'))
+
+        scope_ids = conn.execute(text(f'SELECT DISTINCT time_scope_id FROM "{Note.__tablename__}"')).scalars().all()
+        if scope_ids:
+            conn.execute(
+                text(f'UPDATE "{Note.__tablename__}" '
+                     'SET scope_type = :scope_type, '
+                     '    scope_start_ordinal = :scope_start_ordinal, '
+                     '    scope_end_ordinal = :scope_end_ordinal '
+                     'WHERE time_scope_id = :time_scope_id'),
+                [
+                    dict(zip(['scope_type', 'scope_start_ordinal', 'scope_end_ordinal'], scope_ordinals(scope_id)),
+                         time_scope_id=scope_id)
+                    for scope_id in scope_ids
+                ],
+            )
+
+        for index in Note.__table__.indexes:
+            if index.name.startswith('notes-scope-'):
+                index.create(conn, checkfirst=True)
+
+        logger.info(f"Backfilled numeric time scopes for {len(scope_ids)} distinct time_scope_ids")
+
+
+def intern_note_domains(engine: Engine) -> None:
+    """
+    Rewrite NoteDomains-v2 from (note_id, domain_id string) rows into (note_id, domain_int)
+
+    SQLite can't change a table's primary key in-place, so the old table gets
+    renamed, copied into the new schema, and dropped.
+    """
+    old_table_name = f'{NoteDomain.__tablename__}-old'
+
+    with engine.begin() as conn:
+        if 'domain_int' in _column_names(conn, NoteDomain.__tablename__):
+            return
+
+        logger.info(f"Moving {NoteDomain.__tablename__} domain strings into {Domain.__tablename__}")
+        conn.execute(text(f'ALTER TABLE "{NoteDomain.__tablename__}" RENAME TO "{old_table_name}"'))
+
+        # Indexes follow the renamed table, so drop them to free up their names
+        old_index_names = conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table_name AND sql IS NOT NULL"),
+            {'table_name': old_table_name},
+        ).scalars().all()
+        for index_name in old_index_names:
+            conn.execute(text(f'DROP INDEX "{index_name}"'))
+
+        NoteDomain.__table__.create(conn)
+
+        conn.execute(text(
+            f'INSERT OR IGNORE INTO "{Domain.__tablename__}" (domain_id) '
+            f'SELECT DISTINCT domain_id FROM "{old_table_name}" ORDER BY domain_id'
+        ))
+        conn.execute(text(
+            f'INSERT OR IGNORE INTO "{NoteDomain.__tablename__}" (note_id, domain_int) '
+            f'SELECT old.note_id, d.domain_int FROM "{old_table_name}" AS old '
+            f'JOIN "{Domain.__tablename__}" AS d ON d.domain_id = old.domain_id'
+        ))
+        conn.execute(text(f'DROP TABLE "{old_table_name}"'))
+
+
+def add_note_content_hashes(engine: Engine) -> None:
+    """
+    Rebuild Notes-v2 with a `content_hash` column, in place of the unique constraint across every note field
+
+    SQLite can't drop a table constraint, so the new table gets built under a temporary name,
+    filled in, and renamed over the old one. `note_id`s are kept, so NoteDomains-v2 and the
+    FTS index stay valid; this relies on foreign key enforcement being off, which is SQLite's default.
+
+    Every trigger gets dropped first, since triggers that reference a missing table break the
+    rename. `create_note_search_index()` and `create_generation_triggers()` recreate them afterwards.
+    """
+    new_table_name = f'{Note.__tablename__}-new'
+
+    with engine.begin() as conn:
+        existing_columns = _column_names(conn, Note.__tablename__)
+        if 'content_hash' in existing_columns:
+            return
+
+        logger.info(f"Rebuilding {Note.__tablename__} with content hashes, this may take a moment")
+        new_table = Note.__table__.to_metadata(MetaData(), name=new_table_name)
+        conn.execute(CreateTable(new_table))
+
+        copied_columns = ', '.join(
+            f'"{column.name}"' for column in new_table.columns if column.name in existing_columns)
+        conn.execute(text(
+            f'INSERT INTO "{new_table_name}" ({copied_columns}) '
+            f'SELECT {copied_columns} FROM "{Note.__tablename__}"'
+        ))
+
+        new_hashes = []
+        for note_id, *hashed_fields in conn.execute(
+                select(
+                    new_table.c.note_id,
+                    new_table.c.time_scope_id,
+                    new_table.c.sort_time,
+                    new_table.c['metadata'],
+                    new_table.c['desc'],
+                    new_table.c.detailed_desc,
+                    new_table.c.created_at,
+                )
+                .order_by(new_table.c.note_id)
+        ):
+            new_hashes.append({'b_note_id': note_id, 'b_content_hash': note_content_hash(*hashed_fields)})
+
+        if new_hashes:
+            conn.execute(
+                update(new_table)
+                .where(new_table.c.note_id == bindparam('b_note_id'))
+                .values(content_hash=bindparam('b_content_hash')),
+                new_hashes,
+            )
+
+        trigger_names = conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        ).scalars().all()
+        for trigger_name in trigger_names:
+            conn.execute(text(f'DROP TRIGGER "{trigger_name}"'))
+
+        conn.execute(text(f'DROP TABLE "{Note.__tablename__}"'))
+        conn.execute(text(f'ALTER TABLE "{new_table_name}" RENAME TO "{Note.__tablename__}"'))
+        for index in Note.__table__.indexes:
+            index.create(conn)
+
+        logger.info(f"Added content hashes for {len(new_hashes)} notes")
+
+
+def recreate_stale_domain_stats(engine: Engine) -> None:
+    """
+    `DomainStats` is derived data, so rather than migrate it, drop and rebuild it.
+
+    The actual rebuild is done by `notes_v2.add.backfill_derived_tables()`,
+    once it sees the table is empty.
+    """
+    with engine.begin() as conn:
+        existing_columns = _column_names(conn, DomainStats.__tablename__)
+        expected_columns = {column.name for column in DomainStats.__table__.columns}
+        if expected_columns <= existing_columns:
+            return
+
+        logger.info(f"Recreating {DomainStats.__tablename__} with new columns")
+        DomainStats.__table__.drop(conn)
+        DomainStats.__table__.create(conn)
+
+        # Rebuilt rows are plain INSERTs, which don't bump the rarity counter by themselves
+        conn.execute(
+            update(DataGeneration)
+            .where(DataGeneration.generation_key == RARITY_GENERATION_KEY)
+            .values(generation=DataGeneration.generation + 1)
+        )
+
+
+def create_note_search_index(engine: Engine) -> None:
+    """
+    Create the FTS5 index over `Note.desc` and `Note.detailed_desc`, plus triggers to keep it in sync
+
+    This is an external-content table, so the note text isn't stored twice;
+    the triggers mean that every write path (including the CSV import) updates it.
+    """
+    with engine.begin() as conn:
+        index_exists = conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': NOTE_SEARCH_TABLE},
+        ).first()
+
+        conn.execute(text(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS "{NOTE_SEARCH_TABLE}" '
+            f'USING fts5("desc", detailed_desc, content=\'{Note.__tablename__}\', content_rowid=\'note_id\')'
+        ))
+
+        insert_sql = (
+            f'INSERT INTO "{NOTE_SEARCH_TABLE}" (rowid, "desc", detailed_desc) '
+            'VALUES (new.note_id, new."desc", new.detailed_desc);'
+        )
+        delete_sql = (
+            f'INSERT INTO "{NOTE_SEARCH_TABLE}" ("{NOTE_SEARCH_TABLE}", rowid, "desc", detailed_desc) '
+            "VALUES ('delete', old.note_id, old.\"desc\", old.detailed_desc);"
+        )
+        for trigger_suffix, trigger_event, trigger_body in [
+            ('insert', 'AFTER INSERT', insert_sql),
+            ('delete', 'AFTER DELETE', delete_sql),
+            ('update', 'AFTER UPDATE', delete_sql + ' ' + insert_sql),
+        ]:
+            conn.execute(text(
+                f'CREATE TRIGGER IF NOT EXISTS "{NOTE_SEARCH_TABLE}-{trigger_suffix}" '
+                f'{trigger_event} ON "{Note.__tablename__}" '
+                f'BEGIN {trigger_body} END'
+            ))
+
+        if not index_exists:
+            logger.info(f"Building full-text search index {NOTE_SEARCH_TABLE}")
+            conn.execute(text(f'INSERT INTO "{NOTE_SEARCH_TABLE}" ("{NOTE_SEARCH_TABLE}") VALUES (\'rebuild\')'))
+
+
+def create_generation_triggers(engine: Engine) -> None:
+    """
+    Bump `DataGeneration` counters on every write to Notes-v2, NoteDomains-v2, or DomainStats-v2
+
+    Each write bumps the global counter, plus the per-month counter for the note's
+    `scope_start_ordinal` (see `notes_v2.models.month_generation_key()`). The rarity counter
+    only gets bumped when a domain's `DomainStats.rarity_bucket` changes; new and deleted
+    domains don't need it, since they only render in months whose counters already got bumped.
+
+    Counters start at the current time in milliseconds, rather than 0, so a
+    freshly-created database never reuses the data versions of an older one.
+
+    Triggers are dropped and recreated on every startup, so changes to them apply to existing databases.
+    """
+    epoch_millis_sql = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+
+    def bump_sql(generation_key_sql: str) -> str:
+        return (
+            f'INSERT INTO "{DataGeneration.__tablename__}" (generation_key, generation) '
+            f'VALUES ({generation_key_sql}, {epoch_millis_sql}) '
+            'ON CONFLICT (generation_key) DO UPDATE SET generation = generation + 1;'
+        )
+
+    def month_key_sql(ordinal_sql: str) -> str:
+        # Python ordinal 1 (0001-01-01) is Julian day 1721425.5
+        return f"coalesce('month:' || strftime('%Y-%m', ({ordinal_sql}) + 1721424.5), 'month:unknown')"
+
+    def note_ordinal_sql(row_name: str) -> str:
+        return f'(SELECT scope_start_ordinal FROM "{Note.__tablename__}" WHERE note_id = {row_name}.note_id)'
+
+    global_bump_sql = bump_sql(f"'{GLOBAL_GENERATION_KEY}'")
+    rarity_bump_sql = bump_sql(f"'{RARITY_GENERATION_KEY}'")
+    trigger_bodies = {
+        (Note.__tablename__, 'INSERT'): [bump_sql(month_key_sql('new.scope_start_ordinal'))],
+        (Note.__tablename__, 'UPDATE'): [bump_sql(month_key_sql('old.scope_start_ordinal')),
+                                         bump_sql(month_key_sql('new.scope_start_ordinal'))],
+        (Note.__tablename__, 'DELETE'): [bump_sql(month_key_sql('old.scope_start_ordinal'))],
+        (NoteDomain.__tablename__, 'INSERT'): [bump_sql(month_key_sql(note_ordinal_sql('new')))],
+        (NoteDomain.__tablename__, 'UPDATE'): [bump_sql(month_key_sql(note_ordinal_sql('old'))),
+                                               bump_sql(month_key_sql(note_ordinal_sql('new')))],
+        (NoteDomain.__tablename__, 'DELETE'): [bump_sql(month_key_sql(note_ordinal_sql('old')))],
+        (DomainStats.__tablename__, 'INSERT'): [],
+        (DomainStats.__tablename__, 'UPDATE'): [],
+        (DomainStats.__tablename__, 'DELETE'): [],
+    }
+    rarity_trigger_name = f'{DomainStats.__tablename__}-rarity-update'
+
+    with engine.begin() as conn:
+        for generation_key in (GLOBAL_GENERATION_KEY, RARITY_GENERATION_KEY):
+            conn.execute(text(
+                f'INSERT OR IGNORE INTO "{DataGeneration.__tablename__}" (generation_key, generation) '
+                f"VALUES ('{generation_key}', {epoch_millis_sql})"
+            ))
+
+        for (table_name, trigger_event), bumps in trigger_bodies.items():
+            trigger_name = f'{table_name}-generation-{trigger_event.lower()}'
+            conn.execute(text(f'DROP TRIGGER IF EXISTS "{trigger_name}"'))
+            conn.execute(text(
+                f'CREATE TRIGGER "{trigger_name}" '
+                f'AFTER {trigger_event} ON "{table_name}" '
+                f'BEGIN {global_bump_sql} {" ".join(bumps)} END'
+            ))
+
+        conn.execute(text(f'DROP TRIGGER IF EXISTS "{rarity_trigger_name}"'))
+        conn.execute(text(
+            f'CREATE TRIGGER "{rarity_trigger_name}" '
+            f'AFTER UPDATE OF rarity_bucket ON "{DomainStats.__tablename__}" '
+            'WHEN old.rarity_bucket IS NOT new.rarity_bucket '
+            f'BEGIN {rarity_bump_sql} END'
+        ))
+
+
+def migrate_models(engine: Engine) -> None:
+    add_scope_ordinals(engine)
+    intern_note_domains(engine)
+    add_note_content_hashes(engine)
+    recreate_stale_domain_stats(engine)
+    create_note_search_index(engine)
+    create_generation_triggers(engine)
@@ -1,12 +1,24 @@
+import hashlib
+import json
 import operator
-from typing import Dict, List
+from datetime import date, datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
 
 from dateutil import parser
-from sqlalchemy import String, Column, Integer, ForeignKey, UniqueConstraint, DateTime, Index
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import String, Column, Integer, ForeignKey, DateTime, Index, event, select, text
+from sqlalchemy.orm import declarative_base, relationship, validates
+
+from util import TimeScope
 
 Base = declarative_base()
 
+NOTE_SEARCH_TABLE = 'NotesSearch-v2'
+"""
+FTS5 index over `Note.desc` and `Note.detailed_desc`, see `notes_v2.migrate.create_note_search_index()`.
+
+SQLAlchemy doesn't know how to create virtual tables, so this is kept out of `Base.metadata`.
+"""
+
 
 class Note(Base):
     """
@@ -37,16 +49,41 @@ class Note(Base):
     detailed_desc = Column(String)
     created_at = Column(DateTime)
 
+    # Numeric versions of `time_scope_id`, derived automatically, so range queries can use an index.
+    # Ordinals are `date.toordinal()` day numbers; the end ordinal is exclusive.
+    scope_type = Column(Integer)
+    scope_start_ordinal = Column(Integer)
+    scope_end_ordinal = Column(Integer)
+
+    # Hash of the fields that make a note unique, set automatically on insert/update, see `note_content_hash()`.
+    # This replaces a unique constraint across all those fields, which duplicated every `detailed_desc` into an index.
+    content_hash = Column(String(32))
+
     __table_args__ = (
-        UniqueConstraint('time_scope_id', 'sort_time', 'metadata', 'desc', 'detailed_desc', 'created_at'),
-        Index("import-notes-index-1", 'time_scope_id', 'desc'),
-        Index("import-notes-index-2", 'time_scope_id', 'sort_time', 'metadata', 'desc', 'detailed_desc'),
+        Index("notes-content-hash-index", 'content_hash'),
+        # Same rule as the old unique constraint: SQLite treats NULLs as distinct, so notes with NULL fields can repeat
+        Index("notes-content-hash-unique-index", 'content_hash', unique=True,
+              sqlite_where=text('sort_time IS NOT NULL AND metadata IS NOT NULL '
+                                'AND detailed_desc IS NOT NULL AND created_at IS NOT NULL')),
+        Index("notes-scope-range-index", 'scope_start_ordinal', 'scope_end_ordinal'),
+        Index("notes-scope-type-index", 'scope_type', 'scope_start_ordinal'),
     )
 
     domains = relationship('NoteDomain', backref='Note')
 
+    @validates('time_scope_id')
+    def _sync_scope_ordinals(self, key, time_scope_id):
+        self.scope_type, self.scope_start_ordinal, self.scope_end_ordinal = \
+            scope_ordinals(time_scope_id)
+        return time_scope_id
+
+    def compute_content_hash(self) -> str:
+        return note_content_hash(self.time_scope_id, self.sort_time, self.note_metadata,
+                                 self.desc, self.detailed_desc, self.created_at)
+
     def get_domain_ids(self):
-        return map(operator.attrgetter('domain_id'), self.domains)
+        # Sorted, because row order now follows `Domain.domain_int` rather than the domain strings
+        return sorted(map(operator.attrgetter('domain_id'), self.domains))
 
     def as_json(self, include_domains: bool = False) -> Dict:
         """
@@ -99,14 +136,245 @@ class Note(Base):
         return cls(**serialized)
 
 
+@event.listens_for(Note, 'before_insert')
+@event.listens_for(Note, 'before_update')
+def _set_content_hash(mapper, connection, target: Note) -> None:
+    target.content_hash = target.compute_content_hash()
+
+
+def note_content_hash(
+        time_scope_id: str | None,
+        sort_time: datetime | None,
+        note_metadata: str | None,
+        desc: str | None,
+        detailed_desc: str | None,
+        created_at: datetime | None,
+) -> str:
+    """
+    Fixed-width hash of every field that makes a note unique, for `Note.content_hash`
+
+    NULL fields hash like any other value, so a re-imported row matches its note even when
+    the unique index wouldn't have caught it. ORM writes get this set automatically;
+    bulk INSERTs need to set it themselves.
+    """
+    def serialize(value):
+        if isinstance(value, datetime):
+            # SQLite DateTime columns drop the timezone, so hash what actually gets stored
+            return str(value.replace(tzinfo=None))
+        return value
+
+    fields = [time_scope_id, sort_time, note_metadata, desc, detailed_desc, created_at]
+    serialized_fields = json.dumps([serialize(value) for value in fields], ensure_ascii=False)
+    return hashlib.sha256(serialized_fields.encode('utf-8')).hexdigest()[:32]
+
+
+def scope_ordinals(time_scope_id: str | None) -> Tuple[int | None, int | None, int | None]:
+    """
+    Returns (scope_type, scope_start_ordinal, scope_end_ordinal) for the given `time_scope_id`
+
+    Unparseable scopes get NULLs, rather than failing the import.
+    """
+    if not time_scope_id:
+        return None, None, None
+
+    try:
+        scope = TimeScope(time_scope_id)
+        return scope.type.value, scope.start.toordinal(), scope.end.toordinal()
+    except ValueError:
+        return None, None, None
+
+
+class Domain(Base):
+    """
+    Dictionary of every domain string, so `NoteDomain` rows only need to store an integer
+
+    Rows are created on demand by `intern_new_domains()`, and never deleted.
+    """
+    __tablename__ = 'Domains-v2'
+
+    domain_int = Column(Integer, primary_key=True, nullable=False)
+    domain_id = Column(String, nullable=False, unique=True)
+
+
 class NoteDomain(Base):
+    """
+    Links a Note to a Domain
+
+    Still constructed with the domain string, `NoteDomain(note_id=..., domain_id="...")`;
+    the matching `Domain` row gets looked up (or created) when the session flushes.
+    """
     __tablename__ = 'NoteDomains-v2'
 
-    note_id = Column(Integer, ForeignKey('Notes-v2.note_id'), primary_key=True, nullable=False, index=True)
-    domain_id = Column(String, primary_key=True, nullable=False, index=True)
+    note_id = Column(Integer, ForeignKey('Notes-v2.note_id'), primary_key=True, nullable=False)
+    domain_int = Column(Integer, ForeignKey('Domains-v2.domain_int'), primary_key=True, nullable=False)
+
+    domain = relationship('Domain', lazy='joined', innerjoin=True)
 
     __table_args__ = (
-        UniqueConstraint('note_id', 'domain_id'),
-        Index("note-domain-index", 'note_id', 'domain_id'),
-        Index("domain-note-index", 'domain_id', 'note_id'),
+        # The primary key already covers (note_id, domain_int)
+        Index("domain-note-index", 'domain_int', 'note_id'),
     )
+
+    def __init__(self, domain_id: str | None = None, **kwargs):
+        super().__init__(**kwargs)
+        if domain_id is not None:
+            self.domain = Domain(domain_id=domain_id)
+
+    @property
+    def domain_id(self) -> str:
+        return self.domain.domain_id
+
+
+def intern_new_domains(session, flush_context, instances) -> None:
+    """
+    Swap any newly-constructed `Domain`s for the existing row with the same `domain_id`
+
+    Also de-duplicates new `Domain`s within the same flush, so the unique
+    constraint on `Domain.domain_id` holds. Registered as a `before_flush` listener
+    on the notes `sessionmaker` only, see `notes_v2.load_models()`.
+    """
+    new_domains = [obj for obj in session.new if isinstance(obj, Domain)]
+    if not new_domains:
+        return
+
+    with session.no_autoflush:
+        canonical_domains = {
+            d.domain_id: d
+            for d in session.execute(
+                select(Domain).where(Domain.domain_id.in_({d.domain_id for d in new_domains}))
+            ).scalars()
+        }
+
+    for d in new_domains:
+        canonical_domains.setdefault(d.domain_id, d)
+
+    for obj in list(session.new):
+        if isinstance(obj, NoteDomain) and obj.domain is not None:
+            obj.domain = canonical_domains[obj.domain.domain_id]
+
+    for d in new_domains:
+        if canonical_domains[d.domain_id] is not d:
+            session.expunge(d)
+
+
+class DomainStats(Base):
+    """
+    Materialized per-domain statistics, so readers don't need to GROUP BY every NoteDomain
+
+    This is derived data: `notes_v2.add.refresh_domain_stats()` recomputes rows for
+    any domains touched by an import, and can rebuild the whole table if needed.
+    """
+    __tablename__ = 'DomainStats-v2'
+
+    domain_id = Column(String, primary_key=True, nullable=False)
+    note_count = Column(Integer, nullable=False)
+    # See `domain_rarity_bucket()`
+    rarity_bucket = Column(Integer, nullable=False)
+
+    # Quarter scopes are skipped here, unless they're the only scopes the domain has.
+    earliest_time_scope_id = Column(String(20))
+    latest_time_scope_id = Column(String(20))
+    latest_sort_time = Column(DateTime)
+
+    # Start ordinals for the earliest/latest scopes, see `Note.scope_start_ordinal`
+    earliest_scope_ordinal = Column(Integer)
+    latest_scope_ordinal = Column(Integer)
+
+    __table_args__ = (
+        Index("domain-stats-recency-index", 'latest_scope_ordinal', 'latest_sort_time'),
+        Index("domain-stats-count-index", 'note_count', 'domain_id'),
+    )
+
+
+def domain_rarity_bucket(note_count: int) -> int:
+    """
+    Rounds `note_count` down to a power of two, which is all that rendering uses for sizing + ordering
+
+    That way, rendered pages only go stale when a domain's note count doubles or halves.
+    """
+    return note_count.bit_length() - 1
+
+
+class DomainScopeCounts(Base):
+    """
+    Rollup of note counts per (domain, time scope), for the calendar views
+
+    The calendar heatmaps only read the day-scoped rows, but keeping every scope
+    type lets `/v2/domains/calendar` answer from this table too.
+    Maintained by `notes_v2.add.refresh_domain_scope_counts()`.
+    """
+    __tablename__ = 'DomainScopeCounts-v2'
+
+    domain_id = Column(String, primary_key=True, nullable=False)
+    time_scope_id = Column(String(20), primary_key=True, nullable=False)
+    scope_type = Column(Integer)
+    scope_start_ordinal = Column(Integer)
+
+    note_count = Column(Integer, nullable=False)
+
+    __table_args__ = (
+        Index("domain-scope-counts-range-index", 'domain_id', 'scope_type', 'scope_start_ordinal'),
+    )
+
+
+class DataGeneration(Base):
+    """
+    Counters that get bumped whenever notes change, so render caches can tell when they're stale
+
+    The counters are bumped by SQLite triggers (see `notes_v2.migrate.create_generation_triggers()`),
+    so every write path gets covered, including other processes.
+    """
+    __tablename__ = 'DataGenerations-v2'
+
+    generation_key = Column(String, primary_key=True, nullable=False)
+    generation = Column(Integer, nullable=False, default=0)
+
+
+GLOBAL_GENERATION_KEY = '*'
+"Bumped on any change to `Note`, `NoteDomain`, or `DomainStats`"
+
+RARITY_GENERATION_KEY = 'rarity'
+"""
+Bumped when any `DomainStats.rarity_bucket` changes
+
+That's everything `DomainRarityIndex` reads, and it sizes + orders every rendered page's dots and domains.
+"""
+
+
+def month_generation_key(ordinal: int) -> str:
+    """
+    Per-month `DataGeneration` key, bumped for changes to any note whose `scope_start_ordinal` is in that month
+
+    Must match the SQL version in `notes_v2.migrate.create_generation_triggers()`.
+    """
+    return 'month:' + date.fromordinal(ordinal).strftime('%Y-%m')
+
+
+def scope_generation_keys(scope: TimeScope) -> List[str]:
+    """
+    `DataGeneration` keys that cover every note that can show up on a page for `scope`
+
+    That's the scope and all its child scopes, plus its parent scopes (see `NoteStapler.add_by_scope()`).
+    """
+    def scope_and_descendants(s: TimeScope) -> Iterable[TimeScope]:
+        yield s
+        if not s.is_day:
+            for child in s.children:
+                yield from scope_and_descendants(TimeScope(child))
+
+    start_ordinals = [s.start.toordinal() for s in scope_and_descendants(scope)]
+
+    generation_keys = set()
+    month_start = date.fromordinal(min(start_ordinals)).replace(day=1)
+    last_month = date.fromordinal(max(start_ordinals)).replace(day=1)
+    while month_start <= last_month:
+        generation_keys.add(month_generation_key(month_start.toordinal()))
+        month_start = (month_start + timedelta(days=32)).replace(day=1)
+
+    # Parent scopes only contribute their own notes, which all share one start ordinal
+    if scope.is_day:
+        generation_keys.add(month_generation_key(scope.parent_week.start.toordinal()))
+    if not scope.is_quarter:
+        generation_keys.add(month_generation_key(scope.parent_quarter.start.toordinal()))
+
+    return sorted(generation_keys)
@@ -1,24 +1,26 @@
 import json
 from datetime import datetime, timedelta
-from typing import Tuple, List
+from typing import List, Tuple
 
-from flask import current_app, render_template, url_for
+from flask import current_app, render_template, stream_template, url_for
 from markupsafe import Markup, escape
-from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 
-from notes_v2.models import Note, NoteDomain
-from notes_v2.report.gather import notes_json_tree
+from notes_v2.models import Note
+from notes_v2.report.gather import iter_notes_json_tree, notes_json_tree
 from notes_v2.report.render import render_day_svg, render_week_svg
 from util import TimeScope, TimeScopeBuilder
 # noinspection PyUnresolvedReferences
-from . import counts, domains, gather, render
-from .render import standalone_render_day_svg, standalone_render_week_svg
-from .render_utils import domain_to_css_color, _domain_to_html_link, cache
+from . import counts, domains, gather, rarity, render, render_utils, search
+from .rarity import DomainRarityIndex, get_rarity_index
+from .render import compact_svg_output, day_svg_height, day_svg_symbol_id, day_svg_width, \
+    standalone_render_day_svg, standalone_render_svg_sprite, standalone_render_week_svg, \
+    week_svg_height, week_svg_symbol_id, week_svg_width
+from .render_utils import domain_to_css_color, _domain_to_html_link, cache, cache_get
 
 
 def _render_n2_domains(
-        db_session: Session,
+        rarity_index: DomainRarityIndex,
         n: Note,
         domain_ids: Tuple[str],
         scope_ids: Tuple[str],
@@ -47,21 +49,12 @@ def _render_n2_domains(
     if len(renderable_domains) == 0:
         return ""
     elif len(renderable_domains) == 1:
-        # Don't need to do any querying if there's only one domain,
+        # Don't need to do any sorting if there's only one domain,
         # which is true for the majority of notes
         return _domain_to_html_link(renderable_domains[0], scope_ids, single_page)
     else:
-        # TODO: Profile and decide whether memoizing this will help.
-        # And also, whether we can do it with functools, or need flask.current_app.
-        query = (
-            select(NoteDomain.domain_id, func.count(NoteDomain.note_id))
-            .where(NoteDomain.domain_id.in_(renderable_domains))
-            .group_by(NoteDomain.domain_id)
-            .order_by(func.count(NoteDomain.note_id).asc())
-        )
-
         rendered_domains = []
-        for domain_id, note_count in db_session.execute(query).all():
+        for domain_id in rarity_index.sorted_by_rarity(renderable_domains):
             rendered_domains.append(_domain_to_html_link(domain_id, scope_ids, single_page))
 
         return " & ".join(rendered_domains)
@@ -95,12 +88,68 @@ def _render_n2_time(
     )
 
 
+def _make_note_renderers(
+        db_session: Session,
+        domains: Tuple[str],
+        scope_ids: Tuple[str],
+        single_page: bool,
+):
+    """
+    Build the `render_n2_desc` and `render_n2_json` callables used by notes/render.html
+
+    Shared between the normal /notes page and search results. Domains are sorted
+    by the in-memory rarity index, so rendering a note never queries `DomainStats`.
+    """
+
+    def do_markdown_filter(text):
+        filter = current_app.jinja_env.filters.get('markdown')
+        return filter(text)
+
+    def render_n2_desc(n: Note, scope_id):
+        return (
+            # Some kind of sort_time
+            f'<div class="time" title="{n.sort_time}">{_render_n2_time(n, scope_ids, TimeScope(scope_id))}</div>\n'
+            # Print the description
+            f'<div class="desc">{do_markdown_filter(n.desc)}</div>\n'
+            # And color-coded, hyperlinked domains
+            f'<div class="domains">{_render_n2_domains(get_rarity_index(db_session), n, domains, scope_ids, single_page)}</div>\n'
+        )
+
+    def render_n2_json(
+            n: Note, 
+            detailed_desc_max_length: int | None = 280,
+    ) -> str:
+        note_json = n.as_json(include_domains=True)
+
+        # Add extra debugging info
+        ddesc = note_json.get('detailed_desc', None)
+        if ddesc is not None:
+            # Re-add the `detailed_desc` field so it shows up last in rendering
+            del note_json['detailed_desc']
+            if detailed_desc_max_length is not None and len(ddesc) > detailed_desc_max_length:
+                note_json['detailed_desc'] = ddesc[:detailed_desc_max_length] + '... [truncated]'
+            else:
+                note_json['detailed_desc'] = ddesc
+
+            note_json['detailed_desc_characters'] = len(ddesc)
+
+        return json.dumps(note_json, indent=2)
+
+    return render_n2_desc, render_n2_json
+
+
 def render_matching_notes(
         db_session: Session,
         domains: Tuple[str],
         scope_ids: Tuple[str],
         single_page: bool,
+        stream: bool = False,
 ):
+    """
+    Render the /notes page
+
+    With `stream`, the page is sent out a week at a time, as each section's notes get gathered.
+    """
     render_kwargs = {}
     url_kwargs = {
         'domain': domains,
@@ -143,105 +192,76 @@ def render_matching_notes(
 
     render_kwargs['as_quarter_header'] = as_quarter_header
 
-    def do_markdown_filter(text):
-        filter = current_app.jinja_env.filters.get('markdown')
-        return filter(text)
-
-    def render_n2_desc(n: Note, scope_id):
-        return (
-            # Some kind of sort_time
-            f'<div class="time" title="{n.sort_time}">{_render_n2_time(n, scope_ids, TimeScope(scope_id))}</div>\n'
-            # Print the description
-            f'<div class="desc">{do_markdown_filter(n.desc)}</div>\n'
-            # And color-coded, hyperlinked domains
-            f'<div class="domains">{_render_n2_domains(db_session, n, domains, scope_ids, single_page)}</div>\n'
-        )
-
-    def render_n2_json(
-            n: Note, 
-            detailed_desc_max_length: int | None = 280,
-    ) -> str:
-        note_json = n.as_json(include_domains=True)
+    render_n2_desc, render_n2_json = _make_note_renderers(db_session, domains, scope_ids, single_page)
 
-        # Add extra debugging info
-        ddesc = note_json.get('detailed_desc', None)
-        if ddesc is not None:
-            # Re-add the `detailed_desc` field so it shows up last in rendering
-            del note_json['detailed_desc']
-            if detailed_desc_max_length is not None and len(ddesc) > detailed_desc_max_length:
-                note_json['detailed_desc'] = ddesc[:detailed_desc_max_length] + '... [truncated]'
-            else:
-                note_json['detailed_desc'] = ddesc
-
-            note_json['detailed_desc_characters'] = len(ddesc)
-
-        return json.dumps(note_json, indent=2)
+    page_cache_key = ("/notes", tuple(domains), tuple(scope_ids),)
+    single_page_cache_key = ("/notes single_page", tuple(domains), tuple(scope_ids),)
 
     def memoized_render_notes(jinja_render_fn):
         def generate_fn():
             notes_tree = notes_json_tree(db_session, domains, scope_ids)
             return jinja_render_fn(notes_tree)
 
-        # Do not cache the current day.
-        uncacheable_day_scope = TimeScope(datetime.now().strftime('%G-ww%V.%u'))
-
-        if (
-            uncacheable_day_scope in scope_ids
-            or uncacheable_day_scope.parent_week in scope_ids
-            or uncacheable_day_scope.parent_quarter in scope_ids
-        ):
-            return generate_fn()
-
         # For a normal page, just cache the normal render.
         if not single_page:
-            return cache(
-                key=("/notes", tuple(domains), tuple(scope_ids),),
-                generate_fn=generate_fn)
+            return cache(key=page_cache_key, generate_fn=generate_fn, scopes=scope_ids, persist=True)
 
         # For a `single_page`'d request, try to write two cache entries.
-        sp_result = cache(
-            key=("/notes single_page", tuple(domains), tuple(scope_ids),),
-            generate_fn=generate_fn)
-
-        cache(
-            key=("/notes", tuple(domains), tuple(scope_ids),),
-            generate_fn=lambda: sp_result)
+        sp_result = cache(key=single_page_cache_key, generate_fn=generate_fn, scopes=scope_ids, persist=True)
+        cache(key=page_cache_key, generate_fn=lambda: sp_result, scopes=scope_ids, persist=True)
 
         return sp_result
 
-    def memoized_render_day_svg(day_scope, day_dict_notes):
-        disable_caching: bool = False
-        if datetime.now().strftime('%G-ww%V.%u') == day_scope:
-            disable_caching = True
+    def streamed_render_notes(jinja_render_quarter_fn):
+        """
+        Yields one rendered (partial) quarter at a time, then caches the concatenated result like `memoized_render_notes`
+        """
+        cache_key = single_page_cache_key if single_page else page_cache_key
+        cached_render = cache_get(cache_key, scopes=scope_ids, persist=True)
+        if cached_render is not None:
+            yield cached_render
+            return
+
+        rendered_quarters = []
+        previous_quarter_scope = None
+        for quarter_scope, quarter_dict in iter_notes_json_tree(db_session, domains, scope_ids):
+            # Busy quarters arrive in several pieces, but only the first one gets a header
+            with_header = quarter_scope != previous_quarter_scope
+            previous_quarter_scope = quarter_scope
+
+            rendered_quarter = jinja_render_quarter_fn(quarter_scope, quarter_dict, with_header)
+            rendered_quarters.append(rendered_quarter)
+            yield rendered_quarter
+
+        full_render = Markup('').join(rendered_quarters)
+        cache(key=cache_key, generate_fn=lambda: full_render, scopes=scope_ids, persist=True)
+        if single_page:
+            cache(key=page_cache_key, generate_fn=lambda: full_render, scopes=scope_ids, persist=True)
+
+    compact_svg = compact_svg_output()
+    # Non-inline pages get all their day + week <svg>s from one sprite, see `render_svg_sprite()`
+    sprite_src = url_for(".do_render_svg_sprite", scope=scope_ids, domain=domains)
 
+    def memoized_render_day_svg(day_scope, day_dict_notes):
         render_inline: bool = single_page
         if not render_inline:
-            src_kwargs = {
-                'day_scope': day_scope,
-                'domain': domains,
-            }
-            if disable_caching:
-                src_kwargs['disable_caching'] = "true"
-
-            src = url_for(
-                ".do_render_svg_day",
-                **src_kwargs,
+            return (
+                f'<svg class="day-svg-external" width="{day_svg_width}px" height="{day_svg_height}px">'
+                f'<use href="{sprite_src}#{day_svg_symbol_id(day_scope)}" />'
+                '</svg>'
             )
-            return f'<img class="day-svg-external" src="{src}" width="960px" height="96px" />'
 
-        if disable_caching:
-            return render_day_svg(db_session, domains, day_scope, day_dict_notes)
-        else:
-            return cache(
-                key=("/svg.day cache entry", day_scope, domains),
-                generate_fn=lambda: render_day_svg(db_session, domains, day_scope, day_dict_notes))
+        return cache(
+            key=("/svg.day cache entry", day_scope, domains, compact_svg),
+            generate_fn=lambda: render_day_svg(
+                db_session, domains, day_scope, day_dict_notes, compact=compact_svg),
+            scopes=[day_scope],
+            persist=True)
 
     render_kwargs['render_day_svg'] = memoized_render_day_svg
 
     def memoized_maybe_render_week_svg(week_scope, week_dict):
         disable_caching: bool = False
-        if datetime.now().strftime('%G-ww%V') == week_scope:
-            disable_caching = True
         # Sometimes, we render a week <svg> for a single day.
         # This makes the rendering weird and incomplete, so don't cache it.
         if len(scope_ids) == 1 and TimeScope(scope_ids[0]).is_day:
@@ -261,24 +281,23 @@ def render_matching_notes(
                 link_kwargs = dict(url_kwargs)
                 link_kwargs['single_page'] = 'true'
 
-                image_src = url_for(
-                    ".do_render_svg_week",
-                    week_scope=week_scope,
-                    domain=domains,
-                )
                 link_href = url_for(".do_render_matching_notes", **link_kwargs)
                 return (
                     f'<a href="{link_href}">'
-                    f'<img class="week-svg-external" src="{image_src}" width="1008px" height="480px" />'
+                    f'<svg class="week-svg-external" width="{week_svg_width}px" height="{week_svg_height}px">'
+                    f'<use href="{sprite_src}#{week_svg_symbol_id(week_scope)}" />'
+                    '</svg>'
                     f'</a>'
                 )
 
         if disable_caching:
-            return render_week_svg(db_session, domains, week_scope, week_dict)
+            return render_week_svg(db_session, domains, week_scope, week_dict, compact=compact_svg)
         else:
             return cache(
-                key=("/svg.week cache entry", week_scope, domains),
-                generate_fn=lambda: render_week_svg(db_session, domains, week_scope, week_dict))
+                key=("/svg.week cache entry", week_scope, domains, compact_svg),
+                generate_fn=lambda: render_week_svg(db_session, domains, week_scope, week_dict, compact=compact_svg),
+                scopes=[week_scope],
+                persist=True)
 
     render_kwargs['maybe_render_week_svg'] = memoized_maybe_render_week_svg
 
@@ -308,6 +327,13 @@ def render_matching_notes(
             )
         )
 
+    if stream:
+        return stream_template('notes/render.html',
+                               streamed_render=streamed_render_notes,
+                               render_n2_desc=render_n2_desc,
+                               render_n2_json=render_n2_json,
+                               **render_kwargs)
+
     return render_template('notes/render.html',
                            cached_render=memoized_render_notes,
                            render_n2_desc=render_n2_desc,
@@ -315,6 +341,36 @@ def render_matching_notes(
                            **render_kwargs)
 
 
+def render_search_results(
+        db_session: Session,
+        query: str,
+        page: int,
+):
+    results = search.search(db_session, query, page)
+    render_n2_desc, render_n2_json = _make_note_renderers(db_session, (), (), False)
+
+    render_kwargs = {}
+    if results.page > 1:
+        render_kwargs['prev_scope'] = '<a href="{}">page {}</a>'.format(
+            url_for(".do_render_note_search", q=query, page=results.page - 1),
+            results.page - 1)
+    if results.has_next_page:
+        render_kwargs['next_scope'] = '<a href="{}">page {}</a>'.format(
+            url_for(".do_render_note_search", q=query, page=results.page + 1),
+            results.page + 1)
+
+    render_kwargs['scope_nav_header'] = Markup(
+        f'<div>\n<span>search: {escape(query)}</span>\n</div>\n'
+    )
+
+    return render_template('notes/render.html',
+                           page_title=escape(f'/notes/search?q={query}  '),
+                           search_results=results.notes,
+                           render_n2_desc=render_n2_desc,
+                           render_n2_json=render_n2_json,
+                           **render_kwargs)
+
+
 def edit_notes_simple(*args):
     """
     Render a list of Notes as simply as possible
@@ -1,26 +1,93 @@
+import bisect
+import operator
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Tuple
+from typing import Iterable, List, Tuple, TypeAlias
 
 from flask import render_template, url_for
 from markupsafe import Markup
-from sqlalchemy import select, func, and_, or_
+from sqlalchemy import select, func, or_
 from sqlalchemy.orm import Session
 
 from .render_utils import render_cache, render_cache_generator, render_cache_with_args
-from ..models import NoteDomain, Note
+from ..models import DomainScopeCounts
 from util import TimeScope, TimeScopeBuilder
 
 
 @dataclass
 class GenerationResult:
-    quarter_ignored: int = 0
-    week_ignored: int = 0
     entries_modified: int = 0
     "Counts the number of entries modified, so we can skip rendering if 0"
     entries_modified_redundantly: int = 0
 
 
+DayCountRow: TypeAlias = Tuple[int, str, int]
+"(scope_start_ordinal, domain_id or filter, note_count)"
+
+
+def _load_day_counts(
+        db_session: Session,
+        domain_filter: str,
+        coalesce_matching_domains: bool,
+) -> List[DayCountRow]:
+    """
+    Read every day-scoped count for the filter from the `DomainScopeCounts` rollup, in one query
+
+    We don't have any UI for non-day notes, so those are skipped.
+    Rows are sorted by day, so callers can bisect them into quarters.
+    """
+    if coalesce_matching_domains:
+        query = (
+            select(
+                DomainScopeCounts.scope_start_ordinal,
+                func.sum(DomainScopeCounts.note_count),
+            )
+            .group_by(DomainScopeCounts.scope_start_ordinal)
+            .order_by(DomainScopeCounts.scope_start_ordinal.asc())
+        )
+    else:
+        query = (
+            select(
+                DomainScopeCounts.scope_start_ordinal,
+                DomainScopeCounts.note_count,
+                DomainScopeCounts.domain_id,
+            )
+            .order_by(
+                DomainScopeCounts.scope_start_ordinal.asc(),
+                DomainScopeCounts.domain_id.asc(),
+            )
+        )
+
+    rows = db_session.execute(
+        query
+        .where(DomainScopeCounts.scope_type == TimeScope.Type.day.value)
+        .where(DomainScopeCounts.domain_id.ilike(domain_filter))
+    ).all()
+
+    if coalesce_matching_domains:
+        return [(row[0], str(domain_filter), row[1]) for row in rows]
+    else:
+        return [(row[0], row[2], row[1]) for row in rows]
+
+
+def _rows_within(rows: List[DayCountRow], quarter_scope: TimeScope) -> List[DayCountRow]:
+    start_index = bisect.bisect_left(rows, quarter_scope.start.toordinal(), key=operator.itemgetter(0))
+    end_index = bisect.bisect_left(rows, quarter_scope.end.toordinal(), key=operator.itemgetter(0))
+    return rows[start_index:end_index]
+
+
+def _quarters_between(start_ordinal: int, end_ordinal: int) -> Iterable[TimeScope]:
+    current_quarter = TimeScopeBuilder.day_scope_from_dt(datetime.fromordinal(start_ordinal)).parent_quarter
+    end_end: datetime = datetime.fromordinal(end_ordinal)
+    while current_quarter.start < end_end:
+        yield current_quarter
+        current_quarter = current_quarter.next
+
+
+def _day_scope_from_ordinal(ordinal: int) -> TimeScope:
+    return TimeScopeBuilder.day_scope_from_dt(datetime.fromordinal(ordinal))
+
+
 def calendar(
         db_session: Session,
         page_scopes: Tuple[str],
@@ -28,24 +95,22 @@ def calendar(
 ):
     query = (
         select(
-            NoteDomain.domain_id,
-            Note.time_scope_id,
-            func.count(Note.note_id),
+            DomainScopeCounts.domain_id,
+            DomainScopeCounts.time_scope_id,
+            DomainScopeCounts.note_count,
         )
-        .join(NoteDomain, NoteDomain.note_id == Note.note_id)
-        .group_by(NoteDomain.domain_id, Note.time_scope_id)
         .order_by(
-            NoteDomain.domain_id.desc(),
-            func.count(Note.note_id).desc(),
+            DomainScopeCounts.domain_id.desc(),
+            DomainScopeCounts.note_count.desc(),
         )
     )
 
     if page_domain_filters:
         query = query.where(or_(
-            *[NoteDomain.domain_id.ilike(filter) for filter in page_domain_filters],
+            *[DomainScopeCounts.domain_id.ilike(filter) for filter in page_domain_filters],
         ))
     if page_scopes:
-        query = query.filter(Note.time_scope_id.in_(page_scopes))
+        query = query.filter(DomainScopeCounts.time_scope_id.in_(page_scopes))
 
     response_json = {}
     "Maps from domain_id to {scope: count}"
@@ -63,27 +128,17 @@ def render_one_calendar(
         db_session: Session,
         page_domain_filter: str,
 ):
+    @render_cache_with_args('calendar single counts', page_domain_filter)
+    def load_day_counts() -> List[DayCountRow]:
+        return _load_day_counts(db_session, page_domain_filter, True)
+
     @render_cache_generator('calendar quarters', (), (page_domain_filter,))
     def quarters_generator():
-        scope_bounds_query = (
-            select(
-                func.min(Note.time_scope_id),
-                func.max(Note.time_scope_id),
-            )
-            .join(NoteDomain, NoteDomain.note_id == Note.note_id)
-            .filter(func.not_(Note.time_scope_id.contains('—')))
-            .where(NoteDomain.domain_id.ilike(page_domain_filter))
-        )
-
-        scope_bounds = db_session.execute(scope_bounds_query).one()
-        if not scope_bounds[0] or not scope_bounds[1]:
+        day_count_rows = load_day_counts()
+        if not day_count_rows:
             raise ValueError(f"Couldn't find any TimeScope boundaries for {page_domain_filter}")
 
-        current_quarter = TimeScope(scope_bounds[0]).parent_quarter
-        end_end: datetime = TimeScope(scope_bounds[1]).end
-        while current_quarter.start < end_end:
-            yield current_quarter
-            current_quarter = current_quarter.next
+        yield from _quarters_between(day_count_rows[0][0], day_count_rows[-1][0] + 1)
 
     @render_cache_generator('calendar single', page_domain_filter)
     def day_counts_generator(quarter_scope: TimeScope):
@@ -93,38 +148,17 @@ def render_one_calendar(
         for week_scope in quarter_scope.children:
             quarter_counts[week_scope] = [0] * 7
 
-        query = (
-            select(Note.time_scope_id, func.count(Note.note_id))
-            .group_by(Note.time_scope_id)
-            .join(NoteDomain, NoteDomain.note_id == Note.note_id)
-            .where(and_(
-                NoteDomain.domain_id.ilike(page_domain_filter),
-                Note.time_scope_id >= TimeScopeBuilder.day_scope_from_dt(quarter_scope.start),
-                Note.time_scope_id < TimeScopeBuilder.day_scope_from_dt(quarter_scope.end),
-            ))
-            .order_by(
-                Note.time_scope_id.asc(),
-            )
-        )
-
-        for day_count_row in db_session.execute(query).all():
-            count_scope = TimeScope(day_count_row[0])
-            if count_scope.is_quarter:
-                result.quarter_ignored += 1
-                continue
-            if count_scope.is_week:
-                result.week_ignored += 1
-                continue
-
+        for day_ordinal, _, note_count in _rows_within(load_day_counts(), quarter_scope):
+            count_scope = _day_scope_from_ordinal(day_ordinal)
             day_counts = quarter_counts[count_scope.parent_week]
             day_index = int(count_scope[-1]) - 1
 
-            if day_counts[day_index] == day_count_row[1]:
+            if day_counts[day_index] == note_count:
                 result.entries_modified_redundantly += 1
             else:
                 result.entries_modified += 1
 
-            day_counts[day_index] = day_count_row[1]
+            day_counts[day_index] = note_count
 
         yield from quarter_counts.items()
 
@@ -161,44 +195,30 @@ def render_calendar(
         page_domains: Tuple[str],
         page_domain_filters: Tuple[str],
 ):
+    @render_cache_with_args('calendar multi counts', page_domains, page_domain_filters)
+    def load_day_counts() -> List[Tuple[str, bool, List[DayCountRow]]]:
+        """
+        One rollup read per domain/filter, covering every quarter at once
+        """
+        return [
+            *[(f, True, _load_day_counts(db_session, f, True)) for f in page_domain_filters],
+            *[(d, False, _load_day_counts(db_session, d, False)) for d in page_domains],
+        ]
+
     @render_cache_generator('calendar quarters', page_domains, page_domain_filters)
     def quarters_generator():
         """
-        This function is a little dumb because time_scope_id's are stored dumbly in SQLite.
-        Specifically, the emdash of a "quarter" scope will always come last.
-
-        So rather than try to sort it out, just filter out emdashes.
+        Quarter- and week-scoped notes don't have any UI in the calendar, so they don't count towards the bounds.
         """
-        scope_bounds_query = (
-            select(
-                func.min(Note.time_scope_id),
-                func.max(Note.time_scope_id),
-            )
-            .join(NoteDomain, NoteDomain.note_id == Note.note_id)
-            .filter(func.not_(Note.time_scope_id.contains('—')))
-        )
-
-        # These have to be provided in one shot to be OR'd,
-        # providing them in two .where() clauses generates an AND.
-        where_clauses = [
-            *[NoteDomain.domain_id.ilike(f) for f in page_domains],
-            *[NoteDomain.domain_id.ilike(f) for f in page_domain_filters],
+        day_ordinals = [
+            day_ordinal
+            for _, _, day_count_rows in load_day_counts()
+            for day_ordinal, _, _ in day_count_rows
         ]
-
-        if len(where_clauses) > 1:
-            scope_bounds_query = scope_bounds_query.where(or_(*where_clauses))
-        elif len(where_clauses) == 1:
-            scope_bounds_query = scope_bounds_query.where(where_clauses[0])
-
-        scope_bounds = db_session.execute(scope_bounds_query).one()
-        if not scope_bounds[0] or not scope_bounds[1]:
+        if not day_ordinals:
             raise ValueError(f"Couldn't find any TimeScope boundaries for {page_domains} + {page_domain_filters}")
 
-        current_quarter = TimeScope(scope_bounds[0]).parent_quarter
-        end_end: datetime = TimeScope(scope_bounds[1]).end
-        while current_quarter.start < end_end:
-            yield current_quarter
-            current_quarter = current_quarter.next
+        yield from _quarters_between(min(day_ordinals), max(day_ordinals) + 1)
 
     @render_cache_generator('calendar multi', page_domains, page_domain_filters)
     def day_counts_generator(quarter_scope: TimeScope):
@@ -229,47 +249,13 @@ def render_calendar(
 
         def populate_per_domain_counts(
                 domain_filter: str,
-                coalesce_matching_domains: bool = False,
+                day_count_rows: List[DayCountRow],
         ) -> None:
             if domain_filter in initialized_domains:
                 return
 
-            if coalesce_matching_domains:
-                base_query = \
-                    select(Note.time_scope_id, func.count(Note.note_id)) \
-                    .group_by(Note.time_scope_id)
-            else:
-                base_query = \
-                    select(Note.time_scope_id, func.count(Note.note_id), NoteDomain.domain_id) \
-                    .group_by(Note.time_scope_id, NoteDomain.domain_id)
-
-            day_count_rows = db_session.execute(
-                base_query
-                .join(NoteDomain, NoteDomain.note_id == Note.note_id)
-                .where(and_(
-                    NoteDomain.domain_id.ilike(domain_filter),
-                    Note.time_scope_id >= TimeScopeBuilder.day_scope_from_dt(quarter_scope.start),
-                    Note.time_scope_id < TimeScopeBuilder.day_scope_from_dt(quarter_scope.end),
-                ))
-                .order_by(
-                    Note.time_scope_id.asc(),
-                )
-            ).all()
-
-            for day_count_row in day_count_rows:
-                count_scope = TimeScope(day_count_row[0])
-                # Confirm that we're actually dealing with days, since we don't have any UI for non-day notes
-                if count_scope.is_quarter:
-                    result.quarter_ignored += 1
-                    continue
-                if count_scope.is_week:
-                    result.week_ignored += 1
-                    continue
-
-                if coalesce_matching_domains:
-                    domain_ish_label = str(domain_filter)
-                else:
-                    domain_ish_label = day_count_row[2]
+            for day_ordinal, domain_ish_label, note_count in _rows_within(day_count_rows, quarter_scope):
+                count_scope = _day_scope_from_ordinal(day_ordinal)
 
                 # NB The set of labels will vary per quarter, skipping one if it doesn't show up at all.
                 if domain_ish_label not in initialized_domains:
@@ -282,18 +268,16 @@ def render_calendar(
                 day_index = int(count_scope[-1]) - 1
 
                 # Do the update, with some tracking for debug/profiling purposes
-                if day_counts[day_index] == day_count_row[1]:
+                if day_counts[day_index] == note_count:
                     result.entries_modified_redundantly += 1
                 else:
                     result.entries_modified += 1
 
-                day_counts[day_index] = day_count_row[1]
-
-        for domain_filter in page_domain_filters:
-            populate_per_domain_counts(domain_filter, True)
+                day_counts[day_index] = note_count
 
-        for domain in page_domains:
-            populate_per_domain_counts(domain)
+        # Filters come first, so they get coalesced before any of their matching domains show up
+        for domain_filter, _, day_count_rows in load_day_counts():
+            populate_per_domain_counts(domain_filter, day_count_rows)
 
         if not result.entries_modified:
             print(f"[DEBUG] No entries modified, GenerationResult: {result}")
@@ -1,16 +1,18 @@
 from flask import render_template
 from markupsafe import Markup
-from sqlalchemy import select, func
+from sqlalchemy import select
 
 from util import TimeScope
 from .render_utils import _domain_to_html_link
-from ..models import NoteDomain, Note
+from ..models import DomainStats
 
 
 def stats(session):
     """
     Build and return statistics for every matching NoteDomain
 
+    This reads from the materialized `DomainStats` table, which the import path maintains.
+
     - how many notes are tied to that domain
     - (maybe) how many notes are _uniquely_ that domain
     - latest time_scope_id for that note (alphabetical sorting is fine)
@@ -32,17 +34,10 @@ def stats(session):
     """
     response_json = {}
 
-    for nd in session.query(NoteDomain.domain_id).distinct():
-        response_json[nd.domain_id] = {
-            "latest": Note.query
-                .join(NoteDomain, NoteDomain.note_id == Note.note_id)
-                .filter(NoteDomain.domain_id == nd.domain_id)
-                .order_by(Note.time_scope_id.desc())
-                .limit(1)
-                .one().time_scope_id,
-            "count": NoteDomain.query
-                .filter_by(domain_id=nd.domain_id)
-                .count()
+    for ds in session.execute(select(DomainStats)).scalars():
+        response_json[ds.domain_id] = {
+            "latest": ds.latest_time_scope_id,
+            "count": ds.note_count,
         }
 
     return response_json
@@ -70,19 +65,15 @@ def render_stats(
     def render_domains():
         query = query_limiter(
             select(
-                NoteDomain.domain_id,
-                func.min(Note.time_scope_id),
-                func.max(Note.time_scope_id),
-                func.max(Note.sort_time),
-                func.count(Note.note_id),
+                DomainStats.domain_id,
+                DomainStats.earliest_time_scope_id,
+                DomainStats.latest_time_scope_id,
+                DomainStats.latest_sort_time,
+                DomainStats.note_count,
             )
-            .join(NoteDomain, NoteDomain.note_id == Note.note_id)
-            # Filter out any time_scope_ids that contain an emdash, since they mess up the ordering dramatically
-            .filter(func.not_(Note.time_scope_id.contains('—')))
-            .group_by(NoteDomain.domain_id)
             .order_by(
-                func.max(Note.time_scope_id).desc(),
-                func.max(Note.sort_time).desc())
+                DomainStats.latest_scope_ordinal.desc(),
+                DomainStats.latest_sort_time.desc())
         )
 
         rows = session.execute(query).all()
@@ -1,20 +1,33 @@
 import logging
 from datetime import datetime
-from typing import Dict, Iterable
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 from markupsafe import Markup
-from sqlalchemy import or_, select
+from sqlalchemy import and_, func, or_, select
 from sqlalchemy.orm import Session, joinedload
 
-from notes_v2.models import Note, NoteDomain
-from util import TimeScope
+from notes_v2.models import Domain, Note, NoteDomain
+from util import TimeScope, TimeScopeBuilder
 
 NOTES_KEY = "notes"
 
+default_week_promotion_threshold: int = 9
+default_quarter_promotion_threshold: int = 17
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+def _exact_scope(scope: TimeScope):
+    """
+    Matches notes with exactly this time scope, using the numeric scope columns' index
+    """
+    return (
+        Note.scope_type == scope.type.value,
+        Note.scope_start_ordinal == scope.start.toordinal(),
+    )
+
+
 class NoteStapler:
     """
     Bundles up Note.as_json() results into a Jinja-renderable dict
@@ -33,21 +46,23 @@ class NoteStapler:
     ):
         self.session = db_session
 
-        domains_filter_sql = []
-        if domains_filter:
-            domains_filter_sql = [NoteDomain.domain_id.like(d + "%") for d in domains_filter]
-
         # TODO: Combining domain and scope filtering doesn't work, but it should
         # TODO: Notes with no domains set are not returned by this
         self.filtered_query = (
             select(Note)
             .join(NoteDomain, Note.note_id == NoteDomain.note_id)
-            .where(or_(*domains_filter_sql))
+            .join(Domain, NoteDomain.domain_int == Domain.domain_int)
             .options(joinedload(Note.domains))
             .group_by(Note)
         )
+        if domains_filter:
+            self.filtered_query = self.filtered_query.where(
+                or_(*[Domain.domain_id.like(d + "%") for d in domains_filter]))
 
         self.scope_tree = {}
+        self.prefetched_notes: Dict[Tuple[int, int], List[Note]] = {}
+        "Maps (scope_type, scope_start_ordinal) to matching notes, see `_prefetch_notes()`"
+
         # When larger scopes have a very low number of notes,
         # hide the <svg>'s and just render the notes directly,
         # because we usually don't care about the timing.
@@ -120,14 +135,48 @@ class NoteStapler:
 
         scope_tree[NOTES_KEY].sort(key=as_sort_time)
 
+    def _prefetch_notes(self, scope: TimeScope, include_parents: bool = True) -> None:
+        """
+        Load every note that `add_by_scope(scope)` will read, in one range query
+
+        This covers `scope` and all its child scopes (as a range of start ordinals),
+        plus exact matches for the parent scopes unless `include_parents` is False.
+        Notes are bucketed by their exact scope, so the `_add_by_*` methods only need a dict lookup.
+        """
+        def scope_and_descendants(s: TimeScope) -> Iterable[TimeScope]:
+            yield s
+            if not s.is_day:
+                for child in s.children:
+                    yield from scope_and_descendants(TimeScope(child))
+
+        start_ordinals = [s.start.toordinal() for s in scope_and_descendants(scope)]
+        scope_conditions = [
+            and_(
+                Note.scope_start_ordinal >= min(start_ordinals),
+                Note.scope_start_ordinal <= max(start_ordinals),
+            ),
+        ]
+        if include_parents and scope.is_day:
+            scope_conditions.append(and_(*_exact_scope(scope.parent_week)))
+        if include_parents and not scope.is_quarter:
+            scope_conditions.append(and_(*_exact_scope(scope.parent_quarter)))
+
+        new_note_rows = self.filtered_query \
+            .filter(or_(*scope_conditions)) \
+            .order_by(Note.sort_time.asc(), Note.note_id.asc())
+
+        self.prefetched_notes = {}
+        for (n,) in self.session.execute(new_note_rows).unique().all():
+            self.prefetched_notes.setdefault((n.scope_type, n.scope_start_ordinal), []).append(n)
+
+    def _prefetched_notes_for(self, scope: TimeScope) -> List[Note]:
+        return self.prefetched_notes.get((scope.type.value, scope.start.toordinal()), [])
+
     def _add_by_day(
             self,
             scope: TimeScope,
     ) -> int:
-        new_note_rows = self.filtered_query \
-            .filter(Note.time_scope_id == scope) \
-            .order_by(Note.sort_time.asc())
-        new_notes = list(n for (n,) in self.session.execute(new_note_rows).unique().all())
+        new_notes = self._prefetched_notes_for(scope)
 
         notes_list = self._construct_scope_tree(scope)[NOTES_KEY]
         notes_list.extend(new_notes)
@@ -146,10 +195,7 @@ class NoteStapler:
                 added_notes = self._add_by_day(TimeScope(day_scope))
                 total_notes_count += added_notes
 
-        new_note_rows = self.filtered_query \
-            .filter(Note.time_scope_id == scope) \
-            .order_by(Note.time_scope_id.asc())
-        new_notes = list(n for (n,) in self.session.execute(new_note_rows).unique().all())
+        new_notes = self._prefetched_notes_for(scope)
 
         notes_list = self._construct_scope_tree(scope)[NOTES_KEY]
         notes_list.extend(new_notes)
@@ -173,10 +219,7 @@ class NoteStapler:
                 added_notes = self._add_by_week(TimeScope(week_scope), skip_child_scopes)
                 total_notes_count += added_notes
 
-        new_note_rows = self.filtered_query \
-            .filter(Note.time_scope_id == scope) \
-            .order_by(Note.time_scope_id.asc())
-        new_notes = list(n for (n,) in self.session.execute(new_note_rows).unique().all())
+        new_notes = self._prefetched_notes_for(scope)
 
         notes_list = self._construct_scope_tree(scope)[NOTES_KEY]
         notes_list.extend(new_notes)
@@ -189,6 +232,8 @@ class NoteStapler:
         return total_notes_count
 
     def add_by_scope(self, scope: TimeScope) -> None:
+        self._prefetch_notes(scope)
+
         if scope.is_quarter:
             self._add_by_quarter(scope)
         elif scope.is_week:
@@ -213,35 +258,145 @@ class NoteStapler:
 
         # Once we're done, iteratively check if we need to do collapsing
         for quarter in list(self.scope_tree.keys()):
-            quarter_count = 0
+            self._collapse_quarter_by_counts(quarter)
+
+    def _collapse_quarter_by_counts(self, quarter: TimeScope) -> None:
+        quarter_count = 0
 
-            for week in list(self.scope_tree[quarter].keys()):
-                week_count = 0
+        for week in list(self.scope_tree[quarter].keys()):
+            week_count = 0
 
-                # If this isn't a real week, but the quarter's notes:
-                if week == NOTES_KEY:
-                    quarter_count += len(self.scope_tree[quarter][week])
+            # If this isn't a real week, but the quarter's notes:
+            if week == NOTES_KEY:
+                quarter_count += len(self.scope_tree[quarter][week])
+                continue
+
+            for day in list(self.scope_tree[quarter][week].keys()):
+                # If this isn't a real day, but the week's notes:
+                if day == NOTES_KEY:
+                    week_count += len(self.scope_tree[quarter][week][day])
                     continue
 
-                for day in list(self.scope_tree[quarter][week].keys()):
-                    # If this isn't a real day, but the week's notes:
-                    if day == NOTES_KEY:
-                        week_count += len(self.scope_tree[quarter][week][day])
-                        continue
+                week_count += len(self.scope_tree[quarter][week][day][NOTES_KEY])
+
+            if week_count <= self.week_promotion_threshold:
+                self._collapse_scope_tree(week)
+            if week_count == 0:
+                raise RuntimeError(f"ERROR: somehow, we created an empty week-scope {week}")
 
-                    week_count += len(self.scope_tree[quarter][week][day][NOTES_KEY])
+            quarter_count += week_count
 
-                if week_count <= self.week_promotion_threshold:
-                    self._collapse_scope_tree(week)
-                if week_count == 0:
-                    raise RuntimeError(f"ERROR: somehow, we created an empty week-scope {week}")
+        if quarter_count <= self.quarter_promotion_threshold:
+            self._collapse_scope_tree(quarter)
+        if quarter_count == 0:
+            raise RuntimeError(f"ERROR: somehow, we created an empty quarter-scope {quarter}")
+
+    def _iter_quarter_by_weeks(
+            self,
+            quarter: TimeScope,
+            week_scopes: Iterable[TimeScope],
+    ) -> Iterator[Tuple[TimeScope, Dict]]:
+        """
+        Same as `_add_by_quarter()`, but yields partial quarter trees as soon as they're final, latest first
+
+        Whether a quarter gets collapsed depends on its total note count, so the first
+        yield waits until the quarter is known to be too busy to collapse. After that,
+        each week is yielded by itself. Quiet quarters are yielded whole, once collapsed.
+        """
+        quarter_note_rows = self.filtered_query \
+            .filter(and_(*_exact_scope(quarter))) \
+            .order_by(Note.sort_time.asc(), Note.note_id.asc())
+        quarter_notes = [n for (n,) in self.session.execute(quarter_note_rows).unique().all()]
+
+        self._construct_scope_tree(quarter)[NOTES_KEY].extend(quarter_notes)
+        total_notes_count = len(quarter_notes)
+
+        for week_scope in sorted(week_scopes, reverse=True):
+            self._prefetch_notes(week_scope, include_parents=False)
+            total_notes_count += self._add_by_week(week_scope)
+
+            if total_notes_count > self.quarter_promotion_threshold and quarter in self.scope_tree:
+                yield quarter, self.scope_tree.pop(quarter)
+
+        if total_notes_count <= self.quarter_promotion_threshold:
+            self._collapse_scope_tree(quarter)
+            yield quarter, self.scope_tree.pop(quarter)
+
+        logger.debug(f"Stapled quarter scope {quarter} (streamed) <= {total_notes_count} notes")
+
+    def iter_by_scopes(self, scopes: Iterable[TimeScope]) -> Iterator[Tuple[TimeScope, Dict]]:
+        """
+        Streaming version of `add_by_scope()`, yielding (quarter, partial quarter tree) pairs, latest first
+
+        A quarter that was requested by itself is yielded a week at a time, see `_iter_quarter_by_weeks()`.
+        Yielded trees are removed from `self.scope_tree`.
+        """
+        scopes_by_quarter: Dict[TimeScope, List[TimeScope]] = {}
+        for scope in scopes:
+            scopes_by_quarter.setdefault(_quarter_of(scope), []).append(scope)
+
+        for quarter in sorted(scopes_by_quarter.keys(), reverse=True):
+            if scopes_by_quarter[quarter] == [quarter]:
+                yield from self._iter_quarter_by_weeks(quarter, (TimeScope(w) for w in quarter.children))
+                continue
+
+            for scope in scopes_by_quarter[quarter]:
+                self.add_by_scope(scope)
+
+            if quarter in self.scope_tree:
+                yield quarter, self.scope_tree.pop(quarter)
+
+    def iter_everything(self) -> Iterator[Tuple[TimeScope, Dict]]:
+        """
+        Streaming version of `add_everything()`, yielding (quarter, partial quarter tree) pairs, latest first
+
+        Each quarter starts with one query for the scopes that have notes,
+        then only those weeks get loaded, see `_iter_quarter_by_weeks()`.
+        Yielded trees are removed from `self.scope_tree`.
+        """
+        filtered_notes = self.filtered_query.subquery()
+        earliest_ordinal, latest_ordinal = self.session.execute(
+            select(
+                func.min(filtered_notes.c.scope_start_ordinal),
+                func.max(filtered_notes.c.scope_start_ordinal),
+            )
+        ).one()
+        if earliest_ordinal is None:
+            return
+
+        quarter = _quarter_of(TimeScopeBuilder.day_scope_from_dt(datetime.fromordinal(latest_ordinal)))
+        while True:
+            # Weeks near the edges of a quarter can include days from the neighboring quarters
+            child_weeks = list(quarter.children)
+            range_start = min(quarter.start, child_weeks[0].start).toordinal()
+            range_end = max(quarter.end, child_weeks[-1].end).toordinal()
+            if range_end <= earliest_ordinal:
+                break
+
+            note_scope_ids = self.session.execute(
+                select(filtered_notes.c.time_scope_id)
+                .where(filtered_notes.c.scope_start_ordinal >= range_start)
+                .where(filtered_notes.c.scope_start_ordinal < range_end)
+                .distinct()
+            ).scalars()
+            note_scopes = [
+                s for s in (TimeScope(scope_id) for scope_id in note_scope_ids)
+                if _quarter_of(s) == quarter
+            ]
+
+            if note_scopes:
+                week_scopes = {
+                    s if s.is_week else s.parent_week
+                    for s in note_scopes
+                    if not s.is_quarter
+                }
+                yield from self._iter_quarter_by_weeks(quarter, week_scopes)
+
+            quarter = quarter.prev
 
-                quarter_count += week_count
 
-            if quarter_count <= self.quarter_promotion_threshold:
-                self._collapse_scope_tree(quarter)
-            if quarter_count == 0:
-                raise RuntimeError(f"ERROR: somehow, we created an empty quarter-scope {quarter}")
+def _quarter_of(scope: TimeScope) -> TimeScope:
+    return scope if scope.is_quarter else scope.parent_quarter
 
 
 def notes_json_tree(
@@ -250,8 +405,8 @@ def notes_json_tree(
         scope_ids: Iterable[Markup | str],
         disable_scope_collapse: bool = False,
 ):
-    week_promotion_threshold: int = 9
-    quarter_promotion_threshold: int = 17
+    week_promotion_threshold: int = default_week_promotion_threshold
+    quarter_promotion_threshold: int = default_quarter_promotion_threshold
     if disable_scope_collapse:
         week_promotion_threshold = 0
         quarter_promotion_threshold = 0
@@ -271,3 +426,28 @@ def notes_json_tree(
         ns.add_everything()
 
     return ns.scope_tree
+
+
+def iter_notes_json_tree(
+        db_session: Session,
+        domain_ids: Iterable[Markup | str],
+        scope_ids: Iterable[Markup | str],
+) -> Iterator[Tuple[TimeScope, Dict]]:
+    """
+    Same as `notes_json_tree()`, but yields (quarter scope, partial quarter tree) pairs, latest first
+
+    Busy quarters come out a week at a time, so the notes page can stream sections
+    before every note has been loaded. Merging the partial trees gives `notes_json_tree()`.
+    """
+    logger.debug(f"Stapling (streamed): {domain_ids} x {scope_ids}")
+    ns = NoteStapler(
+        db_session,
+        domain_ids,
+        default_week_promotion_threshold,
+        default_quarter_promotion_threshold,
+    )
+
+    if scope_ids:
+        yield from ns.iter_by_scopes(TimeScope(scope_id) for scope_id in scope_ids)
+    else:
+        yield from ns.iter_everything()
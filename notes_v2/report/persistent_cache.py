@@ -0,0 +1,145 @@
+import hashlib
+import logging
+import pickle
+import time
+from typing import Any, Dict, Hashable, Tuple
+
+from sqlalchemy import Column, Float, Index, Integer, LargeBinary, String, delete, func, insert, select
+from sqlalchemy.orm import declarative_base
+
+from util.database import create_sqlite_engine
+
+CacheBase = declarative_base()
+
+default_persistent_cache_max_bytes = 2 * 1024 * 1024 * 1024
+"Override with the `RENDER_CACHE_DISK_MAX_BYTES` Flask config"
+
+logger = logging.getLogger('n2.cache')
+
+
+class RenderCacheEntry(CacheBase):
+    __tablename__ = 'RenderCache'
+
+    cache_key = Column(String, primary_key=True, nullable=False)
+    "sha256 of the `repr()` of the (data version, key) pair"
+    value = Column(LargeBinary, nullable=False)
+    size_bytes = Column(Integer, nullable=False)
+    created_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("render-cache-age-index", 'created_at'),
+    )
+
+
+class PersistentRenderCache:
+    """
+    Render cache entries in their own SQLite file, shared by every worker process
+
+    This lives outside notes-v2.db, so cache writes don't trigger the dev server's
+    reload-on-DB-change. Entries are pickled, and keyed by the notes data version,
+    so they survive restarts but go unused once the notes change.
+
+    Data versions are per-scope, so there's no single "current" version to prune against;
+    stale entries just age out. Pruning is oldest-first rather than LRU, so reads never need to write.
+    """
+    def __init__(
+            self,
+            db_path: str,
+            max_bytes: int = default_persistent_cache_max_bytes,
+            prune_interval: int = 100,
+    ):
+        self.engine = create_sqlite_engine(db_path)
+        CacheBase.metadata.create_all(bind=self.engine)
+
+        self.max_bytes = max_bytes
+        self.prune_interval = prune_interval
+        self._puts_since_prune = 0
+
+    @staticmethod
+    def _hash_key(data_version: Hashable, key: Hashable) -> str:
+        return hashlib.sha256(repr((data_version, key)).encode('utf-8')).hexdigest()
+
+    def get(self, data_version: Hashable, key: Hashable) -> Tuple[bool, Any]:
+        with self.engine.connect() as conn:
+            pickled_value = conn.execute(
+                select(RenderCacheEntry.value)
+                .where(RenderCacheEntry.cache_key == self._hash_key(data_version, key))
+            ).scalar_one_or_none()
+
+        if pickled_value is None:
+            return False, None
+
+        try:
+            return True, pickle.loads(pickled_value)
+        except Exception as e:
+            logger.warning(f"Couldn't unpickle persistent cache entry for {key}: {e}")
+            return False, None
+
+    def put(self, data_version: Hashable, key: Hashable, value: Any) -> None:
+        try:
+            pickled_value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            logger.debug(f"Not persisting unpicklable cache entry for {key}: {e}")
+            return
+
+        if len(pickled_value) > self.max_bytes:
+            return
+
+        with self.engine.begin() as conn:
+            conn.execute(
+                insert(RenderCacheEntry).prefix_with('OR REPLACE'),
+                {
+                    'cache_key': self._hash_key(data_version, key),
+                    'value': pickled_value,
+                    'size_bytes': len(pickled_value),
+                    'created_at': time.time(),
+                },
+            )
+
+        self._puts_since_prune += 1
+        if self._puts_since_prune >= self.prune_interval:
+            self.prune()
+
+    def prune(self) -> None:
+        """
+        Drop the oldest entries until we're under `max_bytes`
+        """
+        self._puts_since_prune = 0
+
+        with self.engine.begin() as conn:
+            total_bytes = conn.execute(select(func.coalesce(func.sum(RenderCacheEntry.size_bytes), 0))).scalar()
+            if total_bytes <= self.max_bytes:
+                return
+
+            bytes_to_free = total_bytes - self.max_bytes
+            oldest_entries = conn.execute(
+                select(RenderCacheEntry.cache_key, RenderCacheEntry.size_bytes)
+                .order_by(RenderCacheEntry.created_at.asc())
+            ).all()
+
+            expired_keys = []
+            for cache_key, size_bytes in oldest_entries:
+                if bytes_to_free <= 0:
+                    break
+
+                expired_keys.append(cache_key)
+                bytes_to_free -= size_bytes
+
+            for chunk_start in range(0, len(expired_keys), 500):
+                conn.execute(
+                    delete(RenderCacheEntry)
+                    .where(RenderCacheEntry.cache_key.in_(expired_keys[chunk_start:chunk_start + 500]))
+                )
+
+    def stats(self) -> Dict:
+        with self.engine.connect() as conn:
+            entries, size_bytes = conn.execute(
+                select(func.count(), func.coalesce(func.sum(RenderCacheEntry.size_bytes), 0))
+                .select_from(RenderCacheEntry)
+            ).one()
+
+        return {
+            'entries': entries,
+            'size_bytes': size_bytes,
+            'max_bytes': self.max_bytes,
+        }
@@ -0,0 +1,130 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from notes_v2.models import DomainStats
+from .render_utils import _domain_hue, current_data_version
+
+_rarity_index_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class DomainRarityIndex:
+    """
+    In-memory copy of `DomainStats.rarity_bucket`, for picking the rarest domain on a note
+
+    Built once per data version (see `get_rarity_index()`), so rendering never needs
+    a per-note query. Only buckets get read, so pages stay valid until one of them changes
+    (see `notes_v2.models.RARITY_GENERATION_KEY`).
+    """
+    data_version: int
+    rarity_buckets: Dict[str, int] = field(default_factory=dict)
+
+    @staticmethod
+    def load(db_session: Session, data_version: int) -> 'DomainRarityIndex':
+        return DomainRarityIndex(
+            data_version=data_version,
+            rarity_buckets=dict(db_session.execute(
+                select(DomainStats.domain_id, DomainStats.rarity_bucket)
+            ).all()),
+        )
+
+    def rarity_bucket(self, domain_id: str) -> int:
+        """
+        Domains without stats get a bucket of -1, so they still sort first.
+        """
+        return self.rarity_buckets.get(domain_id, -1)
+
+    def sorted_by_rarity(self, domain_ids: Iterable[str]) -> List[str]:
+        return sorted(domain_ids, key=lambda d: (self.rarity_bucket(d), d))
+
+    def rarest_domain(self, domain_ids: Iterable[str]) -> Tuple[str, int] | None:
+        """
+        Rarest domain that has stats, along with its rarity bucket
+        """
+        known_domains = [(self.rarity_buckets[d], d) for d in domain_ids if d in self.rarity_buckets]
+        if not known_domains:
+            return None
+
+        rarity_bucket, domain_id = min(known_domains)
+        return domain_id, rarity_bucket
+
+
+def get_rarity_index(db_session: Session) -> DomainRarityIndex:
+    data_version = current_data_version()
+
+    rarity_index = getattr(current_app, 'domain_rarity_index', None)
+    if rarity_index is not None and rarity_index.data_version == data_version:
+        return rarity_index
+
+    with _rarity_index_lock:
+        rarity_index = getattr(current_app, 'domain_rarity_index', None)
+        if rarity_index is None or rarity_index.data_version != data_version:
+            rarity_index = DomainRarityIndex.load(db_session, data_version)
+            current_app.domain_rarity_index = rarity_index
+
+    return rarity_index
+
+
+plain_dot_opacity = 0.2
+
+
+def dot_appearance(
+        rarity_index: DomainRarityIndex,
+        focus_domain_ids: Tuple[str],
+        note_domain_ids: Iterable[str],
+        detailed_desc_length: int,
+) -> Tuple[float, str | None, float]:
+    """
+    Size and color a note's dot by its rarest domain, or by its length for long notes
+
+    Returns the dot radius, the domain to color it by (`None` for a plain gray dot), and its opacity.
+    """
+    note_domain_ids = list(note_domain_ids)
+    if not detailed_desc_length and not note_domain_ids:
+        return 8, None, plain_dot_opacity
+
+    # Use the rarest domain, and figure out how big to make the dot
+    rarest_domain = rarity_index.rarest_domain(note_domain_ids)
+    if rarest_domain is None:
+        # Domain stats haven't been refreshed for this note yet, so just render it plainly
+        return 8, None, plain_dot_opacity
+
+    domain_id0, rarity_bucket = rarest_domain
+
+    # Do an initial estimate of dot size based on note length
+    if detailed_desc_length > 1_000:
+        dot_radius = min(40, detailed_desc_length / 200)
+        dot_opacity = min(0.6, max(0.2, 1.0 - detailed_desc_length / 8_000))
+
+    # Otherwise, shrink the dot by a pixel every time the domain's note count doubles
+    else:
+        dot_radius = max(2, 14 - rarity_bucket)
+        dot_opacity = 0.3
+
+    # Make in-focus domains a little more consistent
+    if domain_id0 in focus_domain_ids:
+        dot_radius = min(40, dot_radius + 6)
+
+    return dot_radius, domain_id0, dot_opacity
+
+
+def dot_radius_and_styling(
+        rarity_index: DomainRarityIndex,
+        focus_domain_ids: Tuple[str],
+        note_domain_ids: Iterable[str],
+        detailed_desc_length: int,
+) -> Tuple[float, str]:
+    """
+    `dot_appearance()`, with the color written out as an inline style
+    """
+    dot_radius, color_domain_id, dot_opacity = \
+        dot_appearance(rarity_index, focus_domain_ids, note_domain_ids, detailed_desc_length)
+    if color_domain_id is None:
+        return dot_radius, f'style="fill: rgba(0, 0, 0, 0.2);"'
+
+    return dot_radius, f'style="fill: hsl({_domain_hue(color_domain_id)}, 80%, 40%); fill-opacity: {dot_opacity:.2f}"'
@@ -1,73 +1,111 @@
-import functools
+import gzip
 import itertools
 from datetime import datetime, timedelta
-from typing import Iterable, Tuple
+from typing import Dict, Iterable, Tuple
 
-from flask import Response, current_app
+from flask import Response, current_app, request
 from markupsafe import escape
-from sqlalchemy import func, select
 from sqlalchemy.orm import Session
 
-from notes_v2.models import Note, NoteDomain
+from notes_v2.models import Note
 from notes_v2.report.gather import notes_json_tree
 from util import TimeScope
-from .render_utils import max_cache_size, _domain_hue, cache
+from .rarity import DomainRarityIndex, dot_appearance, dot_radius_and_styling, get_rarity_index
+from .render_utils import _domain_hue_index, _hue_index_to_hue, cache
 
 default_dot_render_offset = 0
 
+day_svg_width = 960
+day_svg_height = 96
+week_svg_width = 1008
+week_svg_height = 480
+
+
+
+def compact_svg_output() -> bool:
+    """
+    Override with the `SVG_COMPACT_OUTPUT` Flask config
+    """
+    return current_app.config.get('SVG_COMPACT_OUTPUT', True)
+
+
+def _cached_svg_response(key, generate_fn, scopes) -> Response:
+    """
+    Cache SVG bodies gzip-compressed, and send them that way to any client that accepts it
+    """
+    gzipped_svg = cache(
+        key=key + ("gzip",),
+        generate_fn=lambda: gzip.compress(generate_fn().encode('utf-8'), mtime=0),
+        scopes=scopes,
+        persist=True)
+
+    if 'gzip' in request.accept_encodings:
+        response = Response(gzipped_svg, mimetype='image/svg+xml')
+        response.content_encoding = 'gzip'
+    else:
+        response = Response(gzip.decompress(gzipped_svg), mimetype='image/svg+xml')
+
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _compact_number(value: float) -> str:
+    """
+    Round SVG coordinates to one decimal place, and drop any trailing `.0`
+    """
+    return format(round(value, 1), 'g')
 
 
-@functools.lru_cache(maxsize=max_cache_size)
 def _dot_radius_and_styling(
-        db_session: Session,
+        rarity_index: DomainRarityIndex,
         domain_ids: Tuple[str],
         note: Note,
-) -> Tuple[str, str]:
-    if not note.detailed_desc and not note.get_domain_ids():
-        return 8, f'style="fill: rgba(0, 0, 0, 0.2);"'
-
-    # Use the rarest domain, and figure out how big to make the dot
-    domain_id0, note_count = db_session.execute(
-        select(NoteDomain.domain_id, func.count(NoteDomain.note_id))
-        .where(NoteDomain.domain_id.in_(list(note.get_domain_ids())))
-        .group_by(NoteDomain.domain_id)
-        .order_by(func.count(NoteDomain.note_id).asc())
-        .limit(1)
-    ).one()
-
-    # Do an initial estimate of dot size based on note length
-    if note.detailed_desc is not None and len(note.detailed_desc) > 1_000:
-        dot_radius = min(40, len(note.detailed_desc) / 200)
-        dot_opacity = min(0.6, max(0.2, 1.0 - len(note.detailed_desc) / 8_000))
-
-    # Otherwise, estimate the rarity of the domain
-    else:
-        # Check if we've cached a note count somewhere
-        if not hasattr(current_app, 'total_note_count'):
-            current_app.total_note_count = db_session.execute(
-                select(func.count(Note.note_id))
-            ).scalar()
+        compact_styles: Dict[str, str] | None = None,
+) -> Tuple[float, str]:
+    """
+    If `compact_styles` is provided, dots get a CSS class instead of an inline style,
+    and the class's rule is added to `compact_styles` (see `_compact_svg_style()`).
+    """
+    if compact_styles is None:
+        return dot_radius_and_styling(
+            rarity_index,
+            domain_ids,
+            note.get_domain_ids(),
+            len(note.detailed_desc or ''),
+        )
 
-        dot_radius_weight = 0.1 * current_app.total_note_count / note_count
-        dot_radius = min(14, dot_radius_weight + 2)
-        dot_opacity = 0.3
+    dot_radius, color_domain_id, dot_opacity = dot_appearance(
+        rarity_index,
+        domain_ids,
+        note.get_domain_ids(),
+        len(note.detailed_desc or ''),
+    )
+    if color_domain_id is None:
+        css_class = 'n2-dot'
+        compact_styles[css_class] = 'fill:#000'
+    else:
+        hue_index = _domain_hue_index(color_domain_id)
+        css_class = f'n2-dot-h{hue_index}'
+        compact_styles[css_class] = f'fill:hsl({_hue_index_to_hue(hue_index)},80%,40%)'
 
-    # Make in-focus domains a little more consistent
-    if domain_id0 in domain_ids:
-        dot_radius = min(40, dot_radius + 6)
+    return round(dot_radius, 1), f'class="{css_class}" fill-opacity="{dot_opacity:.2f}"'
 
-    return dot_radius, f'style="fill: hsl({_domain_hue(domain_id0)}, 80%, 40%); fill-opacity: {dot_opacity:.2f}"'
 
+def _compact_svg_style(compact_styles: Dict[str, str]) -> str:
+    """
+    Class names are shared by every compact <svg>, so the rules are identical wherever they get repeated
+    """
+    if not compact_styles:
+        return ''
 
-# TODO: Investigate why this is a separate function
-def tooltip_cache(key, generate_fn):
-    if not hasattr(current_app, 'tooltip_cache_dict'):
-        current_app.tooltip_cache_dict = {}
+    return '<style>' + ''.join(
+        f'circle.{css_class}{{{rule}}}'
+        for css_class, rule in sorted(compact_styles.items())
+    ) + '</style>'
 
-    if key not in current_app.tooltip_cache_dict:
-        current_app.tooltip_cache_dict[key] = generate_fn()
 
-    return current_app.tooltip_cache_dict[key]
+def tooltip_cache(key, generate_fn):
+    return cache(key=("tooltip", key), generate_fn=generate_fn)
 
 
 def _domain_ids_tooltip(
@@ -78,23 +116,12 @@ def _domain_ids_tooltip(
     """
     Returns a formatted list of domain_ids, suitable for an `svg * > title`
     """
-    def sort_domain_ids(domain_ids: Tuple[str]):
-        sorted_domain_rows = db_session.execute(
-            select(NoteDomain.domain_id)
-            .where(NoteDomain.domain_id.in_(domain_ids))
-            .group_by(NoteDomain.domain_id)
-            .order_by(func.count(NoteDomain.note_id).asc())
-        ).all()
-
-        for (domain_id,) in sorted_domain_rows:
-            yield domain_id
-
     domain_ids = tuple(sorted(note.get_domain_ids()))
     if not do_sort_domain_ids:
         return escape('\n'.join(domain_ids)) or "[no domains]"
 
     def generate_fn():
-        sorted_domains = sort_domain_ids(domain_ids)
+        sorted_domains = get_rarity_index(db_session).sorted_by_rarity(domain_ids)
         return escape('\n'.join(sorted_domains)) or "[no domains]"
 
     return tooltip_cache(domain_ids, generate_fn)
@@ -105,9 +132,10 @@ def render_day_svg(
     domains: Tuple[str],
     day_scope_id: str,
     day_notes,
-    svg_width: int = 960,
+    svg_width: int = day_svg_width,
     initial_indent_str: str = ' ' * 4,
     additional_indent_str: str = '  ',
+    compact: bool = False,
 ) -> str:
     """
     Valid timezones range from -12 to +14 or so (historical data gets worse),
@@ -118,12 +146,29 @@ def render_day_svg(
 
     - height is 96 because it's close to 100, and a multiple of 6 (hours are split into six segments)
     - hour lines are between 0.40 and 0.60 of this
+
+    `compact` output styles dots with CSS classes, draws the hour lines as `<use>`s
+    of one shared line, and rounds coordinates to one decimal place. The shared line's id
+    includes the scope, so it stays unique when several SVGs end up in one document.
     """
     start_time = datetime.strptime(day_scope_id, '%G-ww%V.%u') + timedelta(hours=-12)
     width_factor = svg_width / (48 * 60 * 60)
-    height_factor = 96
+    rarity_index = get_rarity_index(db_session)
+    height_factor = day_svg_height
+    compact_styles: Dict[str, str] | None = {} if compact else None
+    tick_id = f'n2-day-tick-{day_scope_id}'
 
     def draw_hour_lines() -> Iterable[str]:
+        if compact:
+            yield (
+                f'<defs><line id="{tick_id}" '
+                f'y1="{_compact_number(0.4 * height_factor)}" y2="{_compact_number(0.6 * height_factor)}" '
+                'stroke="black" opacity="0.1" /></defs>'
+            )
+            for hour in range(1, 48):
+                yield f'<use href="#{tick_id}" x="{_compact_number(svg_width * hour / 48)}" />'
+            return
+
         # draw the hour lines on top
         for hour in range(1, 48):
             yield (
@@ -135,6 +180,10 @@ def render_day_svg(
 
     # the overall day boundaries + text label(s)
     def draw_other_elements() -> Iterable[str]:
+        if compact:
+            yield from draw_compact_other_elements()
+            return
+
         yield (
             '<line '
             f'x1="{svg_width * 1 / 4}" y1="{0.15 * height_factor:.3f}" '
@@ -156,6 +205,23 @@ def render_day_svg(
             f'{(start_time + timedelta(hours=36)).strftime("ww%V.%u")}</text>'
         )
 
+    def draw_compact_other_elements() -> Iterable[str]:
+        for x in (svg_width * 1 / 4, svg_width * 3 / 4):
+            yield (
+                f'<line x1="{_compact_number(x)}" y1="{_compact_number(0.15 * height_factor)}" '
+                f'x2="{_compact_number(x)}" y2="{_compact_number(0.85 * height_factor)}" stroke="black" />'
+            )
+        yield (
+            f'<text x="{_compact_number(svg_width / 2)}" y="{_compact_number(0.85 * height_factor)}" '
+            'text-anchor="middle" opacity="0.5" style="font-size: 12px">'
+            f'{(start_time + timedelta(hours=12)).strftime("%G-ww%V.%u-%b-%d")}</text>'
+        )
+        yield (
+            f'<text x="{svg_width}" y="{_compact_number(0.85 * height_factor)}" '
+            'text-anchor="end" opacity="0.5" style="font-size: 12px">'
+            f'{(start_time + timedelta(hours=36)).strftime("ww%V.%u")}</text>'
+        )
+
     # and the actual note circles
     def draw_note_dots(render_if_missing_time: bool = True) -> Iterable[str]:
         for note in day_notes:
@@ -166,17 +232,32 @@ def render_day_svg(
             else:
                 continue
 
-            dot_radius, dot_styling = _dot_radius_and_styling(db_session, domains, note)
+            dot_radius, dot_styling = _dot_radius_and_styling(rarity_index, domains, note, compact_styles)
             hour_offset = seconds_offset % 3600
+            dot_x = (seconds_offset - hour_offset + 1800) * width_factor
+            dot_y = hour_offset / 3600 * height_factor
+
+            if compact:
+                yield '<circle cx="{}" cy="{}" r="{}" {}><title>{}</title></circle>'.format(
+                    _compact_number(dot_x),
+                    _compact_number(dot_y),
+                    _compact_number(dot_radius),
+                    dot_styling,
+                    _domain_ids_tooltip(db_session, note),
+                )
+                continue
 
             yield '''<circle cx="{:.3f}" cy="{:.3f}" r="{}" {}><title>{}</title></circle>'''.format(
-                (seconds_offset - hour_offset + 1800) * width_factor,
-                hour_offset / 3600 * height_factor,
+                dot_x,
+                dot_y,
                 dot_radius,
                 dot_styling,
                 _domain_ids_tooltip(db_session, note),
             )
 
+    # Render the dots first, so we know which styles they need
+    note_dots = list(draw_note_dots())
+
     return (
         '<svg xmlns="http://www.w3.org/2000/svg" '
         f'id="{day_scope_id}" '
@@ -185,9 +266,10 @@ def render_day_svg(
         + ('\n' + initial_indent_str + additional_indent_str).join(
             itertools.chain(
                 [''],
+                [_compact_svg_style(compact_styles)] if compact_styles else [],
                 draw_hour_lines(),
                 draw_other_elements(),
-                draw_note_dots(),
+                note_dots,
             ))
         + '\n' + initial_indent_str + '</svg>'
     )
@@ -199,25 +281,27 @@ def standalone_render_day_svg(
         day_scope: str,
         disable_caching: bool,
 ):
-    notes_tree = notes_json_tree(
-        db_session,
-        domain_ids,
-        [day_scope],
-    )
-    quarter_notes = notes_tree[day_scope.parent_quarter]
-    week_notes = quarter_notes[day_scope.parent_week]
-    day_notes = week_notes[day_scope]
+    compact = compact_svg_output()
+
+    def generate_fn():
+        notes_tree = notes_json_tree(
+            db_session,
+            domain_ids,
+            [day_scope],
+        )
+        quarter_notes = notes_tree[day_scope.parent_quarter]
+        week_notes = quarter_notes[day_scope.parent_week]
+        day_notes = week_notes[day_scope]
+
+        return render_day_svg(db_session, domain_ids, day_scope, day_notes['notes'], compact=compact)
 
     if disable_caching:
-        svg_text = render_day_svg(db_session, domain_ids, day_scope, day_notes['notes'])
-        response = Response(svg_text, mimetype='image/svg+xml')
-        response.cache_control.max_age = 31536000
-        return response
+        return Response(generate_fn(), mimetype='image/svg+xml')
     else:
-        svg_text = cache(
-            key=("/svg.day cache entry", day_scope, domain_ids),
-            generate_fn=lambda: render_day_svg(db_session, domain_ids, day_scope, day_notes['notes']))
-        return Response(svg_text, mimetype='image/svg+xml')
+        return _cached_svg_response(
+            key=("/svg.day cache entry", day_scope, domain_ids, compact),
+            generate_fn=generate_fn,
+            scopes=[day_scope])
 
 def render_week_svg(
         db_session: Session,
@@ -226,12 +310,19 @@ def render_week_svg(
         notes_dict,
         initial_indent_str: str = ' ' * 4,
         additional_indent_str: str = '  ',
+        compact: bool = False,
 ) -> str:
     """
     Render data vertically, like a weekly calendar.
+
+    See `render_day_svg()` for `compact`; here, each day column's hour lines are `<use>`s of shared groups.
     """
     hours_before = 12
     hours_after = 12
+    rarity_index = get_rarity_index(db_session)
+    compact_styles: Dict[str, str] | None = {} if compact else None
+    early_hours_id = f'n2-week-early-hours-{week_scope_id}'
+    late_hours_id = f'n2-week-late-hours-{week_scope_id}'
     col_width = 108
     col_width_and_right_margin = col_width + 4
     row_height = 20
@@ -258,25 +349,70 @@ def render_week_svg(
                 row * row_height
             )
 
-    def draw_hour_lines() -> Iterable[str]:
-        # render the pre-monday, if needed
-        for row in range(24 - hours_before, 24):
-            yield _draw_hour_line(column=0, row=row)
+    def _draw_compact_hour_line(row, x_offset: float = 0) -> str:
+        half_width = 15 if row % 6 == 0 else 10
+        return '<line x1="{}" y1="{}" x2="{}" y2="{}" stroke="black" opacity="{}" />'.format(
+            _compact_number(x_offset + col_width / 2 - half_width),
+            row * row_height,
+            _compact_number(x_offset + col_width / 2 + half_width),
+            row * row_height,
+            "0.4" if row % 6 == 0 else "0.1",
+        )
+
+    def draw_compact_hour_lines() -> Iterable[str]:
+        """
+        Every column is some part of the same set of hour lines, so define them once,
+        split at `hours_before`, and translate them into each column
+        """
+        yield (
+            '<defs>'
+            f'<g id="{early_hours_id}">'
+            + ''.join(_draw_compact_hour_line(row) for row in range(1, 24 - hours_before))
+            + '</g>'
+            f'<g id="{late_hours_id}">'
+            + ''.join(_draw_compact_hour_line(row) for row in range(24 - hours_before, 24))
+            + '</g>'
+            '</defs>'
+        )
+
+        # render the pre-monday
+        yield f'<use href="#{late_hours_id}" />'
 
         # and now the "normal" days
         for column in range(1, 8):
-            for row in range(1, 24):
-                yield _draw_hour_line(column, row)
+            column_x = _compact_number(column * col_width_and_right_margin)
+            yield f'<use href="#{early_hours_id}" x="{column_x}" />'
+            yield f'<use href="#{late_hours_id}" x="{column_x}" />'
 
         # and the after-sunday
-        for row in range(1, hours_after + 1):
-            yield _draw_hour_line(column=8, row=row)
+        after_sunday_x = 8 * col_width_and_right_margin
+        yield f'<use href="#{early_hours_id}" x="{_compact_number(after_sunday_x)}" />'
+        for row in range(24 - hours_before, hours_after + 1):
+            yield _draw_compact_hour_line(row, x_offset=after_sunday_x)
+
+    def draw_hour_lines() -> Iterable[str]:
+        if compact:
+            yield from draw_compact_hour_lines()
+        else:
+            # render the pre-monday, if needed
+            for row in range(24 - hours_before, 24):
+                yield _draw_hour_line(column=0, row=row)
+
+            # and now the "normal" days
+            for column in range(1, 8):
+                for row in range(1, 24):
+                    yield _draw_hour_line(column, row)
+
+            # and the after-sunday
+            for row in range(1, hours_after + 1):
+                yield _draw_hour_line(column=8, row=row)
 
         # and text for the "normal" days
         for column in range(1, 8):
+            label_x = column * col_width_and_right_margin + col_width / 2
             day_label = (
                 '<text '
-                f'x="{column * col_width_and_right_margin + col_width / 2}" y="{24 * row_height - 8}" '
+                f'x="{_compact_number(label_x) if compact else label_x}" y="{24 * row_height - 8}" '
                 'text-anchor="middle" opacity="0.5" style="font-size: 10px">'
                 f'{week_scope_id[5:] + "." + str(column)}'
                 '</text>'
@@ -317,13 +453,25 @@ def render_week_svg(
             return None
 
         # calculate the sub-hour offset for the dot, scaled to include some margins on the hour-block
-        dot_radius, dot_styling = _dot_radius_and_styling(db_session, domains, note)
+        dot_radius, dot_styling = _dot_radius_and_styling(rarity_index, domains, note, compact_styles)
         dot_x_offset = (seconds_offset % (60 * 60)) / (60 * 60)
         dot_x_offset = dot_radius + dot_x_offset * (col_width - 2 * dot_radius)
+        dot_x = render_column * col_width_and_right_margin + dot_x_offset
+        dot_y = int(seconds_offset / (60 * 60)) * row_height + row_height / 2
+
+        if compact:
+            return '<circle cx="{}" cy="{}" r="{}" {} {}><title>{}</title></circle>'.format(
+                _compact_number(dot_x),
+                _compact_number(dot_y),
+                _compact_number(dot_radius),
+                dot_styling,
+                f'tracker-note-id="{note.note_id}"',
+                _domain_ids_tooltip(db_session, note),
+            )
 
         return '<circle cx="{:.3f}" cy="{:.3f}" r="{}" {} {}><title>{}</title></circle>'.format(
-            render_column * col_width_and_right_margin + dot_x_offset,
-            int(seconds_offset / (60 * 60)) * row_height + row_height / 2,
+            dot_x,
+            dot_y,
             dot_radius,
             dot_styling,
             f'tracker-note-id="{note.note_id}"',
@@ -339,10 +487,15 @@ def render_week_svg(
                 for note in day_dict['notes']:
                     yield _draw_note_dot(note)
 
+    # Render the dots first, so we know which styles they need
+    note_dots = [dot for dot in draw_note_dots() if dot is not None]
+
     return (
         '<svg xmlns="http://www.w3.org/2000/svg" '
         f'width="{9 * col_width_and_right_margin}px" '
         f'height="{24 * row_height}px">'
+        + (('\n' + initial_indent_str + additional_indent_str + _compact_svg_style(compact_styles))
+           if compact_styles else '')
         # Dump all background boxes into one group, because otherwise
         # there are so many that it slows down browser tools.
         + ('\n' + initial_indent_str + additional_indent_str)
@@ -351,29 +504,103 @@ def render_week_svg(
         )
         + ('\n' + initial_indent_str + additional_indent_str)
         + '<g group-id="note-dots">{}</g>'.format(
-            ('\n' + initial_indent_str + additional_indent_str).join(
-                (dot for dot in draw_note_dots() if dot is not None),
-            ))
+            ('\n' + initial_indent_str + additional_indent_str).join(note_dots))
         + '\n' + initial_indent_str + '</svg>'
     )
 
 
 def standalone_render_week_svg(db_session, domains, week_scope, disable_caching):
-    notes_tree = notes_json_tree(
-        db_session,
-        domains,
-        [week_scope],
-    )
-    quarter_notes = notes_tree[week_scope.parent_quarter]
-    week_notes = quarter_notes[week_scope]
+    compact = compact_svg_output()
+
+    def generate_fn():
+        notes_tree = notes_json_tree(
+            db_session,
+            domains,
+            [week_scope],
+        )
+        quarter_notes = notes_tree[week_scope.parent_quarter]
+        week_notes = quarter_notes[week_scope]
+
+        return render_week_svg(db_session, domains, week_scope, week_notes, compact=compact)
 
     if disable_caching:
-        svg_text = render_week_svg(db_session, domains, week_scope, week_notes)
-        response = Response(svg_text, mimetype='image/svg+xml')
-        response.cache_control.max_age = 31536000
-        return response
+        return Response(generate_fn(), mimetype='image/svg+xml')
     else:
-        svg_text = cache(
-            key=("/svg.week cache entry", week_scope, domains),
-            generate_fn=lambda: render_week_svg(db_session, domains, week_scope, week_notes))
-        return Response(svg_text, mimetype='image/svg+xml')
+        return _cached_svg_response(
+            key=("/svg.week cache entry", week_scope, domains, compact),
+            generate_fn=generate_fn,
+            scopes=[week_scope])
+
+
+def _as_symbol(symbol_id: str, width: int, height: int, svg_text: str) -> str:
+    return (
+        f'<symbol id="{symbol_id}" viewBox="0 0 {width} {height}">\n'
+        f'{svg_text}\n'
+        '</symbol>'
+    )
+
+
+def day_svg_symbol_id(day_scope: str) -> str:
+    return f'day-{day_scope}'
+
+
+def week_svg_symbol_id(week_scope: str) -> str:
+    return f'week-{week_scope}'
+
+
+def render_svg_sprite(
+        db_session: Session,
+        domains: Tuple[str],
+        scope_ids: Tuple[str],
+        compact: bool = False,
+) -> str:
+    """
+    Every day and week `<svg>` for a page, as `<symbol>`s in one document
+
+    This gathers notes once for the whole page, rather than once per `/svg.day` or
+    `/svg.week` request. Pages reference each symbol with `<use href="...#day-{scope}">`,
+    see `day_svg_symbol_id()`.
+    """
+    notes_tree = notes_json_tree(db_session, domains, scope_ids)
+
+    def render_symbols() -> Iterable[str]:
+        for quarter_dict in notes_tree.values():
+            for week_scope, week_dict in quarter_dict.items():
+                if week_scope == "notes":
+                    continue
+
+                # Matches the checks in notes/render.html
+                if len(week_dict) > 1 or week_dict["notes"]:
+                    yield _as_symbol(
+                        week_svg_symbol_id(week_scope),
+                        week_svg_width,
+                        week_svg_height,
+                        render_week_svg(db_session, domains, week_scope, week_dict, compact=compact))
+
+                for day_scope, day_dict in week_dict.items():
+                    if day_scope == "notes" or not day_dict["notes"]:
+                        continue
+
+                    yield _as_symbol(
+                        day_svg_symbol_id(day_scope),
+                        day_svg_width,
+                        day_svg_height,
+                        render_day_svg(db_session, domains, day_scope, day_dict["notes"], compact=compact))
+
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg">\n'
+        + '\n'.join(render_symbols())
+        + '\n</svg>'
+    )
+
+
+def standalone_render_svg_sprite(
+        db_session: Session,
+        domains: Tuple[str],
+        scope_ids: Tuple[str],
+):
+    compact = compact_svg_output()
+    return _cached_svg_response(
+        key=("/svg.sprite cache entry", domains, scope_ids, compact),
+        generate_fn=lambda: render_svg_sprite(db_session, domains, scope_ids, compact=compact),
+        scopes=scope_ids)
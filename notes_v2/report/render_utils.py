@@ -1,10 +1,22 @@
 import functools
 import hashlib
 import logging
-from typing import Tuple
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import date
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Tuple
 
-from flask import current_app
+from flask import Response, current_app, has_request_context, make_response, request
 from markupsafe import escape
+from sqlalchemy import select
+
+from notes_v2.models import DataGeneration, GLOBAL_GENERATION_KEY, RARITY_GENERATION_KEY, scope_generation_keys
+from util import TimeScope
+from .persistent_cache import PersistentRenderCache, default_persistent_cache_max_bytes
 
 max_cache_size = 25_000
 """
@@ -12,19 +24,37 @@ This is based on the number of notes in a query,
 where the query takes like 10+ seconds to render.
 """
 
+default_render_cache_max_bytes = 256 * 1024 * 1024
+"""
+Override with the `RENDER_CACHE_MAX_BYTES` Flask config.
+
+Sizes are estimates (see `_estimate_size()`), so treat this as approximate.
+"""
+
 logger = logging.getLogger('n2.cache')
 logger.setLevel(logging.INFO)
 
 
+domain_hue_count = 12
+
+
 @functools.lru_cache(maxsize=max_cache_size)
-def _domain_hue(d: str) -> str:
+def _domain_hue_index(d: str) -> int:
     domain_hash = hashlib.sha256(d.encode('utf-8')).hexdigest()
     domain_hash_int = int(domain_hash[0:4], 16)
 
-    color_h = (domain_hash_int % 12) * (256.0 / 12)
+    return domain_hash_int % domain_hue_count
+
+
+def _hue_index_to_hue(hue_index: int) -> str:
+    color_h = hue_index * (256.0 / domain_hue_count)
     return f"{color_h:.2f}"
 
 
+def _domain_hue(d: str) -> str:
+    return _hue_index_to_hue(_domain_hue_index(d))
+
+
 @functools.lru_cache(maxsize=max_cache_size)
 def domain_to_css_color(d: str) -> str:
     """
@@ -57,20 +87,337 @@ def _domain_to_html_link(
     }" style="{domain_to_css_color(domain_id)}">{domain_id}</a>'''
 
 
-def cache(key, generate_fn):
-    if not hasattr(current_app, 'cache_dict'):
-        current_app.cache_dict = {}
+def _estimate_size(value) -> int:
+    """
+    Rough in-memory size of a cached value, following containers one level at a time
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_estimate_size(v) for v in value)
+    elif isinstance(value, dict):
+        size += sum(_estimate_size(k) + _estimate_size(v) for k, v in value.items())
+
+    return size
+
+
+@dataclass
+class RenderCacheStats:
+    hits: int = 0
+    persistent_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+    entries: int = 0
+    size_bytes: int = 0
+    max_bytes: int = 0
+
+
+class RenderCache:
+    """
+    Size-bounded LRU cache for rendered HTML/SVG fragments
+
+    Entries are evicted least-recently-used first, once the estimated total size
+    goes over `max_bytes`. If `ttl_seconds` is set, entries older than that are
+    treated as misses.
+
+    `generate_fn` runs outside the lock, so two threads may occasionally render
+    the same entry; the later one wins.
+
+    If a `persistent_store` is provided, entries with a `data_version` and `persist=True`
+    are also read from and written to it, so other processes can share them.
+    """
+    def __init__(
+            self,
+            max_bytes: int,
+            ttl_seconds: float | None = None,
+            persistent_store: PersistentRenderCache | None = None,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.persistent_store = persistent_store
+
+        self._entries: OrderedDict[Hashable, Tuple[Any, int, float]] = OrderedDict()
+        "Maps from key to (value, size_bytes, created_at)"
+        self._lock = threading.Lock()
+        self._stats = RenderCacheStats(max_bytes=max_bytes)
+
+    def _lookup(self, key) -> Tuple[bool, Any]:
+        """
+        Must be called with `self._lock` held
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+
+        value, size_bytes, created_at = entry
+        if self.ttl_seconds is not None and time.monotonic() - created_at > self.ttl_seconds:
+            del self._entries[key]
+            self._stats.size_bytes -= size_bytes
+            self._stats.expirations += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        return True, value
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            found, _ = self._lookup(key)
+            return found
+
+    def get(self, key, default=None, data_version: Hashable | None = None, persist: bool = False):
+        memory_key = key if data_version is None else (data_version, key)
+        with self._lock:
+            found, value = self._lookup(memory_key)
+            if found:
+                self._stats.hits += 1
+                return value
+
+        if persist and self.persistent_store is not None and data_version is not None:
+            found, value = self.persistent_store.get(data_version, key)
+            if found:
+                self._put_in_memory(memory_key, value)
+                with self._lock:
+                    self._stats.persistent_hits += 1
+                return value
+
+        with self._lock:
+            self._stats.misses += 1
+        return default
+
+    def _put_in_memory(self, memory_key, value) -> None:
+        size_bytes = _estimate_size(value)
+        if size_bytes > self.max_bytes:
+            logger.info(f"not caching oversized entry ({size_bytes:_} bytes) with key: {memory_key}")
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(memory_key, None)
+            if old_entry is not None:
+                self._stats.size_bytes -= old_entry[1]
+
+            self._entries[memory_key] = (value, size_bytes, time.monotonic())
+            self._stats.size_bytes += size_bytes
+
+            while self._stats.size_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._stats.size_bytes -= evicted_size
+                self._stats.evictions += 1
+
+    def put(self, key, value, data_version: Hashable | None = None, persist: bool = False) -> None:
+        if data_version is None:
+            self._put_in_memory(key, value)
+            return
+
+        self._put_in_memory((data_version, key), value)
+        if persist and self.persistent_store is not None:
+            self.persistent_store.put(data_version, key, value)
+
+    def get_or_generate(
+            self,
+            key,
+            generate_fn: Callable[[], Any],
+            data_version: Hashable | None = None,
+            persist: bool = False,
+    ):
+        sentinel = object()
+        value = self.get(key, sentinel, data_version, persist)
+        if value is not sentinel:
+            logger.debug(f"reading cache entry with key: {key}")
+            return value
 
-    if key not in current_app.cache_dict:
         logger.info(f"adding cache entry with key: {key}")
-        current_app.cache_dict[key] = generate_fn()
+        value = generate_fn()
+        self.put(key, value, data_version, persist)
+        return value
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._stats = RenderCacheStats(max_bytes=self.max_bytes)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._stats.entries = len(self._entries)
+            response = asdict(self._stats)
+
+        if self.persistent_store is not None:
+            response['persistent'] = self.persistent_store.stats()
+
+        return response
+
+
+def get_render_cache() -> RenderCache:
+    """
+    One `RenderCache` per Flask app, configured by:
+
+    - `RENDER_CACHE_MAX_BYTES` and `RENDER_CACHE_TTL_SECONDS`, for the in-memory cache
+    - `RENDER_CACHE_PATH` and `RENDER_CACHE_DISK_MAX_BYTES`, for the cross-process SQLite cache.
+      Outside of tests, this defaults to `instance/render-cache.db`; set it to `''` to disable.
+    """
+    if not hasattr(current_app, 'render_cache'):
+        persistent_cache_path = current_app.config.get('RENDER_CACHE_PATH')
+        if persistent_cache_path is None and not current_app.config['TESTING']:
+            persistent_cache_path = os.path.join(current_app.instance_path, 'render-cache.db')
+
+        persistent_store = None
+        if persistent_cache_path:
+            persistent_store = PersistentRenderCache(
+                persistent_cache_path,
+                max_bytes=current_app.config.get('RENDER_CACHE_DISK_MAX_BYTES', default_persistent_cache_max_bytes),
+            )
+
+        current_app.render_cache = RenderCache(
+            max_bytes=current_app.config.get('RENDER_CACHE_MAX_BYTES', default_render_cache_max_bytes),
+            ttl_seconds=current_app.config.get('RENDER_CACHE_TTL_SECONDS'),
+            persistent_store=persistent_store,
+        )
+
+    return current_app.render_cache
+
+
+def current_data_version() -> int:
+    """
+    The global `DataGeneration` counter, read once per request so every entry on a page agrees
+    """
+    # NB Stored on the WSGI environ rather than `flask.g`, because `g` can outlive the request
+    if has_request_context() and 'n2.data_version' in request.environ:
+        return request.environ['n2.data_version']
+
+    data_version = DataGeneration.query.session.execute(
+        select(DataGeneration.generation)
+        .where(DataGeneration.generation_key == GLOBAL_GENERATION_KEY)
+    ).scalar_one_or_none() or 0
+
+    if has_request_context():
+        request.environ['n2.data_version'] = data_version
+
+    return data_version
+
+
+def scopes_data_version(scopes: Iterable[TimeScope | str]) -> Tuple:
+    """
+    Per-month `DataGeneration` counters covering every note that can render under `scopes`
+
+    Pages for past scopes keep their cache entries when only today's notes get edited.
+    Dot sizes and domain ordering come from the global rarity index, though, so the version
+    also changes whenever a domain's rarity bucket does, no matter which month caused it.
+    """
+    scope_keys = set(
+        key
+        for scope in scopes
+        for key in scope_generation_keys(TimeScope(scope))
+    )
+    if not scope_keys:
+        return GLOBAL_GENERATION_KEY, current_data_version()
+
+    generation_keys = sorted(scope_keys | {RARITY_GENERATION_KEY})
+
+    environ_key = 'n2.data_version:' + ','.join(generation_keys)
+    if has_request_context() and environ_key in request.environ:
+        return request.environ[environ_key]
+
+    generations = dict(DataGeneration.query.session.execute(
+        select(DataGeneration.generation_key, DataGeneration.generation)
+        .where(DataGeneration.generation_key.in_(generation_keys))
+    ).all())
+    data_version = tuple((key, generations.get(key, 0)) for key in generation_keys)
+
+    if has_request_context():
+        request.environ[environ_key] = data_version
+
+    return data_version
+
+
+def _data_version_for(scopes: Iterable[TimeScope | str] | None) -> Hashable:
+    if scopes is None:
+        return current_data_version()
+
+    return scopes_data_version(scopes)
+
+
+def cache(key, generate_fn, scopes: Iterable[TimeScope | str] | None = None, persist: bool = False):
+    """
+    If `scopes` are given, the entry is only invalidated by changes to notes near those scopes
+
+    Only whole page + SVG bodies should `persist`; small fragments (tooltips, links) stay in memory,
+    since a SQLite round trip for each one costs more than rendering it.
+    """
+    return get_render_cache().get_or_generate(key, generate_fn, _data_version_for(scopes), persist)
+
+
+def cache_get(key, default=None, scopes: Iterable[TimeScope | str] | None = None, persist: bool = False):
+    return get_render_cache().get(key, default, _data_version_for(scopes), persist)
+
+
+def data_version_etag(
+        scopes: Iterable[TimeScope | str] | None = None,
+        vary_by_date: bool = False,
+) -> str:
+    """
+    ETag for the current request, covering its path + arguments and the data version of `scopes`
+
+    Scoped versions include the rarity counter (see `scopes_data_version()`), so responses
+    whose dot sizes or domain order changed don't get a 304.
+    """
+    etag_key = (
+        _data_version_for(scopes),
+        request.path,
+        sorted(request.args.items(multi=True)),
+        'gzip' in request.accept_encodings,
+        date.today().isoformat() if vary_by_date else None,
+    )
+    return hashlib.sha256(repr(etag_key).encode('utf-8')).hexdigest()[:32]
+
+
+def _request_scopes(scope_ids: Iterable[str]) -> List[TimeScope] | None:
+    """
+    Parse scopes for `data_version_etag()`, or `None` (meaning, use the global data version) if any are invalid
+    """
+    scopes = []
+    for scope_id in scope_ids:
+        scope = TimeScope(scope_id)
+        try:
+            scope.validate()
+        except ValueError:
+            return None
+
+        scopes.append(scope)
+
+    return scopes
+
+
+def conditional_get(
+        scopes_fn: Callable[..., Iterable[str]] | None = None,
+        vary_by_date: bool = False,
+):
+    """
+    Answer If-None-Match with a 304 before the view does any work, and add an ETag to 200 responses
+
+    `scopes_fn` gets the view's arguments, and returns the scopes its response depends on.
+    Views that don't provide one use the global data version. Responses are marked
+    `no-cache`, so browsers keep them but revalidate every time.
+    """
+    def decorate(view_fn):
+        @functools.wraps(view_fn)
+        def conditional_view(*args, **kwargs):
+            scopes = _request_scopes(scopes_fn(*args, **kwargs)) if scopes_fn is not None else None
+            etag = data_version_etag(scopes, vary_by_date)
+
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view_fn(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.cache_control.no_cache = True
+            response.vary.add('Accept-Encoding')
+            return response
 
-        if len(current_app.cache_dict) % 1000 == 0:
-            logger.info(f"cache size has grown to {len(current_app.cache_dict)}")
-    else:
-        logger.debug(f"reading cache entry with key: {key}")
+        return conditional_view
 
-    return current_app.cache_dict[key]
+    return decorate
 
 
 def render_cache(func):
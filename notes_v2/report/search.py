@@ -0,0 +1,93 @@
+from dataclasses import dataclass
+from typing import List
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session, selectinload
+
+from notes_v2.models import NOTE_SEARCH_TABLE, Note
+
+default_page_size = 50
+
+
+@dataclass
+class SearchResults:
+    query: str
+    page: int
+    notes: List[Note]
+    has_next_page: bool
+
+    def as_json(self):
+        return {
+            'query': self.query,
+            'page': self.page,
+            'next_page': self.page + 1 if self.has_next_page else None,
+            'notes': [n.as_json(include_domains=True) for n in self.notes],
+        }
+
+
+def to_fts_query(user_query: str) -> str:
+    """
+    Quote every search term, so FTS5 query syntax in the user's text can't cause errors
+
+    Terms are implicitly AND'd, and a trailing `*` is kept as a prefix search.
+    """
+    fts_terms = []
+    for term in user_query.split():
+        is_prefix = term.endswith('*')
+        term = term.rstrip('*')
+        if not term:
+            continue
+
+        quoted_term = '"{}"'.format(term.replace('"', '""'))
+        fts_terms.append(quoted_term + ('*' if is_prefix else ''))
+
+    return ' '.join(fts_terms)
+
+
+def search(
+        db_session: Session,
+        user_query: str,
+        page: int = 1,
+        page_size: int = default_page_size,
+) -> SearchResults:
+    """
+    Ranked full-text search over `Note.desc` and `Note.detailed_desc`
+
+    Matches in `desc` are weighted more heavily, since that's the note's summary.
+    """
+    page = max(1, page)
+    fts_query = to_fts_query(user_query)
+    if not fts_query:
+        return SearchResults(user_query, page, [], False)
+
+    # Fetch one extra row, so we know whether there's another page
+    note_ids = db_session.execute(
+        text(f'SELECT rowid FROM "{NOTE_SEARCH_TABLE}" '
+             f'WHERE "{NOTE_SEARCH_TABLE}" MATCH :fts_query '
+             f'ORDER BY bm25("{NOTE_SEARCH_TABLE}", 4.0, 1.0) '
+             'LIMIT :limit OFFSET :offset'),
+        {
+            'fts_query': fts_query,
+            'limit': page_size + 1,
+            'offset': (page - 1) * page_size,
+        },
+    ).scalars().all()
+
+    has_next_page = len(note_ids) > page_size
+    note_ids = note_ids[:page_size]
+
+    notes_by_id = {
+        n.note_id: n
+        for n in db_session.execute(
+            select(Note)
+            .where(Note.note_id.in_(note_ids))
+            .options(selectinload(Note.domains))
+        ).scalars()
+    }
+
+    return SearchResults(
+        user_query,
+        page,
+        [notes_by_id[note_id] for note_id in note_ids if note_id in notes_by_id],
+        has_next_page,
+    )
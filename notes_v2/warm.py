@@ -0,0 +1,114 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Iterable, List, Tuple
+
+from flask import Flask, url_for
+from sqlalchemy.orm import Session
+
+from notes_v2.report import domains
+from util import TimeScope, TimeScopeBuilder
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@dataclass
+class WarmResult:
+    url: str
+    status_code: int
+    elapsed_seconds: float
+
+
+def recent_scopes(quarter_count: int, week_count: int, now: datetime | None = None) -> List[TimeScope]:
+    """
+    The current quarter and week, plus the ones before them, latest first
+    """
+    current_week = TimeScope((now or datetime.now()).strftime('%G-ww%V'))
+
+    scopes = []
+    quarter = current_week.parent_quarter
+    for _ in range(quarter_count):
+        scopes.append(quarter)
+        quarter = TimeScopeBuilder.prev_scope(quarter)
+
+    week = current_week
+    for _ in range(week_count):
+        scopes.append(week)
+        week = TimeScopeBuilder.prev_scope(week)
+
+    return scopes
+
+
+def top_domains(db_session: Session, domain_count: int) -> List[str]:
+    domain_stats = domains.stats(db_session)
+    return sorted(domain_stats, key=lambda d: (-domain_stats[d]["count"], d))[:domain_count]
+
+
+def warm_urls(scopes: Iterable[TimeScope], domain_ids: Iterable[str]) -> List[str]:
+    """
+    URLs for each scope's /notes page and SVG sprite, unfiltered and then for each domain
+
+    Must run in a request context, for `url_for()`.
+    """
+    domain_filters: List[Tuple[str, ...]] = [()] + [(d,) for d in domain_ids]
+
+    urls = []
+    for domain_filter in domain_filters:
+        for scope in scopes:
+            urls.append(url_for("notes-v2.do_render_matching_notes", scope=scope, domain=domain_filter))
+            urls.append(url_for("notes-v2.do_render_svg_sprite", scope=scope, domain=domain_filter))
+
+    return urls
+
+
+_worker_app: Flask | None = None
+
+
+def _init_worker(settings_overrides: Dict) -> None:
+    """
+    Runs in each spawned worker, which builds its own app (and database connections) from the parent's config
+    """
+    # Imported here, since `tracker.app` imports this module
+    from tracker.app import create_app
+
+    global _worker_app
+    _worker_app = create_app(settings_overrides)
+
+
+def _warm_url(url: str, app: Flask | None = None) -> WarmResult:
+    app = app or _worker_app
+
+    start_time = time.monotonic()
+    with app.test_client() as client:
+        response = client.get(url)
+        # Streamed pages only render as they're read
+        response.get_data()
+
+    return WarmResult(url, response.status_code, time.monotonic() - start_time)
+
+
+def warm_render_cache(app: Flask, urls: List[str], jobs: int) -> Iterable[WarmResult]:
+    """
+    Request every URL, so its rendered output lands in the persistent render cache
+
+    With more than one job, requests run in spawned worker processes. Forking a process
+    that holds SQLAlchemy pools and threads isn't safe (notably on macOS), so each worker
+    builds a fresh app with `create_app()` instead. That means workers only see databases
+    on disk, not e.g. the in-memory ones used by tests.
+    """
+    if jobs <= 1:
+        for url in urls:
+            yield _warm_url(url, app)
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(dict(app.config),),
+    ) as executor:
+        yield from executor.map(_warm_url, urls)
@@ -2,10 +2,11 @@ import os
 import sqlite3
 from typing import TypeAlias
 
-import sqlalchemy
+from sqlalchemy import event
 from sqlalchemy.orm import scoped_session, sessionmaker, Session
 
-from tasks.database_models import Base
+from tasks.database_models import Base, allocate_new_task_ids, sync_task_id_allocator
+from util.database import create_sqlite_engine
 
 TasksDB: TypeAlias = Session
 _db_session: TasksDB = None
@@ -98,20 +99,20 @@ def try_migrate_v2_models(
             )
 
 
-def load_database_models(db_path: str) -> None:
-    engine = sqlalchemy.create_engine(
-        'sqlite:///' + db_path,
-        connect_args={
-            "check_same_thread": False,
-        }
-    )
+def load_database_models(db_path: str, **engine_kwargs) -> None:
+    engine = create_sqlite_engine(db_path, **engine_kwargs)
 
     Base.metadata.create_all(bind=engine)
 
     # Create a Session object and bind it to the declarative_base
+    session_factory = sessionmaker(autocommit=False,
+                                   autoflush=False,
+                                   bind=engine)
+    event.listen(session_factory, 'before_flush', allocate_new_task_ids)
+
     global _db_session
-    _db_session = scoped_session(sessionmaker(autocommit=False,
-                                             autoflush=False,
-                                             bind=engine))
+    _db_session = scoped_session(session_factory)
 
     Base.query = _db_session.query_property()
+
+    sync_task_id_allocator(_db_session)
@@ -3,8 +3,9 @@ from datetime import datetime
 from typing import Dict, Iterable
 
 from markupsafe import escape
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, UniqueConstraint, Date, text
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, UniqueConstraint, Date, event, func, \
+    inspect, literal, select, update
+from sqlalchemy.orm import Session, relationship, declarative_base
 
 Base = declarative_base()
 
@@ -12,8 +13,8 @@ Base = declarative_base()
 class Task(Base):
     __tablename__ = 'Tasks'
 
-    task_id = Column(Integer, primary_key=True, nullable=False,
-                     default=text("IFNULL((SELECT MAX(task_id) FROM Tasks) + 1, 1)"))
+    # New tasks get an ID from `TaskIdAllocator` when they're flushed, see `allocate_new_task_ids()`
+    task_id = Column(Integer, primary_key=True, nullable=False)
     import_source = Column(String, primary_key=True, nullable=False, default='')
 
     desc = Column(String, nullable=False)
@@ -62,6 +63,11 @@ class Task(Base):
     def linkage_at(self, requested_scope_id: str, create_if_none: bool = True):
         requested_scope = datetime.strptime(requested_scope_id, '%G-ww%V.%u').date()
 
+        # Read-only lookups can use linkages that were already loaded, e.g. with `selectinload()`
+        if not create_if_none and 'linkages' not in inspect(self).unloaded:
+            matching_linkages = [tl for tl in self.linkages if tl.time_scope == requested_scope]
+            return matching_linkages[0] if matching_linkages else None
+
         linkage = (
             TaskLinkage.query
             .filter_by(
@@ -152,3 +158,81 @@ class TaskLinkage(Base):
                 response_dict[field] = getattr(self, field)
 
         return response_dict
+
+
+class TaskIdAllocator(Base):
+    """
+    Next unused `Task.task_id`, so new tasks don't need a `MAX(task_id)` scan
+
+    There's a single row, keyed by the table it hands out IDs for. Allocating is one
+    `UPDATE ... RETURNING` in the caller's transaction, so SQLite's write lock keeps two
+    writers from getting the same IDs, and rolled-back allocations get rolled back with their tasks.
+    """
+    __tablename__ = 'TaskIdAllocator'
+
+    table_name = Column(String, primary_key=True, nullable=False)
+    next_task_id = Column(Integer, nullable=False)
+
+
+def sync_task_id_allocator(session: Session) -> None:
+    """
+    Create the allocator row, or move it past any tasks that were written without it
+
+    Cheap enough to run on every startup, since `MAX(task_id)` can use the primary key index.
+    """
+    max_task_id_plus_one = select(func.coalesce(func.max(Task.task_id), 0) + 1).scalar_subquery()
+    session.execute(
+        TaskIdAllocator.__table__.insert().prefix_with('OR IGNORE')
+        .from_select(['table_name', 'next_task_id'], select(literal(Task.__tablename__), max_task_id_plus_one))
+    )
+    session.execute(
+        update(TaskIdAllocator)
+        .where(TaskIdAllocator.table_name == Task.__tablename__)
+        .values(next_task_id=func.max(TaskIdAllocator.next_task_id, max_task_id_plus_one))
+    )
+    session.commit()
+
+
+def allocate_task_ids(session: Session, count: int) -> range:
+    """
+    Reserve a block of `count` consecutive task IDs
+    """
+    next_task_id = session.execute(
+        update(TaskIdAllocator)
+        .where(TaskIdAllocator.table_name == Task.__tablename__)
+        .values(next_task_id=TaskIdAllocator.next_task_id + count)
+        .returning(TaskIdAllocator.next_task_id)
+    ).scalar_one()
+
+    return range(next_task_id - count, next_task_id)
+
+
+def _reserve_task_ids_through(session: Session, task_id: int) -> None:
+    session.execute(
+        update(TaskIdAllocator)
+        .where(TaskIdAllocator.table_name == Task.__tablename__)
+        .where(TaskIdAllocator.next_task_id <= task_id)
+        .values(next_task_id=task_id + 1)
+    )
+
+
+def allocate_new_task_ids(session, flush_context, instances) -> None:
+    """
+    Give new `Task`s IDs from `TaskIdAllocator`, one block per flush
+
+    Tasks that already have an ID (e.g. from an import) keep it, and move the allocator past it.
+    Registered as a `before_flush` listener on the tasks `sessionmaker` only, see `load_database_models()`.
+    """
+    new_tasks = [obj for obj in session.new if isinstance(obj, Task)]
+    if not new_tasks:
+        return
+
+    with session.no_autoflush:
+        explicit_task_ids = [t.task_id for t in new_tasks if t.task_id is not None]
+        if explicit_task_ids:
+            _reserve_task_ids_through(session, max(explicit_task_ids))
+
+        tasks_without_ids = [t for t in new_tasks if t.task_id is None]
+        if tasks_without_ids:
+            for t, task_id in zip(tasks_without_ids, allocate_task_ids(session, len(tasks_without_ids))):
+                t.task_id = task_id
@@ -7,6 +7,7 @@ from flask.cli import with_appcontext
 from tasks import import_export
 from tasks.database import load_database_models, try_migrate_v2_models
 from tasks.flask_routes import _register_endpoints, _register_rest_endpoints
+from util.database import sqlite_options_from_config
 
 
 def init_app(app: Flask) -> None:
@@ -19,7 +20,7 @@ def init_app(app: Flask) -> None:
         v2_db_path = os.path.abspath(os.path.join(app.instance_path, 'tasks-v2.db'))
         try_migrate_v2_models(db_path, v2_db_path)
 
-        load_database_models(db_path)
+        load_database_models(db_path, **sqlite_options_from_config(app.config))
         should_load_database_models = False
 
     _register_endpoints(app)
@@ -1,10 +1,9 @@
-import operator
 from collections import defaultdict
 from datetime import datetime, timedelta
 
 from flask import render_template, url_for
-from sqlalchemy import or_, select, and_
-from sqlalchemy.orm import Session
+from sqlalchemy import or_, select, and_, func
+from sqlalchemy.orm import Session, selectinload
 
 from tasks.database_models import Task, TaskLinkage
 from tasks.report.render import to_aio, make_renderer
@@ -61,91 +60,84 @@ def report_one_task(task_id, return_bare_dict=False):
 
 
 def generate_tasks_by_scope(db_session: Session, page_scope: TimeScope):
-    if page_scope.is_day:
-        scope = datetime.strptime(page_scope, "%G-ww%V.%u").date()
-        tasks = Task.query \
-            .join(TaskLinkage,
-                  and_(Task.task_id == TaskLinkage.task_id,
-                       Task.import_source == TaskLinkage.import_source)) \
-            .filter(TaskLinkage.time_scope == scope) \
-            .order_by(TaskLinkage.time_scope, Task.category) \
-            .all()
-
-        return {
-            page_scope: tasks,
-        }
-
-    if page_scope.is_week:
-        tasks_by_scope = {}
-
-        for day_scope_id in page_scope.children:
-            day_scope = datetime.strptime(day_scope_id, "%G-ww%V.%u").date()
-            tasks = Task.query \
-                .join(TaskLinkage,
-                      and_(Task.task_id == TaskLinkage.task_id,
-                           Task.import_source == TaskLinkage.import_source)) \
-                .filter(TaskLinkage.time_scope == day_scope) \
-                .order_by(TaskLinkage.time_scope, Task.category) \
-                .all()
+    """
+    Tasks with a linkage on each day of `page_scope`, as a dict of day scope => tasks
 
-            tasks_by_scope[day_scope_id] = tasks
+    Fetches the whole range in one query, with every task's linkages loaded in one more.
+    """
+    if not (page_scope.is_day or page_scope.is_week or page_scope.is_quarter):
+        raise ValueError(f"No idea how to handle {repr(page_scope)}")
 
-        return tasks_by_scope
+    tasks_by_scope = {}
+    current_day_start = page_scope.start
+    while current_day_start < page_scope.end:
+        tasks_by_scope[current_day_start.strftime("%G-ww%V.%u")] = []
+        current_day_start = current_day_start + timedelta(days=1)
 
-    if page_scope.is_quarter:
-        tasks_by_scope = {}
+    task_rows = db_session.execute(
+        select(Task, TaskLinkage.time_scope)
+        .join(TaskLinkage,
+              and_(Task.task_id == TaskLinkage.task_id,
+                   Task.import_source == TaskLinkage.import_source))
+        .filter(TaskLinkage.time_scope >= page_scope.start.date(),
+                TaskLinkage.time_scope < page_scope.end.date())
+        .order_by(TaskLinkage.time_scope, Task.category)
+        .options(selectinload(Task.linkages))
+    ).all()
 
-        current_day_start = page_scope.start
-        while current_day_start < page_scope.end:
-            tasks = Task.query \
-                .join(TaskLinkage,
-                      and_(Task.task_id == TaskLinkage.task_id,
-                           Task.import_source == TaskLinkage.import_source)) \
-                .filter(TaskLinkage.time_scope == current_day_start.date()) \
-                .order_by(TaskLinkage.time_scope, Task.category) \
-                .all()
-
-            tasks_by_scope[current_day_start.strftime("%G-ww%V.%u")] = tasks
-            current_day_start = current_day_start + timedelta(days=1)
+    for task, time_scope in task_rows:
+        tasks_by_scope[time_scope.strftime("%G-ww%V.%u")].append(task)
 
-        return tasks_by_scope
+    return tasks_by_scope
 
-    # otherwise, no idea
-    raise ValueError(f"No idea how to handle {repr(page_scope)}")
 
+def _select_tasks_by_recency(query_limiter):
+    """
+    Tasks matching `query_limiter`, sorted by their latest linkage, most recent first
 
-def fetch_tasks_by_domain(
-        db_session: Session,
-        query_limiter,
-):
-    # Fetch the final list of tasks; duplicate according to domain-ish splits.
-    tasks_by_domain = defaultdict(set)
+    Linkages get loaded for every task in one extra query, rather than lazy-loaded per task.
+    Tasks without any linkages sort last.
+    """
+    latest_linkages = (
+        select(
+            TaskLinkage.task_id,
+            TaskLinkage.import_source,
+            func.max(TaskLinkage.time_scope).label('latest_time_scope'),
+        )
+        .group_by(TaskLinkage.task_id, TaskLinkage.import_source)
+        .subquery()
+    )
 
     query = query_limiter(
         select(Task)
-        # TODO: Need to figure out a way to do time-sorting
-        .order_by(Task.category)
+        .outerjoin(latest_linkages,
+              and_(Task.task_id == latest_linkages.c.task_id,
+                   Task.import_source == latest_linkages.c.import_source))
     )
-    task_rows = db_session.execute(query).all()
+    # `query_limiter` may join every matching linkage, so collapse those back down to one row per task
+    return query \
+        .group_by(Task.task_id, Task.import_source) \
+        .order_by(latest_linkages.c.latest_time_scope.desc().nulls_last(), Task.task_id.desc()) \
+        .options(selectinload(Task.linkages))
 
-    for (task,) in task_rows:
-        for d in task.split_categories(default=''):
-            tasks_by_domain[d].add(task)
 
-    # Create a sorted version of this, for non-jumpy rendering.
-    # TODO: This should be doable with an SQLAlchemy-level sort.
-    sorted_tbd = {}
-    for domain in sorted(tasks_by_domain.keys()):
-        def sort_time(t: Task):
-            return (
-                max(map(operator.attrgetter('time_scope'), t.linkages)),
-                t.task_id,
-            )
+def fetch_tasks_by_domain(
+        db_session: Session,
+        query_limiter,
+):
+    # Fetch the final list of tasks; duplicate according to domain-ish splits.
+    tasks_by_domain = defaultdict(list)
 
-        tasks = list(tasks_by_domain[domain])
-        sorted_tbd[domain] = sorted(tasks, key=sort_time, reverse=True)
+    tasks = db_session.execute(_select_tasks_by_recency(query_limiter)).scalars()
+    for task in tasks:
+        for d in set(task.split_categories(default='')):
+            tasks_by_domain[d].append(task)
 
-    return sorted_tbd
+    # Sort domains too, for non-jumpy rendering.
+    return {
+        domain: tasks_by_domain[domain]
+        for domain in sorted(tasks_by_domain.keys())
+    }
 
 
 # NB the arguments are kinda weird and inconsistent because they're default-false
@@ -187,21 +179,7 @@ def edit_tasks_all(
                             TaskLinkage.created_at > recent_tasks_cutoff))
 
     if ignore_categories:
-        task_rows = db_session.execute(
-            query_limiter(select(Task)
-                          .group_by(Task.task_id, Task.import_source))
-        ).all()
-
-        def sort_time(t: Task):
-            """TODO: This should be doable with an SQLAlchemy-level sort."""
-            return (
-                max(map(operator.attrgetter('time_scope'), t.linkages)),
-                t.task_id,
-            )
-
-        tasks = [row[0] for row in task_rows]
-        sorted_tasks = sorted(tasks, key=sort_time, reverse=True)
-
+        sorted_tasks = db_session.execute(_select_tasks_by_recency(query_limiter)).scalars().all()
         render_kwargs['tasks_by_domain'] = {'': sorted_tasks}
 
     else:
@@ -214,7 +192,8 @@ def edit_tasks_all(
         return True
 
     todays_date = render_scope_dt.date()
-    render_kwargs['compute_task_render_info'] = make_renderer(db_session, todays_date, is_readonly_import_source)
+    render_kwargs['compute_task_render_info'] = make_renderer(
+        db_session, todays_date, is_readonly_import_source, query_limiter)
 
     render_kwargs['to_summary_html'] = to_summary_html
 
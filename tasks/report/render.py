@@ -1,9 +1,9 @@
 from dataclasses import dataclass
 from datetime import timedelta, date
-from typing import Iterable, Callable
+from typing import Callable, Dict, Iterable, Tuple
 
 from markupsafe import escape
-from sqlalchemy import exists
+from sqlalchemy import Select, and_, func, or_, select
 from sqlalchemy.orm import Session
 
 from tasks.database_models import TaskLinkage, Task
@@ -75,13 +75,14 @@ def make_renderer(
         db_session: Session,
         todays_date: date,
         is_readonly_import_source: Callable[[str], bool],
+        query_limiter: Callable[[Select], Select],
 ) -> Callable[[Task], TaskRenderInfo]:
     """
     Provides enough info for Jinja template to render the task
 
     Task "status" is complicated, in this case in UI terms.
-    To represent it cleanly, we perform an "expensive" calculation,
-    and expect the caller to cache these results.
+    To represent it cleanly, we look up every task's open linkages up front,
+    and cache the results per task.
 
     Inputs:
 
@@ -96,38 +97,68 @@ def make_renderer(
     - for multiple linkages:
       - if only one is open...
 
+    `query_limiter` is the same one used to select the page's tasks, so only those get looked up.
+
     Returns a function that returns a tuple of (scope to print, resolution to print, is future task)
     """
+    page_tasks = (
+        query_limiter(select(Task.task_id, Task.import_source))
+        .distinct()
+        .subquery()
+    )
+
+    # One aggregate query for the whole page: (task_id, import_source) => latest open time_scope.
+    # Tasks that aren't in here have every linkage resolved.
+    #
+    # NB a task only counts as open if some linkage has a NULL resolution,
+    # but once it's open, empty-string resolutions count as open too.
+    latest_open_scopes: Dict[Tuple[int, str], date] = {
+        (task_id, import_source): latest_open_scope
+        for task_id, import_source, latest_open_scope in db_session.execute(
+            select(TaskLinkage.task_id, TaskLinkage.import_source, func.max(TaskLinkage.time_scope))
+            .join(page_tasks,
+                  and_(TaskLinkage.task_id == page_tasks.c.task_id,
+                       TaskLinkage.import_source == page_tasks.c.import_source))
+            .where(or_(TaskLinkage.resolution.is_(None), TaskLinkage.resolution == ''))
+            .group_by(TaskLinkage.task_id, TaskLinkage.import_source)
+            .having(func.max(TaskLinkage.resolution.is_(None)))
+        )
+    }
+
+    # Templates can render the same task several times (once per category), so only compute it once.
+    # The renderer only lives for one page, so tasks can't change underneath it.
+    computed_info: Dict[Tuple[int, str], TaskRenderInfo] = {}
 
     def minimize_vs_today(printed_scope_id) -> str:
         todays_scope_id = todays_date.strftime("%G-ww%V.%u")
         return TimeScope(printed_scope_id).as_short_str(todays_scope_id)
 
     def _compute(t: Task) -> TaskRenderInfo:
-        open_linkages_exist = db_session.scalar(
-            exists()
-            .where(
-                TaskLinkage.task_id.is_(t.task_id),
-                TaskLinkage.import_source.is_(t.import_source),
-                TaskLinkage.resolution.is_(None),
-            )
-            .select()
-        )
+        latest_open_scope = latest_open_scopes.get((t.task_id, t.import_source))
         # If every linkage is closed, just return the "last" resolution
-        if not open_linkages_exist:
-            return TaskRenderInfo('', t.linkages[-1].resolution, False, is_readonly_import_source(t.import_source))
+        if latest_open_scope is None:
+            # Tasks with no linkages at all only get listed with `show_resolved`
+            last_resolution = t.linkages[-1].resolution if t.linkages else None
+            return TaskRenderInfo('', last_resolution, False, is_readonly_import_source(t.import_source))
 
         # By this point multiple linkages exist, but at least one is open
-        latest_open = [tl for tl in t.linkages if not tl.resolution][-1]
-        if latest_open.time_scope - todays_date > timedelta(days=3):
-            return TaskRenderInfo(minimize_vs_today(latest_open.time_scope_id), None, True,
+        latest_open_scope_id = latest_open_scope.strftime("%G-ww%V.%u")
+        if latest_open_scope - todays_date > timedelta(days=3):
+            return TaskRenderInfo(minimize_vs_today(latest_open_scope_id), None, True,
                                   is_readonly_import_source(t.import_source))
-        elif latest_open.time_scope > todays_date:
-            return TaskRenderInfo(minimize_vs_today(latest_open.time_scope_id), None, False,
+        elif latest_open_scope > todays_date:
+            return TaskRenderInfo(minimize_vs_today(latest_open_scope_id), None, False,
                                   is_readonly_import_source(t.import_source))
         else:
             # TODO: past-tasks are the only ones that get their scope shrunken
-            rendered_scope = render_scope(latest_open.time_scope, todays_date)
+            rendered_scope = render_scope(latest_open_scope, todays_date)
             return TaskRenderInfo(rendered_scope, None, False, is_readonly_import_source(t.import_source))
 
-    return _compute
+    def _compute_once(t: Task) -> TaskRenderInfo:
+        task_key = (t.task_id, t.import_source)
+        if task_key not in computed_info:
+            computed_info[task_key] = _compute(t)
+
+        return computed_info[task_key]
+
+    return _compute_once
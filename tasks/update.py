@@ -2,7 +2,7 @@ import logging
 from datetime import datetime
 
 from dateutil import parser
-from sqlalchemy import select
+from sqlalchemy import delete, select
 
 from tasks.database import TasksDB
 from tasks.database_models import Task, TaskLinkage
@@ -128,8 +128,16 @@ def update_task(session: TasksDB, task_id, form_data):
     session.add(task)
     session.flush()
 
-    # Update the entire set of linkages, and ensure they match the ones stored in Task
-    existing_tls = {tl.time_scope: tl for tl in task.linkages}
+    # Update the entire set of linkages, and ensure they match the ones stored in Task.
+    # Everything gets diffed against this one load, rather than looking up each linkage separately.
+    # NB this uses the original `import_source`, since `task.linkages` follows the one that just got flushed.
+    existing_tls = {
+        tl.time_scope: tl
+        for tl in session.execute(
+            select(TaskLinkage)
+            .filter_by(task_id=task_id, import_source=original_import_source)
+        ).scalars()
+    }
 
     # Key on `-time_scope_id` to identify valid linkages
     form_tl_ids = [key[3:-14] for (key, value) in form_data.items(multi=True) if key[-14:] == "-time_scope_id"]
@@ -141,30 +149,33 @@ def update_task(session: TasksDB, task_id, form_data):
 
         raise ValueError(f"Found several TaskLinkages with duplicate time_scope_id's, erroring: {duplicate_tl_times}")
 
+    new_tls = []
     for form_tl_id in form_tl_ids:
         tl_ts_raw = form_data[f'tl-{form_tl_id}-time_scope_id']
         tl_ts = datetime.strptime(tl_ts_raw, '%G-ww%V.%u').date()
 
-        # Check if TL even exists
-        tl: TaskLinkage = TaskLinkage.query \
-            .filter_by(task_id=task_id, import_source=original_import_source, time_scope=tl_ts) \
-            .one_or_none()
+        tl: TaskLinkage | None = existing_tls.pop(tl_ts, None)
         if not tl:
             tl = TaskLinkage(task_id=task_id, import_source=original_import_source, time_scope=tl_ts)
+            new_tls.append(tl)
             logger.debug(f"Constructing new TaskLinkage: {tl}")
         else:
-            existing_tls[tl_ts] = tl
             logger.debug(f"Has existing TaskLinkage: {tl}")
 
+        # Changes to existing linkages get batched into UPDATEs by the flush
         _update_linkage_only(tl, form_tl_id, form_data, task.import_source)
-        session.add(tl)
 
-        if tl_ts in existing_tls:
-            del existing_tls[tl_ts]
-        del tl
-
-    for tl in existing_tls.values():
-        session.delete(tl)
+    # Whatever's left over wasn't in the form, so delete it all in one statement
+    if existing_tls:
+        logger.debug(f"Deleting {len(existing_tls)} TaskLinkages: {list(existing_tls.values())}")
+        session.execute(
+            delete(TaskLinkage)
+            .where(TaskLinkage.task_id == task_id,
+                   TaskLinkage.import_source == original_import_source,
+                   TaskLinkage.time_scope.in_(list(existing_tls.keys())))
+        )
+
+    session.add_all(new_tls)
 
     # Done, commit everything
     session.commit()
@@ -1,4 +1,8 @@
+from contextlib import contextmanager
+from typing import Callable, Iterator, List
+
 import pytest
+from sqlalchemy import event
 from sqlalchemy.orm import Session
 
 import notes_v2
@@ -38,3 +42,33 @@ def tasks_db() -> Session:
     yield tasks.database.get_db()
     tasks.database.get_db().remove()
     tasks.database._db_session = None
+
+
+@pytest.fixture
+def count_statements():
+    """
+    Context manager that collects the SQL statements a session runs, for asserting query counts
+
+        with count_statements(tasks_db) as statements:
+            ...
+        assert len(statements) == 2
+    """
+    @contextmanager
+    def _count_statements(
+            db_session: Session,
+            matching: Callable[[str], bool] = lambda statement: True,
+    ) -> Iterator[List[str]]:
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            if matching(statement):
+                statements.append(statement)
+
+        engine = db_session.get_bind()
+        event.listen(engine, "before_cursor_execute", record_statement)
+        try:
+            yield statements
+        finally:
+            event.remove(engine, "before_cursor_execute", record_statement)
+
+    return _count_statements
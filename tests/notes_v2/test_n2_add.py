@@ -1,7 +1,9 @@
 import io
 
+import pytest
+
 from notes_v2.add import _special_tokenize, all_from_csv, all_to_csv
-from notes_v2.models import Note, NoteDomain
+from notes_v2.models import DomainScopeCounts, DomainStats, Note, NoteDomain
 
 
 def test_tokenize_simple():
@@ -158,3 +160,114 @@ with regular LF-only newline",unniecode ❲😎😎😎❳,domains: no & domains
         assert output_stringio.getvalue() == note_id_annotated_version.getvalue()
         input_string = output_stringio.getvalue()
 
+
+
+def test_domain_stats_maintained(note_v2_session):
+    csv_test_file = """\
+time_scope_id,sort_time,desc,domains
+2021-ww31.6,,first,shared & rare
+2021-ww33.1,2021-08-16 09:00:00,second,shared
+2021—Q3,,quarterly,shared
+"""
+    all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=False)
+
+    shared_stats = DomainStats.query.filter_by(domain_id='shared').one()
+    assert shared_stats.note_count == 3
+    assert shared_stats.earliest_time_scope_id == '2021-ww31.6'
+    assert shared_stats.latest_time_scope_id == '2021-ww33.1'
+    assert str(shared_stats.latest_sort_time) == '2021-08-16 09:00:00'
+
+    assert DomainStats.query.filter_by(domain_id='rare').one().note_count == 1
+
+    update_csv_file = """\
+time_scope_id,desc,domains
+2021-ww34.2,third,rare
+"""
+    all_from_csv(note_v2_session, io.StringIO(update_csv_file), expect_duplicates=True)
+
+    rare_stats = DomainStats.query.filter_by(domain_id='rare').one()
+    assert rare_stats.note_count == 2
+    assert rare_stats.rarity_bucket == 1
+    assert rare_stats.latest_time_scope_id == '2021-ww34.2'
+    assert DomainStats.query.filter_by(domain_id='shared').one().note_count == 3
+
+
+def test_domain_scope_counts_maintained(note_v2_session):
+    csv_test_file = """\
+time_scope_id,desc,domains
+2021-ww31.6,first,shared & rare
+2021-ww31.6,second,shared
+2021-ww33,weekly,shared
+"""
+    all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=False)
+
+    def counts_for(domain_id):
+        return {
+            c.time_scope_id: c.note_count
+            for c in DomainScopeCounts.query.filter_by(domain_id=domain_id).all()
+        }
+
+    assert counts_for('shared') == {'2021-ww31.6': 2, '2021-ww33': 1}
+    assert counts_for('rare') == {'2021-ww31.6': 1}
+
+    update_csv_file = """\
+time_scope_id,desc,domains
+2021-ww31.6,third,shared
+2021-ww35.1,fourth,shared
+"""
+    all_from_csv(note_v2_session, io.StringIO(update_csv_file), expect_duplicates=True)
+
+    assert counts_for('shared') == {'2021-ww31.6': 3, '2021-ww33': 1, '2021-ww35.1': 1}
+    assert counts_for('rare') == {'2021-ww31.6': 1}
+
+
+@pytest.mark.parametrize('bulk', [False, True])
+def test_import_results_match(note_v2_session, bulk):
+    csv_test_file = """\
+time_scope_id,sort_time,desc,metadata,domains
+2021-ww31.6,,first,- source: a,shared & rare
+2021-ww31.6,2021-08-07 10:00:00,second,,shared
+2021-ww31.7,not a date,broken,,shared
+2021-ww33,,weekly,,
+"""
+    result = all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=False, bulk=bulk)
+    assert (result.import_succeeded, result.import_failed_parser_error) == (3, 1)
+
+    update_csv_file = """\
+time_scope_id,sort_time,desc,metadata,domains
+2021-ww31.6,,first,- source: a,shared & new
+2021-ww31.6,2021-08-07 10:00:00,second,,shared
+2021-ww31.6,2021-08-07 10:00:00,second,,shared
+2021-ww32.1,,third,,new
+,,,,todo
+2021-ww32.1,,,,
+"""
+    result = all_from_csv(note_v2_session, io.StringIO(update_csv_file), expect_duplicates=True, bulk=bulk)
+    assert result.import_succeeded == 4
+    assert result.ignored_todo == 1
+    assert result.import_failed_integrity_error == 1
+
+    notes = {n.desc: n.get_domain_ids() for n in Note.query.all()}
+    assert notes == {
+        'first': ['new', 'rare', 'shared'],
+        'second': ['shared'],
+        'third': ['new'],
+        'weekly': [],
+    }
+    assert all(n.content_hash == n.compute_content_hash() for n in Note.query.all())
+    assert DomainStats.query.filter_by(domain_id='new').one().note_count == 2
+
+
+def test_to_csv_chunked(note_v2_session, count_statements):
+    csv_rows = ["created_at,sort_time,desc,detailed_desc,domains,time_scope_id,source,metadata"]
+    csv_rows.extend(f",,note {i},,chunk: {i % 3} & chunk: all,2021-ww31.{i % 7 + 1},," for i in range(25))
+    csv_test_file = "\n".join(csv_rows) + "\n"
+    all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=False)
+
+    with count_statements(note_v2_session) as statements:
+        outfile = io.StringIO()
+        all_to_csv(outfile, chunk_size=10)
+
+    assert outfile.getvalue() == csv_test_file
+    # Three chunks of notes plus their domains, then one empty chunk
+    assert len(statements) == 3 * 2 + 1
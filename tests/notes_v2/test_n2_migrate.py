@@ -0,0 +1,119 @@
+from sqlalchemy import text
+
+from notes_v2.migrate import migrate_models
+from notes_v2.models import Base, note_content_hash
+from util import TimeScope
+from util.database import create_sqlite_engine
+
+
+def test_add_scope_ordinals(tmp_path):
+    engine = create_sqlite_engine(str(tmp_path / 'notes-v2.db'))
+    with engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE "Notes-v2" ('
+            '    note_id INTEGER NOT NULL PRIMARY KEY,'
+            '    time_scope_id VARCHAR(20) NOT NULL,'
+            '    sort_time DATETIME,'
+            '    metadata VARCHAR,'
+            '    "desc" VARCHAR NOT NULL,'
+            '    detailed_desc VARCHAR,'
+            '    created_at DATETIME'
+            ')'))
+        conn.execute(text(
+            'INSERT INTO "Notes-v2" (time_scope_id, "desc") '
+            "VALUES ('2021-ww32.3', 'day'), ('2021—Q3', 'quarter')"))
+
+    Base.metadata.create_all(bind=engine)
+    migrate_models(engine)
+    # Running it a second time should be a no-op
+    migrate_models(engine)
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            'SELECT time_scope_id, scope_type, scope_start_ordinal FROM "Notes-v2" ORDER BY note_id'
+        )).all()
+
+    assert rows[0] == ('2021-ww32.3', TimeScope.Type.day.value, TimeScope('2021-ww32.3').start.toordinal())
+    assert rows[1][1] == TimeScope.Type.quarter.value
+
+
+def test_intern_note_domains(tmp_path):
+    engine = create_sqlite_engine(str(tmp_path / 'notes-v2.db'))
+    with engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE "NoteDomains-v2" ('
+            '    note_id INTEGER NOT NULL,'
+            '    domain_id VARCHAR NOT NULL,'
+            '    PRIMARY KEY (note_id, domain_id),'
+            '    UNIQUE (note_id, domain_id)'
+            ')'))
+        conn.execute(text('CREATE INDEX "domain-note-index" ON "NoteDomains-v2" (domain_id, note_id)'))
+        conn.execute(text(
+            'INSERT INTO "NoteDomains-v2" (note_id, domain_id) '
+            "VALUES (1, 'shared'), (1, 'only one'), (2, 'shared')"))
+
+    Base.metadata.create_all(bind=engine)
+    migrate_models(engine)
+    migrate_models(engine)
+
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            'SELECT nd.note_id, d.domain_id FROM "NoteDomains-v2" AS nd '
+            'JOIN "Domains-v2" AS d USING (domain_int) '
+            'ORDER BY nd.note_id, d.domain_id'
+        )).all()
+        domain_count = conn.execute(text('SELECT COUNT(*) FROM "Domains-v2"')).scalar()
+
+    assert rows == [(1, 'only one'), (1, 'shared'), (2, 'shared')]
+    assert domain_count == 2
+
+
+def test_add_note_content_hashes(tmp_path):
+    engine = create_sqlite_engine(str(tmp_path / 'notes-v2.db'))
+    with engine.begin() as conn:
+        conn.execute(text(
+            'CREATE TABLE "Notes-v2" ('
+            '    note_id INTEGER NOT NULL PRIMARY KEY,'
+            '    time_scope_id VARCHAR(20) NOT NULL,'
+            '    sort_time DATETIME,'
+            '    metadata VARCHAR,'
+            '    "desc" VARCHAR NOT NULL,'
+            '    detailed_desc VARCHAR,'
+            '    created_at DATETIME,'
+            '    UNIQUE (time_scope_id, sort_time, metadata, "desc", detailed_desc, created_at)'
+            ')'))
+        conn.execute(text(
+            'CREATE INDEX "import-notes-index-2" ON "Notes-v2" '
+            '(time_scope_id, sort_time, metadata, "desc", detailed_desc)'))
+        conn.execute(text(
+            'INSERT INTO "Notes-v2" (time_scope_id, "desc", detailed_desc) '
+            "VALUES ('2021-ww32.3', 'repeated', NULL), ('2021-ww32.3', 'repeated', NULL), "
+            "('2021-ww32.4', 'searchable', 'needle')"))
+
+    Base.metadata.create_all(bind=engine)
+    migrate_models(engine)
+    migrate_models(engine)
+
+    with engine.connect() as conn:
+        hashes = conn.execute(text('SELECT content_hash FROM "Notes-v2" ORDER BY note_id')).scalars().all()
+        index_names = conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = 'Notes-v2'"
+        )).scalars().all()
+
+    assert hashes[0] == hashes[1] == note_content_hash('2021-ww32.3', None, None, 'repeated', None, None)
+    assert 'import-notes-index-2' not in index_names
+    assert 'notes-content-hash-unique-index' in index_names
+
+    # Triggers on the rebuilt table still work
+    with engine.begin() as conn:
+        generation = conn.execute(text(
+            "SELECT generation FROM \"DataGenerations-v2\" WHERE generation_key = '*'")).scalar()
+        conn.execute(text(
+            'INSERT INTO "Notes-v2" (time_scope_id, "desc", detailed_desc) '
+            "VALUES ('2021-ww32.5', 'also searchable', 'needle')"))
+
+    with engine.connect() as conn:
+        assert conn.execute(text(
+            "SELECT generation FROM \"DataGenerations-v2\" WHERE generation_key = '*'")).scalar() == generation + 1
+        assert conn.execute(text(
+            "SELECT COUNT(*) FROM \"NotesSearch-v2\" WHERE \"NotesSearch-v2\" MATCH 'needle'")).scalar() == 2
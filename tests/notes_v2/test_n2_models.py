@@ -1,6 +1,10 @@
-from datetime import datetime
+from datetime import date, datetime
 
-from notes_v2.models import Note
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from notes_v2.models import Domain, Note, NoteDomain, intern_new_domains
+from util import TimeScope
 
 
 def test_note_constructor():
@@ -69,3 +73,46 @@ def test_to_from_json_with_datetime(note_v2_session):
     assert note2.desc == note1.desc
     assert note2.detailed_desc == note1.detailed_desc
     assert note2.created_at == note1.created_at
+
+
+def test_scope_ordinals():
+    day_note = Note(time_scope_id="2021-ww32.3", desc="day")
+    assert day_note.scope_type == TimeScope.Type.day.value
+    assert day_note.scope_start_ordinal == date(2021, 8, 11).toordinal()
+    assert day_note.scope_end_ordinal == date(2021, 8, 12).toordinal()
+
+    quarter_note = Note(time_scope_id="2021—Q3", desc="quarter")
+    assert quarter_note.scope_type == TimeScope.Type.quarter.value
+    assert quarter_note.scope_start_ordinal < day_note.scope_start_ordinal
+    assert quarter_note.scope_end_ordinal > day_note.scope_end_ordinal
+
+    garbage_note = Note(time_scope_id="garbage", desc="unparseable")
+    assert garbage_note.scope_start_ordinal is None
+
+
+def test_domains_interned(note_v2_session):
+    n1 = Note(time_scope_id="2021-ww32.2", desc="first")
+    n2 = Note(time_scope_id="2021-ww32.3", desc="second")
+    note_v2_session.add_all([n1, n2])
+    note_v2_session.flush()
+
+    note_v2_session.add_all([
+        NoteDomain(note_id=n1.note_id, domain_id="shared"),
+        NoteDomain(note_id=n2.note_id, domain_id="shared"),
+    ])
+    note_v2_session.commit()
+
+    note_v2_session.add(NoteDomain(note_id=n1.note_id, domain_id="unique"))
+    note_v2_session.add(NoteDomain(note_id=n2.note_id, domain_id="unique"))
+    note_v2_session.commit()
+
+    assert len(Domain.query.all()) == 2
+    note_v2_session.expire_all()
+    assert sorted(n1.get_domain_ids()) == ["shared", "unique"]
+    assert sorted(n2.get_domain_ids()) == ["shared", "unique"]
+
+
+def test_domains_interned_only_for_notes(note_v2_session, tasks_db):
+    assert event.contains(note_v2_session.session_factory, 'before_flush', intern_new_domains)
+    assert not event.contains(tasks_db.session_factory, 'before_flush', intern_new_domains)
+    assert not event.contains(Session, 'before_flush', intern_new_domains)
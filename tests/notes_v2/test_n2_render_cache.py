@@ -0,0 +1,211 @@
+import io
+import json
+from datetime import datetime
+
+from markupsafe import Markup
+
+from sqlalchemy import select
+
+from notes_v2.add import all_from_csv, refresh_domain_scope_counts, refresh_domain_stats
+from notes_v2.models import DataGeneration, Note, scope_generation_keys
+from notes_v2.report.persistent_cache import PersistentRenderCache
+from notes_v2.report.render_utils import RenderCache, cache, current_data_version, scopes_data_version
+from notes_v2.warm import recent_scopes
+from tracker.app import create_app
+from util import TimeScope
+
+
+def test_lru_eviction():
+    c = RenderCache(max_bytes=1_000)
+    value = "x" * 300
+
+    c.put("a", value)
+    c.put("b", value)
+    assert c.get("a") == value
+    # "b" is now least-recently-used, so it gets evicted first
+    c.put("c", value)
+
+    assert "a" in c
+    assert "b" not in c
+    assert "c" in c
+
+    stats = c.stats()
+    assert stats["evictions"] == 1
+    assert stats["entries"] == 2
+    assert stats["size_bytes"] <= 1_000
+
+
+def test_oversized_entry_skipped():
+    c = RenderCache(max_bytes=100)
+    assert c.get_or_generate("big", lambda: "y" * 1_000) == "y" * 1_000
+    assert "big" not in c
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("notes_v2.report.render_utils.time.monotonic", lambda: now[0])
+
+    c = RenderCache(max_bytes=1_000, ttl_seconds=60)
+    c.put("a", "value")
+    now[0] += 30
+    assert c.get("a") == "value"
+    now[0] += 31
+    assert c.get("a") is None
+
+    stats = c.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["expirations"] == 1
+    assert stats["size_bytes"] == 0
+
+
+def test_stats_endpoint(test_client):
+    # Not registered by default
+    assert test_client.get('/v2/debug/render-cache').status_code == 404
+
+    debug_app = create_app({'TESTING': True, 'RENDER_CACHE_DEBUG_ENDPOINT': True})
+    with debug_app.app_context():
+        r = debug_app.test_client().get('/v2/debug/render-cache')
+    j = json.loads(r.get_data())
+
+    assert {"hits", "misses", "evictions", "size_bytes", "max_bytes"} <= set(j.keys())
+
+
+def test_persistent_cache_shared(tmp_path):
+    db_path = str(tmp_path / 'render-cache.db')
+    worker_1 = RenderCache(max_bytes=1_000_000, persistent_store=PersistentRenderCache(db_path))
+    worker_2 = RenderCache(max_bytes=1_000_000, persistent_store=PersistentRenderCache(db_path))
+
+    value = Markup("<svg>rendered once</svg>")
+    assert worker_1.get_or_generate(("/svg.day", "2021-ww32.3"), lambda: value, data_version=5, persist=True) == value
+    # Fragments that aren't persisted stay in the worker's memory
+    worker_1.put(("tooltip", "2021-ww32.3"), Markup("tooltip"), data_version=5)
+    assert worker_1.persistent_store.stats()["entries"] == 1
+
+    def fail():
+        raise AssertionError("should have been read from the persistent cache")
+
+    assert worker_2.get_or_generate(("/svg.day", "2021-ww32.3"), fail, data_version=5, persist=True) == value
+    assert worker_2.stats()["persistent_hits"] == 1
+    assert worker_2.get(("tooltip", "2021-ww32.3"), data_version=5, persist=True) is None
+
+    # Newer data versions never see older entries
+    assert worker_2.get(("/svg.day", "2021-ww32.3"), data_version=6, persist=True) is None
+
+
+def test_persistent_cache_prune(tmp_path):
+    store = PersistentRenderCache(str(tmp_path / 'render-cache.db'), max_bytes=10_000)
+    for i in range(5):
+        store.put(2, f"current {i}", "y" * 3_000)
+
+    store.prune()
+
+    assert store.get(2, "current 0") == (False, None)
+    assert store.get(2, "current 4")[0]
+    assert store.stats()["size_bytes"] <= 10_000
+
+
+def test_data_version_bumped_by_writes(test_app, note_v2_session):
+    with test_app.test_request_context():
+        version_before = current_data_version()
+
+    note_v2_session.add(Note(time_scope_id="2021-ww32.3", desc="new note"))
+    note_v2_session.commit()
+
+    with test_app.test_request_context():
+        assert current_data_version() > version_before
+
+
+def test_noop_reimport_keeps_data_versions(note_v2_session):
+    csv_test_file = """time_scope_id,desc,domains
+2021-ww33.1,reimported note,reimport & reimport: other
+2021—Q3,quarterly note,reimport
+"""
+    all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=True)
+
+    def all_generations():
+        return dict(note_v2_session.execute(
+            select(DataGeneration.generation_key, DataGeneration.generation)
+        ).all())
+
+    generations_before = all_generations()
+    for bulk in [False, True]:
+        all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=True, bulk=bulk)
+        assert all_generations() == generations_before
+
+    # Rebuilding the derived tables from scratch doesn't change anything either
+    refresh_domain_stats(note_v2_session)
+    refresh_domain_scope_counts(note_v2_session)
+    note_v2_session.commit()
+    assert all_generations() == generations_before
+
+
+def test_scope_generation_keys():
+    # Day scopes also depend on their parent week + quarter notes
+    assert scope_generation_keys(TimeScope("2021-ww32.3")) == ["month:2021-06", "month:2021-08"]
+    # ww35 starts on Aug 30, so its days span two months
+    assert scope_generation_keys(TimeScope("2021-ww35")) == ["month:2021-06", "month:2021-08", "month:2021-09"]
+
+
+def test_scope_data_version_only_bumped_by_nearby_edits(test_app, note_v2_session):
+    august_note = Note(time_scope_id="2021-ww33.1", desc="new note")
+    note_v2_session.add(august_note)
+    note_v2_session.commit()
+
+    with test_app.test_request_context():
+        august_before = scopes_data_version(["2021-ww32.3"])
+        march_before = scopes_data_version(["2021-ww10.3"])
+
+    august_note.desc = "edited note"
+    note_v2_session.commit()
+
+    with test_app.test_request_context():
+        assert scopes_data_version(["2021-ww32.3"]) != august_before
+        assert scopes_data_version(["2021-ww10.3"]) == march_before
+
+    # New notes only reach other months through rarity buckets, see `test_conditional_get()`
+    note_v2_session.add(Note(time_scope_id="2021-ww33.2", desc="another note"))
+    note_v2_session.commit()
+
+    with test_app.test_request_context():
+        assert scopes_data_version(["2021-ww10.3"]) == march_before
+
+
+def test_scoped_cache_entry_invalidated(test_app, note_v2_session):
+    renders = []
+
+    def generate_fn():
+        renders.append(len(renders))
+        return f"render {len(renders)}"
+
+    with test_app.test_request_context():
+        assert cache(("scoped test",), generate_fn, scopes=["2021-ww32"]) == "render 1"
+    with test_app.test_request_context():
+        assert cache(("scoped test",), generate_fn, scopes=["2021-ww32"]) == "render 1"
+
+    note_v2_session.add(Note(time_scope_id="2021-ww32.3", desc="new note"))
+    note_v2_session.commit()
+
+    with test_app.test_request_context():
+        assert cache(("scoped test",), generate_fn, scopes=["2021-ww32"]) == "render 2"
+
+
+def test_recent_scopes():
+    scopes = recent_scopes(2, 3, now=datetime(2021, 8, 11))
+    assert scopes == ["2021—Q3", "2021—Q2", "2021-ww32", "2021-ww31", "2021-ww30"]
+
+
+def test_warm_cli(test_app, note_v2_session, tmp_path):
+    test_app.config['RENDER_CACHE_PATH'] = str(tmp_path / 'render-cache.db')
+    if hasattr(test_app, 'render_cache'):
+        del test_app.render_cache
+
+    try:
+        result = test_app.test_cli_runner().invoke(args=['n2/warm', '--quarters', '1', '--weeks', '1', '--jobs', '1'])
+        assert result.exit_code == 0
+        assert result.output.count("200 ") == 4
+
+        assert PersistentRenderCache(str(tmp_path / 'render-cache.db')).stats()["entries"] > 0
+    finally:
+        del test_app.config['RENDER_CACHE_PATH']
+        del test_app.render_cache
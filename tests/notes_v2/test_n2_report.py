@@ -1,10 +1,15 @@
+import gzip
 import io
 import json
+import re
 
 import jsondiff
 
 from notes_v2.add import all_from_csv
-from notes_v2.report.gather import NoteStapler
+from notes_v2.models import Note
+from notes_v2.report.gather import NoteStapler, iter_notes_json_tree, notes_json_tree
+from notes_v2.report.rarity import DomainRarityIndex, dot_radius_and_styling
+from notes_v2.report.render_utils import get_render_cache
 from util import TimeScope
 
 
@@ -56,3 +61,217 @@ with regular LF-only newline",unniecode ❲😎😎😎❳,domains: no & domains
     assert ['2021—Q3'] == list(j.keys())
     assert ['notes'] == list(j['2021—Q3'].keys())
     assert 2 == len(j['2021—Q3']['notes'])
+
+
+def test_stapler_quarter_promotion(note_v2_session):
+    csv_rows = ["time_scope_id,sort_time,desc,domains"]
+    # One busy week that stays un-promoted, and one quiet week that gets collapsed
+    csv_rows.extend(f"2021-ww32.{i % 7 + 1},2021-08-{9 + i % 7} 10:{i:02},busy {i},stapler" for i in range(12))
+    csv_rows.append("2021-ww34.2,,quiet,stapler")
+    csv_rows.append("2021-ww34,,weekly,stapler")
+    csv_rows.extend(f"2021—Q3,,quarterly {i},stapler" for i in range(6))
+    all_from_csv(note_v2_session, io.StringIO("\n".join(csv_rows) + "\n"), expect_duplicates=False)
+
+    tree = notes_json_tree(note_v2_session, ["stapler"], ["2021—Q3"])
+    quarter_tree = tree["2021—Q3"]
+
+    assert len(quarter_tree["notes"]) == 6
+    assert list(quarter_tree["2021-ww34"].keys()) == ["notes"]
+    assert [n.desc for n in quarter_tree["2021-ww34"]["notes"]] == ["weekly", "quiet"]
+    assert "2021-ww32" in quarter_tree
+    assert len(quarter_tree["2021-ww32"]["notes"]) == 0
+    assert len(quarter_tree["2021-ww32"]) == 1 + 7
+    assert [n.desc for n in quarter_tree["2021-ww32"]["2021-ww32.1"]["notes"]] == ["busy 0", "busy 7"]
+
+    # Same notes, fetched through a narrower page
+    week_tree = notes_json_tree(note_v2_session, ["stapler"], ["2021-ww34"])
+    assert [n.desc for n in week_tree["2021—Q3"]["notes"]] == [f"quarterly {i}" for i in range(6)]
+    assert sorted(n.desc for n in week_tree["2021—Q3"]["2021-ww34"]["notes"]) == ["quiet", "weekly"]
+
+
+def test_streamed_tree_matches(test_client, note_v2_session):
+    csv_test_file = """time_scope_id,sort_time,desc,domains
+2021-ww31.6,2021-08-07 10:00:00,first,streamed
+2021-ww39.5,,boundary week,streamed
+2021-ww40.1,,next quarter,streamed
+2021—Q3,,quarterly,streamed
+2023-ww02.1,,much later,streamed & other
+"""
+    all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=False)
+
+    def as_desc_tree(tree):
+        return {
+            k: [n.desc for n in v] if k == "notes" else as_desc_tree(v)
+            for k, v in tree.items()
+        }
+
+    def merged_tree(streamed_quarters):
+        tree = {}
+        for quarter_scope, quarter_dict in streamed_quarters:
+            quarter_tree = tree.setdefault(quarter_scope, {"notes": []})
+            quarter_tree["notes"].extend(quarter_dict["notes"])
+            quarter_tree.update((k, v) for k, v in quarter_dict.items() if k != "notes")
+        return tree
+
+    for scope_ids in [(), ("2021—Q3",), ("2021—Q4", "2021-ww31.6", "2023—Q1")]:
+        expected_tree = notes_json_tree(note_v2_session, ("streamed",), scope_ids)
+        streamed_quarters = list(iter_notes_json_tree(note_v2_session, ("streamed",), scope_ids))
+
+        streamed_scopes = list(dict.fromkeys(quarter_scope for quarter_scope, _ in streamed_quarters))
+        assert streamed_scopes == sorted(expected_tree.keys(), reverse=True)
+        assert as_desc_tree(merged_tree(streamed_quarters)) == as_desc_tree(expected_tree)
+
+    r = test_client.get('/notes?domain=streamed&stream=true')
+    assert r.status_code == 200
+    assert b"much later" in r.get_data()
+
+
+def test_streamed_page_starts_before_later_weeks(test_client, note_v2_session, monkeypatch):
+    csv_rows = ["time_scope_id,desc,domains"]
+    csv_rows.extend(f"2021-ww38.{i % 7 + 1},busy {i},streamed" for i in range(20))
+    csv_rows.append("2021-ww27.1,early week,streamed")
+    all_from_csv(note_v2_session, io.StringIO("\n".join(csv_rows) + "\n"), expect_duplicates=False)
+
+    gathered_weeks = []
+    original_add_by_week = NoteStapler._add_by_week
+
+    def recording_add_by_week(self, scope, *args, **kwargs):
+        gathered_weeks.append(scope)
+        return original_add_by_week(self, scope, *args, **kwargs)
+
+    monkeypatch.setattr(NoteStapler, "_add_by_week", recording_add_by_week)
+    get_render_cache().clear()
+
+    r = test_client.get('/notes?domain=streamed&scope=2021—Q3&stream=true', buffered=False)
+    assert r.status_code == 200
+
+    chunks = iter(r.response)
+    body = b""
+    while b"busy 19" not in body:
+        body += next(chunks)
+
+    # The busy week went out before the quiet, earlier weeks were even loaded
+    assert gathered_weeks[-1] == "2021-ww38"
+    assert all(week >= "2021-ww38" for week in gathered_weeks)
+    assert b"early week" not in body
+
+    body += b"".join(chunks)
+    assert b"early week" in body
+    assert "2021-ww27" in gathered_weeks
+    assert body.count(b"quarter: 2021\xe2\x80\x94Q3") == 1
+
+
+def test_domain_rarity_index_loaded_once(test_app, test_client, note_v2_session, count_statements):
+    csv_rows = ["time_scope_id,desc,domains"]
+    csv_rows.extend(f"2019-ww{week:02}.{day},note {week} {day},rarity: common & rarity: {day}"
+                    for week in range(2, 12) for day in range(1, 8))
+    all_from_csv(note_v2_session, io.StringIO("\n".join(csv_rows) + "\n"), expect_duplicates=False)
+
+    with count_statements(note_v2_session, lambda statement: '"DomainStats-v2"' in statement) \
+            as domain_stats_queries:
+        for stream in ["false", "true"]:
+            get_render_cache().clear()
+
+            r = test_client.get(f'/notes?scope=2019—Q1&stream={stream}')
+            assert r.status_code == 200
+            # Consume the response body, since streamed pages render lazily
+            assert b"note 11 7" in r.get_data()
+
+        # The data version didn't change, so the second page reused the rarity index
+        assert len(domain_stats_queries) == 1
+
+        note_v2_session.add(Note(time_scope_id="2019-ww12.1", desc="new note"))
+        note_v2_session.commit()
+        get_render_cache().clear()
+        assert b"note 11 7" in test_client.get('/notes?scope=2019—Q1').get_data()
+        assert len(domain_stats_queries) == 2
+
+
+def test_dot_radius_and_styling():
+    rarity_index = DomainRarityIndex(
+        data_version=1,
+        rarity_buckets={"common": 8, "rare": 3},
+    )
+
+    plain_radius, plain_styling = dot_radius_and_styling(rarity_index, (), [], 0)
+    assert plain_radius == 8
+    # Domains without stats render plainly too
+    assert dot_radius_and_styling(rarity_index, (), ["unknown"], 0) == (plain_radius, plain_styling)
+
+    common_radius, _ = dot_radius_and_styling(rarity_index, (), ["common"], 0)
+    rare_radius, rare_styling = dot_radius_and_styling(rarity_index, (), ["common", "rare"], 0)
+    assert common_radius < rare_radius
+    assert dot_radius_and_styling(rarity_index, ("rare",), ["rare"], 0)[0] == rare_radius + 6
+    assert dot_radius_and_styling(rarity_index, (), ["common"], 4_000)[0] == 20
+
+
+def test_svg_sprite(test_client, note_v2_session):
+    csv_rows = ["time_scope_id,desc,domains"]
+    csv_rows.extend(f"2019-ww05.{day},note {day} {i},sprite: {i}"
+                    for day in range(1, 8) for i in range(5))
+    all_from_csv(note_v2_session, io.StringIO("\n".join(csv_rows) + "\n"), expect_duplicates=False)
+
+    page = test_client.get('/notes?scope=2019-ww05').get_data(as_text=True)
+    assert '<img' not in page
+    assert '/svg.sprite?scope=2019-ww05#day-2019-ww05.3"' in page
+    assert '/svg.sprite?scope=2019-ww05#week-2019-ww05"' in page
+
+    r = test_client.get('/svg.sprite?scope=2019-ww05')
+    assert r.status_code == 200
+    assert r.mimetype == 'image/svg+xml'
+    sprite = r.get_data(as_text=True)
+    assert sprite.count('<symbol ') == 8
+    assert '<symbol id="week-2019-ww05" viewBox="0 0 1008 480">' in sprite
+    assert '<symbol id="day-2019-ww05.3" viewBox="0 0 960 96">' in sprite
+
+    # Every symbol shares one document, so the compact SVGs' <defs> can't reuse ids
+    sprite_ids = re.findall(r' id="([^"]+)"', sprite)
+    assert len(sprite_ids) == len(set(sprite_ids))
+    assert set(re.findall(r'<use href="#([^"]+)"', sprite)) <= set(sprite_ids)
+
+
+def test_rarity_change_invalidates_other_months(test_client, note_v2_session):
+    def import_notes(*csv_rows):
+        csv_text = "time_scope_id,desc,domains\n" + "\n".join(csv_rows) + "\n"
+        all_from_csv(note_v2_session, io.StringIO(csv_text), expect_duplicates=False)
+
+    import_notes("2021-ww10.3,march note,rarity: a & rarity: b")
+    march_urls = ['/notes?scope=2021-ww10', '/svg.day/2021-ww10.3', '/svg.week/2021-ww10', '/svg.sprite?scope=2021-ww10']
+    march_before = {url: test_client.get(url).get_data() for url in march_urls}
+
+    # Dot sizes and domain order come from rarity buckets, so they change once "rarity: a" hits 8 notes
+    import_notes(*(f"2021-ww32.{day},august note {day},rarity: a" for day in range(1, 8)))
+    for url in march_urls:
+        r = test_client.get(url)
+        assert r.status_code == 200
+        assert r.get_data() != march_before[url], url
+
+        get_render_cache().clear()
+        assert test_client.get(url).get_data() == r.get_data(), url
+
+
+def test_compact_svg_gzipped(test_app, test_client, note_v2_session):
+    csv_rows = ["time_scope_id,sort_time,desc,domains"]
+    csv_rows.extend(f"2019-ww05.{day},2019-02-0{day} 1{day}:00:00,note {day},compact: {day}"
+                    for day in range(1, 8))
+    all_from_csv(note_v2_session, io.StringIO("\n".join(csv_rows) + "\n"), expect_duplicates=False)
+
+    r = test_client.get('/svg.week/2019-ww05', headers={'Accept-Encoding': 'gzip'})
+    assert r.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in r.headers['Vary']
+    compact_svg = gzip.decompress(r.get_data()).decode('utf-8')
+    # Clients without gzip get the same body, uncompressed
+    assert test_client.get('/svg.week/2019-ww05').get_data(as_text=True) == compact_svg
+
+    assert compact_svg.count('<circle ') == 7
+    assert 'style="fill: hsl(' not in compact_svg
+    assert '<use href="#n2-week-early-hours-2019-ww05"' in compact_svg
+
+    test_app.config['SVG_COMPACT_OUTPUT'] = False
+    try:
+        full_svg = test_client.get('/svg.week/2019-ww05').get_data(as_text=True)
+    finally:
+        del test_app.config['SVG_COMPACT_OUTPUT']
+
+    assert full_svg.count('<circle ') == 7
+    assert len(compact_svg) < len(full_svg) / 2
@@ -1,7 +1,9 @@
+import io
 import json
 
 import jsondiff
 
+from notes_v2.add import all_from_csv, refresh_domain_stats
 from notes_v2.models import Note, NoteDomain
 
 
@@ -35,6 +37,10 @@ def test_get_domain_stats(test_client, note_v2_session):
     for d in ["domain 1", "domain 2", "d3", "d4"]:
         nd = NoteDomain(note_id=n.note_id, domain_id=d)
         note_v2_session.add(nd)
+    note_v2_session.flush()
+
+    # NoteDomains were added directly, rather than through the import path
+    refresh_domain_stats(note_v2_session)
     note_v2_session.commit()
 
     assert len(NoteDomain.query.all()) == 4
@@ -50,3 +56,97 @@ def test_domain_stats_no_domains(test_client):
     j = json.loads(r.get_data())
 
     assert not j
+
+
+def test_domain_calendar(test_client, note_v2_session):
+    csv_test_file = """\
+time_scope_id,desc,domains
+2021-ww31.6,first,calendar: one & calendar: two
+2021-ww31.6,second,calendar: one
+2021-ww32.1,third,calendar: one
+"""
+    all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=False)
+
+    r = test_client.get('/v2/domains/calendar?filter=calendar:%25')
+    j = json.loads(r.get_data())
+
+    assert j == {
+        "calendar: one": {"2021-ww31.6": 2, "2021-ww32.1": 1},
+        "calendar: two": {"2021-ww31.6": 1},
+    }
+
+
+def test_note_search(test_client, note_v2_session):
+    csv_test_file = """\
+time_scope_id,desc,detailed_desc,domains
+2021-ww31.6,walked the dog,,pets
+2021-ww31.7,fed the cat,mentions the dog and the dog again,pets
+2021-ww32.1,unrelated,,work
+"""
+    all_from_csv(note_v2_session, io.StringIO(csv_test_file), expect_duplicates=False)
+
+    r = test_client.get('/v2/notes/search?q=dog')
+    j = json.loads(r.get_data())
+
+    # Matches in `desc` outrank matches in `detailed_desc`
+    assert [n["desc"] for n in j["notes"]] == ["walked the dog", "fed the cat"]
+    assert j["next_page"] is None
+
+    r = test_client.get('/v2/notes/search?q=unrel*')
+    j = json.loads(r.get_data())
+    assert [n["desc"] for n in j["notes"]] == ["unrelated"]
+
+    r = test_client.get('/notes/search?q=cat "dog')
+    assert r.status_code == 200
+    assert b"fed the cat" in r.get_data()
+
+
+def test_conditional_get(test_client, note_v2_session):
+    def add_note(time_scope_id, desc):
+        csv_text = f"time_scope_id,desc,domains\n{time_scope_id},{desc},etag test\n"
+        all_from_csv(note_v2_session, io.StringIO(csv_text), expect_duplicates=False)
+
+    add_note("2021-ww32.3", "august")
+
+    r = test_client.get('/notes?scope=2021-ww32')
+    assert r.status_code == 200
+    assert r.headers['Cache-Control'] == 'no-cache'
+    etag = r.headers['ETag']
+
+    r = test_client.get('/notes?scope=2021-ww32', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.get_data() == b''
+    # Different parameters need different ETags
+    assert test_client.get('/notes?scope=2021-ww33').headers['ETag'] != etag
+
+    # Edits to notes in other months leave the ETag alone
+    add_note("2021-ww10.3", "march")
+    etag = test_client.get('/notes?scope=2021-ww32').headers['ETag']
+    Note.query.filter_by(desc="march").one().desc = "march, edited"
+    note_v2_session.commit()
+    assert test_client.get('/notes?scope=2021-ww32', headers={'If-None-Match': etag}).status_code == 304
+
+    # So do imports into other months, as long as no domain's rarity bucket changes (2 => 3 notes)
+    svg_urls = ['/svg.day/2021-ww32.3', '/svg.week/2021-ww32', '/svg.sprite?scope=2021-ww32']
+    svg_etags = {url: test_client.get(url).headers['ETag'] for url in svg_urls}
+    add_note("2021-ww11.3", "also march")
+    assert test_client.get('/notes?scope=2021-ww32', headers={'If-None-Match': etag}).status_code == 304
+    for url in svg_urls:
+        assert test_client.get(url, headers={'If-None-Match': svg_etags[url]}).status_code == 304, url
+
+    # But a new bucket (3 => 4 notes) changes dot sizes and domain order, so it changes every ETag
+    add_note("2021-ww12.3", "more march")
+    r = test_client.get('/notes?scope=2021-ww32', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    etag = r.headers['ETag']
+    for url in svg_urls:
+        assert test_client.get(url, headers={'If-None-Match': svg_etags[url]}).status_code == 200, url
+
+    add_note("2021-ww32.4", "also august")
+    r = test_client.get('/notes?scope=2021-ww32', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert b"also august" in r.get_data()
+
+    # Endpoints without scopes depend on every note
+    etag = test_client.get('/v2/domains').headers['ETag']
+    assert test_client.get('/v2/domains', headers={'If-None-Match': etag}).status_code == 304
@@ -1,8 +1,11 @@
 from datetime import date, datetime
 
 import pytest
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
 
-from tasks.database_models import Task, TaskLinkage
+from tasks.database_models import Task, TaskLinkage, allocate_new_task_ids, allocate_task_ids, \
+    sync_task_id_allocator
 
 
 def test_task_constructor():
@@ -94,3 +97,45 @@ def test_linkage_at(tasks_db):
 
     tl_3 = t.linkage_at("2021-ww34.3")
     assert tl_3
+
+
+def test_task_id_allocator(tasks_db, count_statements):
+    with count_statements(tasks_db, lambda statement: '"TaskIdAllocator"' in statement) as allocator_statements:
+        new_tasks = [Task(desc=f"allocated task {i}") for i in range(3)]
+        tasks_db.add_all(new_tasks)
+        tasks_db.commit()
+
+    # One block for the whole flush
+    assert len(allocator_statements) == 1
+    assert [t.task_id for t in new_tasks] == [1, 2, 3]
+
+    # Imported tasks keep their IDs, and push the allocator past them
+    tasks_db.add(Task(task_id=100, import_source="imported", desc="imported task"))
+    tasks_db.commit()
+    t = Task(desc="after import")
+    tasks_db.add(t)
+    tasks_db.commit()
+    assert t.task_id == 101
+
+    # Rolled-back allocations get reused
+    tasks_db.add(Task(desc="rolled back"))
+    tasks_db.flush()
+    tasks_db.rollback()
+    t = Task(desc="after rollback")
+    tasks_db.add(t)
+    tasks_db.commit()
+    assert t.task_id == 102
+
+
+def test_sync_task_id_allocator(tasks_db):
+    tasks_db.execute(text('INSERT INTO "Tasks" (task_id, import_source, "desc") VALUES (500, \'\', \'raw\')'))
+    tasks_db.commit()
+
+    sync_task_id_allocator(tasks_db)
+    assert allocate_task_ids(tasks_db, 2) == range(501, 503)
+
+
+def test_task_ids_allocated_only_for_tasks(note_v2_session, tasks_db):
+    assert event.contains(tasks_db.session_factory, 'before_flush', allocate_new_task_ids)
+    assert not event.contains(note_v2_session.session_factory, 'before_flush', allocate_new_task_ids)
+    assert not event.contains(Session, 'before_flush', allocate_new_task_ids)
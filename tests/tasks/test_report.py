@@ -0,0 +1,151 @@
+from datetime import date, datetime
+
+from tasks.database_models import Task, TaskLinkage
+from tasks.report.edit import fetch_tasks_by_domain, generate_tasks_by_scope
+from tasks.report.render import TaskRenderInfo, make_renderer
+from util import TimeScope
+
+
+def _add_task(tasks_db, desc: str, *time_scopes: date, category: str | None = None) -> Task:
+    t = Task(desc=desc, category=category)
+    tasks_db.add(t)
+    tasks_db.flush()
+
+    for time_scope in time_scopes:
+        tl = TaskLinkage(task_id=t.task_id, import_source=t.import_source, time_scope=time_scope)
+        tl.created_at = datetime.now()
+        tasks_db.add(tl)
+
+    tasks_db.commit()
+    return t
+
+
+def test_generate_tasks_by_scope(tasks_db, count_statements):
+    _add_task(tasks_db, "monday task", date(2021, 8, 9))
+    _add_task(tasks_db, "recurring task", date(2021, 8, 10), date(2021, 8, 12), date(2021, 9, 30))
+    _add_task(tasks_db, "next week", date(2021, 8, 16))
+
+    with count_statements(tasks_db) as statements:
+        tasks_by_scope = generate_tasks_by_scope(tasks_db, TimeScope("2021-ww32"))
+        assert len(statements) == 2
+
+        assert list(tasks_by_scope.keys()) == list(TimeScope("2021-ww32").children)
+        assert [t.desc for t in tasks_by_scope["2021-ww32.1"]] == ["monday task"]
+        assert [t.desc for t in tasks_by_scope["2021-ww32.2"]] == ["recurring task"]
+        assert tasks_by_scope["2021-ww32.3"] == []
+
+        # Linkages are already loaded, so this doesn't need another query
+        recurring_task = tasks_by_scope["2021-ww32.4"][0]
+        assert len(recurring_task.linkages) == 3
+        assert recurring_task.linkage_at("2021-ww32.4", create_if_none=False).time_scope == date(2021, 8, 12)
+        assert recurring_task.linkage_at("2021-ww32.5", create_if_none=False) is None
+        assert len(statements) == 2
+
+    quarter_scope = TimeScope("2021—Q3")
+    tasks_by_scope = generate_tasks_by_scope(tasks_db, quarter_scope)
+    assert len(tasks_by_scope) == (quarter_scope.end - quarter_scope.start).days
+    assert sum(len(tasks) for tasks in tasks_by_scope.values()) == 5
+
+    tasks_by_scope = generate_tasks_by_scope(tasks_db, TimeScope("2021-ww33.1"))
+    assert [t.desc for t in tasks_by_scope["2021-ww33.1"]] == ["next week"]
+
+
+def test_edit_tasks_in_scope(test_client, tasks_db):
+    _add_task(tasks_db, "rendered task", date(2021, 8, 10), category="chores")
+
+    r = test_client.get('/tasks.in-scope/2021-ww32')
+    assert r.status_code == 200
+    assert b"rendered task" in r.get_data()
+
+
+def test_fetch_tasks_by_domain(tasks_db, count_statements):
+    _add_task(tasks_db, "old task", date(2021, 8, 2), category="shared")
+    _add_task(tasks_db, "recent task", date(2021, 8, 1), date(2021, 8, 20), category="shared & other")
+    _add_task(tasks_db, "middle task", date(2021, 8, 10))
+
+    with count_statements(tasks_db) as statements:
+        tasks_by_domain = fetch_tasks_by_domain(tasks_db, lambda query: query)
+        for domain_tasks in tasks_by_domain.values():
+            for t in domain_tasks:
+                assert t.linkages
+
+        # One query for the tasks, one for all their linkages
+        assert len(statements) == 2
+
+    assert {domain: [t.desc for t in domain_tasks] for domain, domain_tasks in tasks_by_domain.items()} == {
+        '': ["middle task"],
+        'other': ["recent task"],
+        'shared': ["recent task", "old task"],
+    }
+
+
+def test_edit_tasks_all(test_client, tasks_db):
+    _add_task(tasks_db, "first task", date(2021, 8, 2), date(2021, 8, 3), category="chores")
+    _add_task(tasks_db, "second task", date(2021, 8, 4))
+    _add_task(tasks_db, "unscheduled task")
+
+    for query_string in ['', '?show_resolved=1', '?hide_future=1']:
+        r = test_client.get(f'/tasks{query_string}')
+        assert r.status_code == 200
+        assert b"first task" in r.get_data()
+
+    r = test_client.get('/tasks?show_resolved=1')
+    page = r.get_data(as_text=True)
+    assert page.index("second task") < page.index("unscheduled task")
+
+    r = test_client.get('/tasks?ignore_categories=1')
+    page = r.get_data(as_text=True)
+    assert page.index("second task") < page.index("first task")
+
+
+def test_make_renderer(tasks_db):
+    closed_task = _add_task(tasks_db, "closed task", date(2021, 8, 2))
+    closed_task.linkages[0].resolution = "done"
+    future_task = _add_task(tasks_db, "future task", date(2021, 8, 2), date(2021, 8, 30))
+    future_task.linkages[0].resolution = "moved"
+    overdue_task = _add_task(tasks_db, "overdue task", date(2021, 8, 2))
+    # Empty resolutions only count as open when there's also a NULL one
+    blank_task = _add_task(tasks_db, "blank task", date(2021, 8, 2), date(2021, 8, 30))
+    blank_task.linkages[1].resolution = ""
+    blank_closed_task = _add_task(tasks_db, "blank closed task", date(2021, 8, 2))
+    blank_closed_task.linkages[0].resolution = ""
+    tasks_db.commit()
+
+    compute_task_render_info = make_renderer(
+        tasks_db, date(2021, 8, 11), lambda import_source: False, lambda query: query)
+
+    assert compute_task_render_info(closed_task).resolution_to_print == "done"
+    assert compute_task_render_info(future_task) == TaskRenderInfo("ww35.1", None, True, False)
+    assert compute_task_render_info(overdue_task).scope_to_print.endswith("ww31.1</span>")
+    assert compute_task_render_info(overdue_task) is compute_task_render_info(overdue_task)
+    assert compute_task_render_info(blank_task) == TaskRenderInfo("ww35.1", None, True, False)
+    assert compute_task_render_info(blank_closed_task) == TaskRenderInfo("", "", False, False)
+
+
+def test_make_renderer_page_tasks_only(tasks_db):
+    page_task = _add_task(tasks_db, "page task", date(2021, 8, 2))
+    other_task = _add_task(tasks_db, "other task", date(2021, 8, 2))
+
+    compute_task_render_info = make_renderer(
+        tasks_db, date(2021, 8, 11), lambda import_source: False,
+        lambda query: query.where(Task.desc == "page task"))
+
+    assert compute_task_render_info(page_task).scope_to_print.endswith("ww31.1</span>")
+    # Not on the page, so its open linkage never got looked up
+    assert compute_task_render_info(other_task).scope_to_print == ""
+
+
+def test_edit_tasks_all_query_count(test_client, tasks_db, count_statements):
+    def count_page_statements() -> int:
+        with count_statements(tasks_db) as statements:
+            assert test_client.get('/tasks').status_code == 200
+
+        return len(statements)
+
+    _add_task(tasks_db, "lonely task", date(2021, 8, 2))
+    small_page_statements = count_page_statements()
+
+    for i in range(10):
+        _add_task(tasks_db, f"task {i}", date(2021, 8, 2), date(2021, 8, 3 + i), category=f"category {i % 3}")
+
+    assert count_page_statements() == small_page_statements
@@ -0,0 +1,55 @@
+from datetime import date, datetime
+
+from werkzeug.datastructures import MultiDict
+
+from tasks.database_models import Task, TaskLinkage
+from tasks.update import update_task
+
+
+def _task_form(t: Task, linkages: dict) -> MultiDict:
+    form_data = MultiDict({
+        'task-desc': t.desc,
+        'task-desc_for_llm': '',
+        'task-category': '',
+        'task-import_source': t.import_source,
+        'task-time_estimate': '',
+        'task-original_import_source': t.import_source,
+    })
+    for form_tl_id, (time_scope_id, resolution) in linkages.items():
+        form_data[f'tl-{form_tl_id}-time_scope_id'] = time_scope_id
+        form_data[f'tl-{form_tl_id}-created_at'] = '2021-08-01 12:00:00'
+        form_data[f'tl-{form_tl_id}-time_elapsed'] = ''
+        form_data[f'tl-{form_tl_id}-resolution'] = resolution
+        form_data[f'tl-{form_tl_id}-detailed_resolution'] = ''
+
+    return form_data
+
+
+def test_update_task_linkages(tasks_db, count_statements):
+    t = Task(desc="recurring task")
+    tasks_db.add(t)
+    tasks_db.flush()
+    task_id = t.task_id
+    for day in range(1, 31):
+        tl = TaskLinkage(task_id=task_id, import_source=t.import_source, time_scope=date(2021, 8, day))
+        tl.created_at = datetime(2021, 8, 1, 12)
+        tasks_db.add(tl)
+    tasks_db.commit()
+
+    # Keep every linkage but the first, resolve the last one, and add a new one
+    form_linkages = {
+        f'{day}': (date(2021, 8, day).strftime('%G-ww%V.%u'), 'done' if day == 30 else '')
+        for day in range(2, 32)
+    }
+
+    form_data = _task_form(t, form_linkages)
+    with count_statements(tasks_db, lambda statement: statement.startswith('SELECT')) as select_statements:
+        update_task(tasks_db, task_id, form_data)
+
+    # The task, then all its linkages at once
+    assert len(select_statements) == 2
+
+    linkages = {tl.time_scope: tl for tl in TaskLinkage.query.filter_by(task_id=task_id).all()}
+    assert sorted(linkages.keys()) == [date(2021, 8, day) for day in range(2, 32)]
+    assert linkages[date(2021, 8, 30)].resolution == 'done'
+    assert linkages[date(2021, 8, 29)].resolution is None
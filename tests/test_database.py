@@ -0,0 +1,31 @@
+from sqlalchemy import text
+
+from util.database import create_sqlite_engine, sqlite_options_from_config
+
+
+def test_pragmas_applied(tmp_path):
+    engine = create_sqlite_engine(str(tmp_path / 'pragmas.db'))
+    with engine.connect() as conn:
+        assert conn.execute(text('PRAGMA journal_mode')).scalar() == 'wal'
+        # NORMAL == 1
+        assert conn.execute(text('PRAGMA synchronous')).scalar() == 1
+        assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 5_000
+
+
+def test_pragmas_from_config(tmp_path):
+    engine_kwargs = sqlite_options_from_config({
+        'SQLITE_PRAGMAS': {'busy_timeout': 1234},
+        'SQLITE_POOL_SIZE': 2,
+    })
+    assert engine_kwargs['pragmas']['journal_mode'] == 'WAL'
+
+    engine = create_sqlite_engine(str(tmp_path / 'config.db'), **engine_kwargs)
+    assert engine.pool.size() == 2
+    with engine.connect() as conn:
+        assert conn.execute(text('PRAGMA busy_timeout')).scalar() == 1234
+
+
+def test_in_memory_engine():
+    engine = create_sqlite_engine('')
+    with engine.connect() as conn:
+        assert conn.execute(text('SELECT 1')).scalar() == 1
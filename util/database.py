@@ -0,0 +1,83 @@
+import logging
+from typing import Dict, Mapping
+
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger(__name__)
+
+default_sqlite_pragmas: Dict[str, str | int] = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # Negative values are in KiB, so this is ~64 MiB of page cache per connection
+    'cache_size': -64_000,
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5_000,
+}
+"""
+Applied to every new SQLite connection.
+
+These are tuned for the "many uvicorn workers, mostly reads, occasional
+CLI import" pattern; override them with the `SQLITE_PRAGMAS` Flask config.
+"""
+
+
+def sqlite_options_from_config(config: Mapping) -> Dict:
+    """
+    Translate Flask config entries into `create_sqlite_engine()` kwargs
+
+    - `SQLITE_PRAGMAS`: dict of PRAGMA name => value, merged over the defaults
+    - `SQLITE_POOL_SIZE` and `SQLITE_MAX_OVERFLOW`: passed to the QueuePool
+    """
+    pragmas = dict(default_sqlite_pragmas)
+    pragmas.update(config.get('SQLITE_PRAGMAS') or {})
+
+    return {
+        'pragmas': pragmas,
+        'pool_size': config.get('SQLITE_POOL_SIZE', 8),
+        'max_overflow': config.get('SQLITE_MAX_OVERFLOW', 8),
+    }
+
+
+def create_sqlite_engine(
+        db_path: str,
+        pragmas: Mapping[str, str | int] | None = None,
+        pool_size: int = 8,
+        max_overflow: int = 8,
+) -> Engine:
+    """
+    Shared engine factory for notes-v2.db and tasks-v3.db
+
+    An empty `db_path` creates an in-memory database, which is what pytests use.
+    Those keep SQLAlchemy's default (single-connection) pool, since every new
+    connection would otherwise be a new, empty database.
+    """
+    if pragmas is None:
+        pragmas = default_sqlite_pragmas
+
+    engine_kwargs = {}
+    if db_path and db_path != ':memory:':
+        engine_kwargs['poolclass'] = QueuePool
+        engine_kwargs['pool_size'] = pool_size
+        engine_kwargs['max_overflow'] = max_overflow
+
+    engine = sqlalchemy.create_engine(
+        'sqlite:///' + db_path,
+        connect_args={
+            "check_same_thread": False,
+        },
+        **engine_kwargs,
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma_name, pragma_value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma_name}={pragma_value}")
+        cursor.close()
+
+    logger.debug(f"Created SQLite engine for {repr(db_path)} with {dict(pragmas)}")
+    return engine
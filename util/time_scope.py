@@ -120,6 +120,13 @@ class TimeScope(str):
 
         return self._dt_end
 
+    @property
+    def type(self) -> Type:
+        if not hasattr(self, "_type"):
+            self._build_properties()
+
+        return self._type
+
     @property
     def is_day(self) -> bool:
         if not hasattr(self, "_type"):